@@ -0,0 +1,274 @@
+'''
+Local stand-ins for cms.gov, S3 and Snowflake used by the benchmarks.
+
+serve_files:
+    ThreadingHTTPServer on localhost with HEAD, Range (206) and ETag /
+    Last-Modified, which is everything range_download needs.
+
+FakeS3:
+    The boto3 client calls upload_multipart makes. Parts are written into
+    a local directory and stitched together on complete, so the upload
+    side costs real reads and writes.
+
+FakeSnowflakeConnection:
+    Understands the handful of statements the loaders run (PUT, LIST,
+    REMOVE, COPY INTO, COUNT(*), CREATE ... LIKE, SWAP, TRUNCATE, the
+    information_schema column lookup, execute_async). PUT copies the files
+    into a local stage directory and COPY counts the rows of the staged
+    files, so the warehouse side costs a decompress and count pass. Load
+    stage numbers are for comparing modes against each other, not for
+    predicting real Snowflake timings.
+'''
+
+import glob
+import gzip
+import os
+import re
+import shutil
+import sys
+import threading
+import uuid
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# shared helpers live in src/utils
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils'))
+from npi_rowcount import RowCounter
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+BLOCK_SIZE = 16 * 1024 * 1024
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        self._send(head=True)
+
+    def do_GET(self):
+        self._send()
+
+    def _send(self, head=False):
+        path = self.server.files.get(self.path.lstrip('/'))
+        if not path:
+            self.send_error(404)
+            return
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        self.send_response(206 if match else 200)
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        stat = os.stat(path)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', f'"{stat.st_size:x}-{int(stat.st_mtime):x}"')
+        self.send_header('Last-Modified', formatdate(stat.st_mtime, usegmt=True))
+        self.end_headers()
+        if head:
+            return
+        with open(path, 'rb') as file:
+            file.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                block = file.read(min(BLOCK_SIZE, remaining))
+                if not block:
+                    break
+                self.wfile.write(block)
+                remaining -= len(block)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_files(files):
+    # files: url name -> local path; returns (server, base_url), call server.shutdown() when done
+    server = ThreadingHTTPServer(('127.0.0.1', 0), RangeRequestHandler)
+    server.daemon_threads = True
+    server.files = files
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+class FakeS3:
+    def __init__(self, root):
+        self.root = root
+        self.uploads = {}
+        os.makedirs(root, exist_ok=True)
+
+    def _part_path(self, upload_id, number):
+        return os.path.join(self.root, f'{upload_id}.{number:05d}.part')
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        upload_id = uuid.uuid4().hex
+        self.uploads[upload_id] = (Bucket, Key, {})
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, PartNumber, UploadId, Body, **kwargs):
+        data = Body.read() if hasattr(Body, 'read') else Body
+        with open(self._part_path(UploadId, PartNumber), 'wb') as file:
+            file.write(data)
+        etag = f'"{uuid.uuid4().hex}"'
+        self.uploads[UploadId][2][PartNumber] = (etag, len(data))
+        return {'ETag': etag}
+
+    def list_parts(self, Bucket, Key, UploadId, **kwargs):
+        parts = self.uploads[UploadId][2]
+        return {'Parts': [{'PartNumber': number, 'ETag': etag, 'Size': size}
+                          for number, (etag, size) in sorted(parts.items())],
+                'IsTruncated': False}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        out_path = os.path.join(self.root, Key.replace('/', '_'))
+        with open(out_path, 'wb') as out:
+            for part in MultipartUpload['Parts']:
+                part_path = self._part_path(UploadId, part['PartNumber'])
+                with open(part_path, 'rb') as src:
+                    shutil.copyfileobj(src, out, BLOCK_SIZE)
+                os.remove(part_path)
+        del self.uploads[UploadId]
+        return {'Location': out_path}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        for number in self.uploads.pop(UploadId, (None, None, {}))[2]:
+            os.remove(self._part_path(UploadId, number))
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        with open(os.path.join(self.root, Key.replace('/', '_')), 'wb') as out:
+            if hasattr(Body, 'read'):
+                shutil.copyfileobj(Body, out, BLOCK_SIZE)
+            else:
+                out.write(Body)
+        return {}
+
+def count_staged_rows(path):
+    if path.endswith('.parquet'):
+        return pq.ParquetFile(path).metadata.num_rows
+    counter = RowCounter()
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as file:
+        while True:
+            block = file.read(BLOCK_SIZE)
+            if not block:
+                break
+            counter.feed(block)
+    return counter.data_rows()
+
+class FakeSnowflakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.rows = []
+        self.sfqid = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        pass
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def execute(self, sql, params=None):
+        self.rows = self.conn.run(sql, params)
+        return self
+
+    def execute_async(self, sql, params=None):
+        self.sfqid = uuid.uuid4().hex
+        self.conn.results[self.sfqid] = self.conn.run(sql, params)
+        return {'queryId': self.sfqid}
+
+    def get_results_from_sfqid(self, query_id):
+        self.rows = self.conn.results.pop(query_id)
+
+class FakeSnowflakeConnection:
+    def __init__(self, stage_dir, tables=None):
+        # tables: name -> column list, names are matched case-insensitively
+        self.stage_dir = stage_dir
+        self.columns = {name.upper(): list(columns) for name, columns in (tables or {}).items()}
+        self.row_counts = {name: 0 for name in self.columns}
+        self.results = {}
+        self.statements = []
+        self.lock = threading.Lock()
+        os.makedirs(stage_dir, exist_ok=True)
+
+    def cursor(self):
+        return FakeSnowflakeCursor(self)
+
+    def close(self):
+        pass
+
+    def get_query_status_throw_if_error(self, query_id):
+        return 'SUCCESS'
+
+    def is_still_running(self, status):
+        return False
+
+    def run(self, sql, params=None):
+        statement = ' '.join(sql.split())
+        with self.lock:
+            self.statements.append(statement.split(' ', 1)[0].upper())
+        upper = statement.upper()
+
+        match = re.match(r"PUT file://(\S+) @\w+", statement, re.IGNORECASE)
+        if match:
+            rows = []
+            for path in sorted(glob.glob(match.group(1))):
+                name = os.path.basename(path)
+                shutil.copyfile(path, os.path.join(self.stage_dir, name))
+                size = os.path.getsize(path)
+                rows.append((path, name, size, size, 'NONE', 'NONE', 'UPLOADED', ''))
+            return rows
+        if upper.startswith('LIST @'):
+            return [(f'stage/{name}', os.path.getsize(os.path.join(self.stage_dir, name)), '', '')
+                    for name in os.listdir(self.stage_dir)]
+        match = re.match(r"REMOVE @\w+/(\S+)", statement, re.IGNORECASE)
+        if match:
+            path = os.path.join(self.stage_dir, match.group(1))
+            if os.path.exists(path):
+                os.remove(path)
+            return [(match.group(1), 'removed')]
+        match = re.match(r"COPY INTO (\S+) FROM @\w+ FILES = \(([^)]*)\)", statement, re.IGNORECASE)
+        if match:
+            table = match.group(1).upper()
+            rows = []
+            for name in re.findall(r"'([^']+)'", match.group(2)):
+                loaded = count_staged_rows(os.path.join(self.stage_dir, name))
+                rows.append((name, 'LOADED', loaded, loaded, 1, 0, None, None, None, None))
+            with self.lock:
+                self.row_counts[table] = self.row_counts.get(table, 0) + sum(row[3] for row in rows)
+            return rows
+        match = re.match(r"SELECT COUNT\(\*\) FROM (\S+)", statement, re.IGNORECASE)
+        if match:
+            return [(self.row_counts.get(match.group(1).upper(), 0),)]
+        match = re.match(r"CREATE OR REPLACE (?:TRANSIENT )?TABLE (\S+) LIKE (\S+)", statement, re.IGNORECASE)
+        if match:
+            new, source = match.group(1).upper(), match.group(2).upper()
+            self.columns[new] = list(self.columns.get(source, []))
+            self.row_counts[new] = 0
+            return [(f'Table {new} successfully created.',)]
+        match = re.match(r"ALTER TABLE (\S+) SWAP WITH (\S+)", statement, re.IGNORECASE)
+        if match:
+            first, second = match.group(1).upper(), match.group(2).upper()
+            self.row_counts[first], self.row_counts[second] = (self.row_counts.get(second, 0),
+                                                               self.row_counts.get(first, 0))
+            return [('Statement executed successfully.',)]
+        match = re.match(r"TRUNCATE TABLE (\S+)", statement, re.IGNORECASE)
+        if match:
+            self.row_counts[match.group(1).upper()] = 0
+            return [('Statement executed successfully.',)]
+        if 'INFORMATION_SCHEMA.COLUMNS' in upper:
+            schema, name = params
+            table = next((key for key in self.columns if key.endswith(f'.{schema}.{name}')), None)
+            return [(column,) for column in self.columns.get(table, [])]
+        # CREATE STAGE, BEGIN, COMMIT, ROLLBACK, DROP ...
+        return [('Statement executed successfully.',)]
@@ -0,0 +1,126 @@
+'''
+Synthetic NPPES-shaped archives for the offline benchmarks.
+
+Builds a ZIP laid out like the CMS monthly file: one data CSV plus a
+header-only *_fileheader.csv per member, every field quoted, most of the
+wide npidata columns empty. NPIs carry valid Luhn check digits, dates are
+MM/DD/YYYY and a share of rows has a quoted newline in an address field,
+so the quote-aware paths get exercised too.
+
+    python npi_synthetic.py --rows 1000000 --columns 330 --out synthetic.zip
+'''
+
+import argparse
+import logging
+import os
+import sys
+import time
+import zipfile
+
+# shared helpers live in src/utils
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils'))
+from npi_projection import NPIDATA_COLUMNS
+
+DATE_RANGE = '20050523-20241013'
+MEMBERS = ['npidata_pfile', 'endpoint_pfile', 'othername_pfile', 'pl_pfile']
+WRITE_BATCH = 10000
+
+ENDPOINT_COLUMNS = ['NPI', 'Endpoint Type', 'Endpoint Type Description', 'Endpoint', 'Affiliation',
+                    'Endpoint Description', 'Affiliation Legal Business Name', 'Use Code', 'Use Description',
+                    'Other Use Description', 'Content Type', 'Content Description', 'Other Content Description',
+                    'Affiliation Address Line One', 'Affiliation Address Line Two', 'Affiliation Address City',
+                    'Affiliation Address State', 'Affiliation Address Country', 'Affiliation Address Postal Code']
+OTHERNAME_COLUMNS = ['NPI', 'Provider Other Organization Name', 'Provider Other Organization Name Type Code']
+PL_COLUMNS = ['NPI', 'Provider Secondary Practice Location Address- Address Line 1',
+              'Provider Secondary Practice Location Address-  Address Line 2',
+              'Provider Secondary Practice Location Address - City Name',
+              'Provider Secondary Practice Location Address - State Name',
+              'Provider Secondary Practice Location Address - Postal Code',
+              'Provider Secondary Practice Location Address - Country Code (If outside U.S.)',
+              'Provider Secondary Practice Location Address - Telephone Number',
+              'Provider Secondary Practice Location Address - Telephone Extension',
+              'Provider Practice Location Address - Fax Number']
+
+def npi_for(index):
+    # 9 digit base plus the Luhn check digit over the 80840 prefix
+    base = str(100000000 + index % 900000000)
+    total = 24
+    for position, char in enumerate(base):
+        digit = int(char)
+        if position % 2 == 0:
+            digit *= 2
+            digit -= 9 if digit > 9 else 0
+        total += digit
+    return base + str((10 - total % 10) % 10)
+
+def npidata_header(columns):
+    header = list(NPIDATA_COLUMNS[:columns])
+    header += [f'Healthcare Provider Taxonomy Group_{index}' for index in range(1, columns - len(header) + 1)]
+    return header
+
+def _quoted(values):
+    return ','.join(f'"{value}"' for value in values) + '\n'
+
+def npidata_rows(start, count, header):
+    positions = {name: index for index, name in enumerate(header)}
+    empty = [''] * len(header)
+    for index in range(start, start + count):
+        row = list(empty)
+        entity = '1' if index % 3 else '2'
+        row[positions['NPI']] = npi_for(index)
+        for name, value in (('Entity Type Code', entity),
+                            ('Provider Last Name (Legal Name)', f'LAST{index}'),
+                            ('Provider First Name', f'FIRST{index % 997}'),
+                            ('Provider Business Practice Location Address City Name', 'SPRINGFIELD'),
+                            ('Provider Business Practice Location Address State Name', 'IL'),
+                            ('Provider Business Practice Location Address Postal Code', f'{62700 + index % 99:05d}'),
+                            ('Provider Enumeration Date', f'{index % 12 + 1:02d}/{index % 28 + 1:02d}/20{index % 20:02d}'),
+                            ('Last Update Date', '07/08/2024'),
+                            ('Healthcare Provider Taxonomy Code_1', '207Q00000X'),
+                            ('Healthcare Provider Primary Taxonomy Switch_1', 'Y')):
+            if name in positions:
+                row[positions[name]] = value
+        if index % 50 == 0 and 'Provider First Line Business Practice Location Address' in positions:
+            # quoted newline, like the multi line addresses in the real file
+            row[positions['Provider First Line Business Practice Location Address']] = f'{index} MAIN ST\nSUITE 5'
+        yield _quoted(row)
+
+def narrow_rows(start, count, header):
+    for index in range(start, start + count):
+        yield _quoted([npi_for(index)] + [f'VALUE{index % 101}' if position % 2 else ''
+                                          for position in range(1, len(header))])
+
+def _write_member(zip_ref, name, header, rows, row_generator):
+    zip_ref.writestr(f'{name}_{DATE_RANGE}_fileheader.csv', _quoted(header))
+    with zip_ref.open(f'{name}_{DATE_RANGE}.csv', 'w', force_zip64=True) as dst:
+        dst.write(_quoted(header).encode())
+        for start in range(0, rows, WRITE_BATCH):
+            dst.write(''.join(row_generator(start, min(WRITE_BATCH, rows - start), header)).encode())
+
+def build_archive(out_path, rows=100000, columns=330, members=('npidata_pfile',), compresslevel=6):
+    started = time.perf_counter()
+    with zipfile.ZipFile(out_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=compresslevel) as zip_ref:
+        for member in members:
+            if member == 'npidata_pfile':
+                _write_member(zip_ref, member, npidata_header(columns), rows, npidata_rows)
+            else:
+                header = {'endpoint_pfile': ENDPOINT_COLUMNS, 'othername_pfile': OTHERNAME_COLUMNS,
+                          'pl_pfile': PL_COLUMNS}[member]
+                # the side files are a fraction of the main one in the real archive
+                _write_member(zip_ref, member, header, max(rows // 10, 1), narrow_rows)
+    logging.info(f"Built {out_path} ({os.path.getsize(out_path) / (1024 * 1024):.1f} MB, {rows} rows, "
+                 f"{columns} columns, {list(members)}) in {time.perf_counter() - started:.2f} seconds")
+    return out_path
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a synthetic NPPES-shaped ZIP")
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--columns', type=int, default=330)
+    parser.add_argument('--members', nargs='+', choices=MEMBERS, default=['npidata_pfile'])
+    parser.add_argument('--out', default='synthetic_nppes.zip')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    build_archive(args.out, args.rows, args.columns, args.members)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+'''
+Offline end-to-end benchmarks for the NPI loaders.
+
+Nothing here talks to cms.gov, S3 or Snowflake. A synthetic NPPES-shaped
+ZIP (npi_synthetic) is served from a local HTTP server, uploads go to a
+local S3 stand-in and the loaders get a fake Snowflake connection
+(npi_fakes). Every stage runs in its own spawned process so its peak RSS
+(resource.getrusage) is its own, and is timed with perf_counter:
+
+    download-legacy     download_file(streaming=False), whole ZIP in memory
+    download-single     download_file with one connection, spilled to disk
+    download-ranged     download_file with DOWNLOAD_CONNECTIONS range requests
+    remote-member       open_remote_zip, range-read only the smallest member in --members
+    extract             extract_files for every member in --members
+    extract-projected   extract_files with the default column projection
+    extract-lookup      extract_member_to_file of npidata with the NPI lookup index built on the way (needs pyarrow)
+    upload-multipart    upload_multipart of the extracted npidata CSV
+    validate            validate_csv (needs pyarrow)
+    load-single         load_data_to_snowflake, one PUT of the whole CSV
+    load-split          load_data_to_snowflake, split and compressed chunks
+    load-swap           load-split into a shadow table and SWAP
+    load-parquet        load_data_to_snowflake with Parquet staging (needs pyarrow)
+    pipelined           pipelined_load straight from the ZIP member
+    local-duckdb        load_local into a DuckDB file (needs duckdb and pyarrow)
+    local-parquet       load_local into a partitioned Parquet dataset (needs pyarrow)
+
+Results are logged as a table and written to JSON. --baseline compares
+against an earlier JSON from the same machine and exits 1 when a stage
+lost more than --tolerance of its throughput or grew its peak RSS by
+more than that. RSS is compared as the growth over the stage process's
+RSS before the stage ran, so interpreter and import overhead don't count.
+
+    python run_benchmarks.py --rows 500000 --output before.json
+    python run_benchmarks.py --rows 500000 --baseline before.json
+'''
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# shared helpers live in src/utils, the loaders in src/direct_loader
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(HERE, '..', 'utils'))
+sys.path.append(os.path.join(HERE, '..', 'direct_loader'))
+import Phase2_npi_failover_data_loader as loader
+from npi_extract import extract_member_to_file
+from npi_fakes import FakeS3, FakeSnowflakeConnection, serve_files
+from npi_local_sink import load_local
+from npi_lookup import LookupIndexWriter
+import npi_pipeline
+from npi_pipeline import pipelined_load
+from npi_projection import PROJECTIONS, NPIDATA_COLUMNS
+from npi_remote_zip import open_remote_zip
+from npi_s3_upload import upload_multipart
+from npi_synthetic import build_archive, MEMBERS
+from npi_validate import validate_csv
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+MB = 1024 * 1024
+ARCHIVE_NAME = 'NPPES_Data_Dissemination_Synthetic.zip'
+# RSS growth below this is noise, not a regression
+RSS_NOISE_MB = 16
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / MB if sys.platform == 'darwin' else peak / 1024
+
+def stage_rss_mb(result):
+    # what the stage itself added on top of the interpreter and imports
+    if result.get('peak_rss_mb') is None or result.get('baseline_rss_mb') is None:
+        return None
+    return max(result['peak_rss_mb'] - result['baseline_rss_mb'], 0)
+
+def _fresh_dir(ctx, name):
+    path = os.path.join(ctx['workdir'], name)
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    return path
+
+def _fake_snowflake(ctx):
+    return FakeSnowflakeConnection(_fresh_dir(ctx, 'stage'), {loader.TARGET_TABLE: ctx['header']})
+
+def _download(ctx, **kwargs):
+    buffer = loader.download_file(ctx['url'], **kwargs)
+    with buffer:
+        buffer.seek(0, os.SEEK_END)
+        return buffer.tell(), None
+
+def _remote_member(ctx):
+    # what the endpoint-only scripts do, MB/s is over the uncompressed member
+    with open_remote_zip(ctx['url']) as zip_ref:
+        info = min((info for info in zip_ref.infolist()
+                    if info.filename.startswith(tuple(ctx['members'])) and not info.filename.endswith('fileheader.csv')),
+                   key=lambda info: info.compress_size)
+        with zip_ref.open(info) as member:
+            while member.read(16 * MB):
+                pass
+    return info.file_size, None
+
+def _extract(ctx, projections=None):
+    member_tables = {prefix: loader.MEMBER_TABLES[prefix] for prefix in ctx['members']}
+    dest_dir = _fresh_dir(ctx, 'extract')
+    with open(ctx['archive'], 'rb') as buffer:
+        extracted = loader.extract_files(buffer, member_tables, dest_dir, projections=projections)
+    # throughput is measured on the uncompressed members read, projected output is smaller
+    with zipfile.ZipFile(ctx['archive']) as zip_ref:
+        processed = sum(info.file_size for info in zip_ref.infolist()
+                        if info.filename.startswith(tuple(ctx['members'])) and not info.filename.endswith('fileheader.csv'))
+    shutil.rmtree(dest_dir)
+    return processed, sum(file.row_count for file in extracted.values())
+
+def _extract_lookup(ctx):
+    dest_dir = _fresh_dir(ctx, 'lookup')
+    writer = LookupIndexWriter(os.path.join(dest_dir, 'npi_lookup'))
+    with zipfile.ZipFile(ctx['archive']) as zip_ref:
+        extracted = extract_member_to_file(zip_ref, ctx['member'], os.path.join(dest_dir, 'npidata.csv'), tee=writer)
+    writer.close()
+    return extracted.size, extracted.row_count
+
+def _upload(ctx):
+    s3_client = FakeS3(_fresh_dir(ctx, 's3'))
+    upload_multipart(s3_client, 'benchmark', 'npi/npidata.csv', ctx['csv_path'])
+    return ctx['csv_size'], ctx['rows']
+
+def _validate(ctx):
+    report = validate_csv(ctx['csv_path'], expected_columns=len(ctx['header']))
+    return ctx['csv_size'], report['rows']
+
+def _load(ctx, split=True, **kwargs):
+    loader.SPLIT_STAGING = split
+    conn = _fake_snowflake(ctx)
+    loader.load_data_to_snowflake(ctx['csv_path'], conn, ctx['rows'], None, table=loader.TARGET_TABLE, **kwargs)
+    loaded = conn.row_counts[loader.TARGET_TABLE.upper()]
+    if loaded != ctx['rows']:
+        raise Exception(f"Fake table has {loaded} rows, expected {ctx['rows']}")
+    return ctx['csv_size'], loaded
+
+def _pipelined(ctx):
+    # the fake COPY finishes as soon as it is submitted, the real poll interval would only time sleeps
+    npi_pipeline.POLL_INTERVAL = 0.01
+    conn = _fake_snowflake(ctx)
+    with zipfile.ZipFile(ctx['archive']) as zip_ref:
+        result = pipelined_load(conn, zip_ref, ctx['member'], loader.TARGET_TABLE, loader.STAGE_NAME,
+                                _fresh_dir(ctx, 'chunks'))
+    return ctx['csv_size'], result.rows_loaded
+
+def _local(ctx, sink):
+    path = os.path.join(_fresh_dir(ctx, 'local'), 'npi.duckdb' if sink == 'duckdb' else 'dataset')
+    loaded = load_local(sink, ctx['csv_path'], path, loader.TARGET_TABLE, ctx['rows'])
+    return ctx['csv_size'], loaded
+
+STAGES = {
+    'download-legacy': lambda ctx: _download(ctx, streaming=False),
+    'download-single': lambda ctx: _download(ctx, connections=1),
+    'download-ranged': lambda ctx: _download(ctx),
+    'remote-member': _remote_member,
+    'extract': _extract,
+    'extract-projected': lambda ctx: _extract(ctx, projections=PROJECTIONS),
+    'extract-lookup': _extract_lookup,
+    'upload-multipart': _upload,
+    'validate': _validate,
+    'load-single': lambda ctx: _load(ctx, split=False),
+    'load-split': _load,
+    'load-swap': lambda ctx: _load(ctx, strategy='swap'),
+    'load-parquet': lambda ctx: _load(ctx, staging='parquet'),
+    'pipelined': _pipelined,
+    'local-duckdb': lambda ctx: _local(ctx, 'duckdb'),
+    'local-parquet': lambda ctx: _local(ctx, 'parquet'),
+}
+NEEDS_PYARROW = {'validate', 'load-parquet', 'local-duckdb', 'local-parquet', 'extract-lookup'}
+
+def _run_stage(name, ctx, results, verbose):
+    logging.basicConfig(level=logging.INFO if verbose else logging.WARNING,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    os.chdir(ctx['workdir'])
+    baseline_rss = peak_rss_mb()
+    started = time.perf_counter()
+    try:
+        processed, rows = STAGES[name](ctx)
+    except Exception as e:
+        results.put({'stage': name, 'error': f"{type(e).__name__}: {e}"})
+        return
+    seconds = max(time.perf_counter() - started, 1e-6)
+    results.put({'stage': name, 'seconds': seconds, 'mb': processed / MB,
+                 'mb_per_second': processed / MB / seconds,
+                 'rows_per_second': rows / seconds if rows else None,
+                 'peak_rss_mb': peak_rss_mb(), 'baseline_rss_mb': baseline_rss})
+
+def run_stage(name, ctx, verbose=False):
+    # spawn, not fork, so the peak RSS doesn't start from the parent's
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=_run_stage, args=(name, ctx, results, verbose))
+    process.start()
+    process.join()
+    if results.empty():
+        return {'stage': name, 'error': f"process exited with code {process.exitcode}"}
+    return results.get()
+
+def prepare(args, workdir):
+    archive = args.archive or build_archive(os.path.join(workdir, ARCHIVE_NAME), args.rows, args.columns,
+                                            args.members)
+    with zipfile.ZipFile(archive) as zip_ref:
+        member = next(info for info in zip_ref.infolist()
+                      if info.filename.startswith('npidata_pfile') and not info.filename.endswith('fileheader.csv'))
+        csv_path = os.path.join(workdir, 'data', os.path.basename(member.filename))
+        os.makedirs(os.path.dirname(csv_path), exist_ok=True)
+        extracted = extract_member_to_file(zip_ref, member, csv_path)
+        with zip_ref.open(member) as file:
+            header = file.readline().decode().strip().strip('"').split('","')
+    return {'workdir': workdir, 'archive': archive, 'member': member.filename, 'members': args.members,
+            'csv_path': csv_path, 'csv_size': extracted.size, 'rows': extracted.row_count, 'header': header}
+
+def skip_reason(name, ctx):
+    if name in NEEDS_PYARROW and pyarrow is None:
+        return "pyarrow not installed"
+    if name == 'local-duckdb' and duckdb is None:
+        return "duckdb not installed"
+    if name == 'extract-projected' and not set(NPIDATA_COLUMNS) <= set(ctx['header']):
+        return "fewer columns than the projection"
+    return None
+
+def log_results(results):
+    logging.info(f"{'stage':<20}{'seconds':>10}{'MB':>10}{'MB/s':>10}{'rows/s':>12}{'peak RSS MB':>14}")
+    for result in results:
+        if 'error' in result or 'skipped' in result:
+            logging.info(f"{result['stage']:<20}  {result.get('error') or 'skipped: ' + result['skipped']}")
+            continue
+        rows_per_second = f"{result['rows_per_second']:>12,.0f}" if result['rows_per_second'] else f"{'-':>12}"
+        peak = f"{result['peak_rss_mb']:>14.1f}" if result['peak_rss_mb'] is not None else f"{'-':>14}"
+        logging.info(f"{result['stage']:<20}{result['seconds']:>10.2f}{result['mb']:>10.1f}"
+                     f"{result['mb_per_second']:>10.1f}{rows_per_second}{peak}")
+
+def compare(results, baseline_path, tolerance):
+    with open(baseline_path, 'r') as file:
+        baseline = {result['stage']: result for result in json.load(file)['results']}
+    regressions = []
+    for result in results:
+        before = baseline.get(result['stage'])
+        if not before or 'mb_per_second' not in before or 'mb_per_second' not in result:
+            continue
+        if result['mb_per_second'] < before['mb_per_second'] * (1 - tolerance):
+            regressions.append(f"{result['stage']}: {before['mb_per_second']:.1f} -> "
+                               f"{result['mb_per_second']:.1f} MB/s")
+        rss_before, rss_after = stage_rss_mb(before), stage_rss_mb(result)
+        if rss_before is not None and rss_after is not None and \
+                rss_after > rss_before * (1 + tolerance) and rss_after - rss_before > RSS_NOISE_MB:
+            regressions.append(f"{result['stage']}: RSS growth {rss_before:.1f} -> "
+                               f"{rss_after:.1f} MB")
+    for regression in regressions:
+        logging.warning(f"Regression: {regression}")
+    return regressions
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the NPI loaders")
+    parser.add_argument('--rows', type=int, default=200000, help="rows in the synthetic npidata member")
+    parser.add_argument('--columns', type=int, default=330, help="columns in the synthetic npidata member")
+    parser.add_argument('--members', nargs='+', choices=MEMBERS, default=['npidata_pfile'])
+    parser.add_argument('--archive', help="use an existing NPPES ZIP instead of building a synthetic one")
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES), default=list(STAGES))
+    parser.add_argument('--repeat', type=int, default=1, help="runs per stage, the fastest one is kept")
+    parser.add_argument('--workdir', help="scratch directory, a temporary one by default")
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', help="earlier results JSON to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.15)
+    parser.add_argument('--verbose', action='store_true', help="show the loaders' own logging")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    # every stage has to do the real download / unzip, not hit the shared cache (inherited by the spawned stages)
+    os.environ['NPI_CACHE_MAX_GB'] = '0'
+    workdir = args.workdir or tempfile.mkdtemp(prefix='npi_bench_')
+    os.makedirs(workdir, exist_ok=True)
+    server = None
+    try:
+        ctx = prepare(args, workdir)
+        server, base_url = serve_files({ARCHIVE_NAME: ctx['archive']})
+        ctx['url'] = f"{base_url}/{ARCHIVE_NAME}"
+        logging.info(f"Benchmarking {ctx['rows']} rows, {len(ctx['header'])} columns, "
+                     f"{ctx['csv_size'] / MB:.1f} MB CSV, {os.path.getsize(ctx['archive']) / MB:.1f} MB ZIP")
+
+        results = []
+        for name in args.stages:
+            reason = skip_reason(name, ctx)
+            if reason:
+                results.append({'stage': name, 'skipped': reason})
+                continue
+            runs = [run_stage(name, ctx, args.verbose) for _ in range(args.repeat)]
+            failed = [run for run in runs if 'error' in run]
+            results.append(failed[0] if failed else min(runs, key=lambda run: run['seconds']))
+            logging.info(f"{name} done")
+    finally:
+        if server:
+            server.shutdown()
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    log_results(results)
+    with open(args.output, 'w') as file:
+        json.dump({'machine': {'platform': platform.platform(), 'python': platform.python_version(),
+                               'cpus': os.cpu_count()},
+                   'rows': ctx['rows'], 'columns': len(ctx['header']), 'csv_mb': ctx['csv_size'] / MB,
+                   'results': results}, file, indent=2)
+    logging.info(f"Results written to {args.output}")
+
+    if args.baseline and compare(results, args.baseline, args.tolerance):
+        sys.exit(1)
+    if any('error' in result for result in results):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
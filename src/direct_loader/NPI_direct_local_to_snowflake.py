@@ -9,7 +9,8 @@ Downloads ZIP → extracts CSV → saves locally → PUT to Snowflake stage →
 - Using requests.get we fetch the HTML of the website
 - Using the HTML we parse it using Beautiful Soup
 - The download link is present in an anchor tag
-- We create a buffer and download it
+- Only the endpoint member is read from the remote ZIP with range requests
+  (a few MB instead of the whole archive), full download if ranges aren't supported
 
 # Snowflake cursor steps
 
@@ -27,13 +28,17 @@ from bs4 import BeautifulSoup
 import snowflake.connector
 import re
 from datetime import datetime
-import zipfile
-import io
 import os
+import sys
 import logging
 import time
 from dotenv import load_dotenv
 
+# shared helpers live in src/utils
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils'))
+from npi_remote_zip import open_remote_zip
+from npi_cache import default_cache
+
 load_dotenv()
 
 # Logging configurations
@@ -68,24 +73,22 @@ try:
     # the website url, and concats the name of the file instead
     download_url = WEBSITE_URL.rsplit('/', 1)[0] + '/' + anchor_tag['href']
 
-    # checking if download link is valid
-    file_response = requests.get(download_url, stream=True, timeout=(10, 1000))
-    if file_response.status_code != 200:
-        raise Exception(f"Failed to download file from {download_url}")
-    logging.info("Got 200 file_response")
-    logging.info("Downloading...")
-
-    # Save the downloaded file to a buffer
-    buffer = io.BytesIO(file_response.content)
     desired_file_name = None
     desired_file_content = None
 
     logging.info("Unzipping file...")
-    with zipfile.ZipFile(buffer, 'r') as zip_ref:
+    # reads the central directory and then just the endpoint member over HTTP ranges,
+    # the shared cache skips even that when a sibling run already has the file
+    cache = default_cache()
+    with open_remote_zip(download_url, cache=cache) as zip_ref:
         for file_info in zip_ref.infolist():
             if file_info.filename.startswith('endpoint_') and not file_info.filename.endswith('fileheader.csv'):
                 desired_file_name = file_info.filename
-                desired_file_content = zip_ref.read(file_info.filename)
+                if cache:
+                    with cache.open_member(zip_ref, file_info) as member:
+                        desired_file_content = member.read()
+                else:
+                    desired_file_content = zip_ref.read(file_info.filename)
                 break
     
     logging.info("Unzipped")
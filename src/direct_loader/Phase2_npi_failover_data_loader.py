@@ -12,20 +12,99 @@ TEST VERSION Uploads to TEST table:
         truncate command
         copy into command
         select counts commands
+
+    --mode incremental MERGEs the weekly NPPES files (on NPI) instead of the full reload
+    --strategy swap loads a shadow table and swaps it in, --rollback swaps the previous snapshot back
+    --watch polls the download page with conditional requests and only loads when a new monthly file drops
+    --staging parquet converts the CSV to typed Parquet before PUT and COPYs by column name
+    --project / --columns extract only the wanted columns (from the member's fileheader.csv)
+    --validate checks the extracted CSV before PUT and aborts on a malformed file
+    --report / --prometheus-textfile write per stage metrics (wall, cpu, bytes, rows, peak RSS) for monitoring
+    --pipelined overlaps extract, compress, PUT and COPY in ~100 MB chunks (always via shadow table swap)
+    --mode diff only uploads the providers that changed since the last load (NPI -> row hash index on disk,
+        written by every full load, without one diff mode loads in full)
+    --mode backfill --months 2022-01:2024-12 (or --archives <urls/zips>) loads old monthly files into
+        <target>_history by SNAPSHOT_DATE, several archives at a time, committed oldest first
+    --sink duckdb / --sink parquet loads the monthly file into a local DuckDB file or Parquet dataset
+        instead of Snowflake (--local-path), no Snowflake credentials needed
+    --lookup-index also writes NPI_lookup.idx / .rec while extracting npidata, a memory mapped
+        NPI -> name / taxonomy / address index for services (npi_lookup.NpiLookup)
 '''
 
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
 import io
+import json
 from datetime import datetime
 import re
 import zipfile
 import os
+import shutil
+import tempfile
 import logging
 import time
+import sys
 import requests
 import snowflake.connector
 from bs4 import BeautifulSoup
 from dotenv import load_dotenv
 
+# shared helpers live in src/utils
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils'))
+from npi_download import range_download, DOWNLOAD_CONNECTIONS
+from npi_extract import extract_member_to_file, resume_extracted
+from npi_cache import default_cache
+from npi_manifest import RunManifest
+from npi_staging import split_and_compress, put_files, result_rows, put_summary, copy_summary, check_copy, \
+    PUT_RESULT_COLUMNS, COPY_RESULT_COLUMNS, COMPRESS_WORKERS
+from npi_pipeline import pipelined_load
+from npi_parquet import csv_to_parquet, PARQUET_FILE_FORMAT
+from npi_projection import extract_projected_member, find_header_member, PROJECTIONS
+from npi_validate import validate_csv
+from npi_metrics import run_metrics
+from npi_diff import diff_snapshot, apply_diff, promote_index, build_index
+from npi_backfill import run_backfill, monthly_urls, BACKFILL_WORKERS
+from npi_local_sink import load_local, LOCAL_SINKS
+from npi_lookup import LookupIndexWriter, build_lookup_index
+from npi_watch import watch, WATCH_INTERVAL, WATCH_JITTER
+from npi_incremental import find_weekly_files, pending_weekly_files, load_state, save_state, merge_weekly_file, table_columns
+
+# named stage (not temporary) so staged files survive a failed run
+STAGE_NAME = 'test_npi_load_stage'
+# state that describes the test tables, kept apart from the NPI_* files of the production loader
+MANIFEST_FILE = 'NPI_test_run_manifest.json'
+INCREMENTAL_STATE_FILE = 'NPI_test_incremental_state.json'
+WATCH_STATE_FILE = 'NPI_test_watch_state.json'
+SNAPSHOT_INDEX_FILE = 'NPI_test_snapshot_index.bin'
+LOOKUP_INDEX_FILE = 'NPI_test_lookup'  # .idx + .rec
+BACKFILL_STATE_FILE = 'NPI_test_backfill_state.json'
+BACKFILL_DIR = 'NPI_test_backfill'
+HISTORY_SUFFIX = '_history'
+TARGET_TABLE = 'PLAYGROUND_TEST.STAGE.test_npi_data'
+# ZIP member prefix -> table, one download feeds every table picked with --members
+MEMBER_TABLES = {
+    'npidata_pfile': TARGET_TABLE,
+    'endpoint_pfile': 'PLAYGROUND_TEST.STAGE.TEST_ENDPOINT',
+    'othername_pfile': 'PLAYGROUND_TEST.STAGE.test_othername',
+    'pl_pfile': 'PLAYGROUND_TEST.STAGE.test_practice_location',
+}
+DEFAULT_MEMBERS = ['npidata_pfile']
+# swap strategy loads <table>_shadow and swaps it in, the old snapshot stays there for rollback
+SHADOW_SUFFIX = '_shadow'
+DEFAULT_STRATEGY = 'truncate'
+# split the CSV into compressed ~200 MB chunks so PUT and COPY run in parallel
+SPLIT_STAGING = True
+# parquet converts the CSV to typed Parquet files first and COPYs with MATCH_BY_COLUMN_NAME
+DEFAULT_STAGING = 'csv'
+RUN_REPORT_FILE = 'NPI_run_report.json'
+# --sink duckdb / parquet write here (under the working directory) unless --local-path says otherwise
+DEFAULT_SINK = 'snowflake'
+LOCAL_SINK_PATHS = {'duckdb': 'NPI_registry.duckdb', 'parquet': 'NPI_registry_parquet'}
+# the local sinks keep their own manifests, a local run must not clear or resume the Snowflake one
+LOCAL_MANIFEST_FILES = {'duckdb': 'NPI_test_duckdb_run_manifest.json', 'parquet': 'NPI_test_parquet_run_manifest.json'}
+CSV_FILE_FORMAT = "FILE_FORMAT = (TYPE = 'CSV' FIELD_OPTIONALLY_ENCLOSED_BY = '\"' SKIP_HEADER = 1)"
+
 def configure_logging():
     log_filename = f"NPI_Loader_{datetime.now().strftime('%B_%Y_%d')}.log"
     logging.basicConfig(level=logging.INFO,
@@ -36,8 +115,11 @@ def configure_logging():
                         ])
     logging.info(f"Script started at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
 
-def load_env_variables():
+def load_env_variables(sink=DEFAULT_SINK):
     load_dotenv()
+    if sink != 'snowflake':
+        # the local sinks never connect
+        return
     required_vars = ['SNOWFLAKE_USER',
                      'SNOWFLAKE_PASSWORD',
                      'SNOWFLAKE_ACCOUNT',
@@ -59,95 +141,626 @@ def find_download_url(soup, base_url):
         raise Exception("ZIP File Download link not found")
     return base_url.rsplit('/', 1)[0] + '/' + anchor_tag['href']
 
-def download_file(url):
+def download_file(url, streaming=True, connections=DOWNLOAD_CONNECTIONS, manifest=None):
+    if streaming:
+        # parallel range download to a spill file, single stream if ranges aren't supported
+        logging.info("Downloading ZIP File...")
+        cache = default_cache()
+        if cache:
+            # the S3 scripts or an earlier run may already have fetched this exact file
+            return cache.open_archive(url, lambda dest_path: range_download(
+                url, connections=connections, dest_path=dest_path, manifest=manifest))
+        # with a manifest the ZIP is kept under its own name so a rerun can resume it
+        dest_path = os.path.join(os.getcwd(), url.rsplit('/', 1)[-1]) if manifest else None
+        return range_download(url, connections=connections, dest_path=dest_path, manifest=manifest)
     response = requests.get(url, stream=True, timeout=(10, 1000))
     response.raise_for_status()
     logging.info("ZIP File Found")
     logging.info("Downloading ZIP File...")
+    # old behaviour, keeps the whole archive in memory
     return io.BytesIO(response.content)
 
-def extract_file(buffer):
+def extract_member(zip_ref, file_info, file_path, extract=extract_member_to_file, variant='', lookup_index=None):
+    # through the shared cache when it is on, a member unzipped before is just linked back out
+    writer = LookupIndexWriter(lookup_index) if lookup_index else None
+    if writer and extract is extract_member_to_file:
+        # the index is built from the same blocks as they are written
+        extract = partial(extract_member_to_file, tee=writer)
+    cache = default_cache()
+    try:
+        if cache:
+            extracted = cache.extract_member(zip_ref, file_info, file_path, extract, variant)
+        else:
+            extracted = extract(zip_ref, file_info, file_path)
+    except Exception:
+        if writer:
+            writer.abort()
+        raise
+    if writer:
+        # reads the extracted file instead when nothing streamed through (cache hit, projection)
+        writer.close(extracted.path)
+    return extracted
+
+def extract_file(buffer, dest_dir=None, lookup_index=None):
+    dest_dir = dest_dir or os.getcwd()
     with zipfile.ZipFile(buffer, 'r') as zip_ref:
         for file_info in zip_ref.infolist():
             if file_info.filename.startswith('npi') and not file_info.filename.endswith('fileheader.csv'):
                 logging.info("DATA File Found")
-                return file_info.filename, zip_ref.read(file_info.filename)
+                file_path = os.path.join(dest_dir, file_info.filename)
+                extracted = extract_member(zip_ref, file_info, file_path, lookup_index=lookup_index)
+                logging.info("DATA File saved")
+                return extracted
     raise Exception("Desired DATA file not found in the zip")
 
-def save_file(file_name, content):
-    file_path = os.path.join(os.getcwd(), file_name)
-    with open(file_path, 'wb') as file:
-        file.write(content)
-    logging.info("DATA File saved")
-    return file_path
+def find_members(zip_ref, member_tables):
+    members = {}
+    for file_info in zip_ref.infolist():
+        if file_info.filename.endswith('fileheader.csv'):
+            continue
+        for prefix, table in member_tables.items():
+            if file_info.filename.startswith(prefix):
+                logging.info(f"DATA File Found: {file_info.filename} -> {table}")
+                members[table] = file_info
+    missing = [prefix for prefix, table in member_tables.items() if table not in members]
+    if missing:
+        raise Exception(f"Desired DATA files not found in the zip: {missing}")
+    return members
+
+def extract_files(buffer, member_tables, dest_dir=None, projections=None, lookup_index=None):
+    # every wanted member out of the one archive, keyed by target table
+    dest_dir = dest_dir or os.getcwd()
+    projections = projections or {}
+    table_prefixes = {table: prefix for prefix, table in member_tables.items()}
+    extracted = {}
+    with zipfile.ZipFile(buffer, 'r') as zip_ref:
+        for table, file_info in find_members(zip_ref, member_tables).items():
+            file_path = os.path.join(dest_dir, file_info.filename)
+            prefix = table_prefixes[table]
+            # only npidata has the provider names and addresses
+            member_index = lookup_index if prefix == 'npidata_pfile' else None
+            if prefix in projections:
+                # only the projected columns are written, the table must match that column list
+                header_member = find_header_member(zip_ref, prefix)
+                extracted[table] = extract_member(
+                    zip_ref, file_info, file_path,
+                    lambda zip_ref, file_info, file_path: extract_projected_member(
+                        zip_ref, file_info, header_member, projections[prefix], file_path),
+                    variant=json.dumps(projections[prefix]), lookup_index=member_index)
+            else:
+                extracted[table] = extract_member(zip_ref, file_info, file_path, lookup_index=member_index)
+    return extracted
 
 def connect_to_snowflake():
-    return snowflake.connector.connect(
-        user=os.getenv('SNOWFLAKE_USER'),
-        password=os.getenv('SNOWFLAKE_PASSWORD'),
-        account=os.getenv('SNOWFLAKE_ACCOUNT'),
-        database=os.getenv('SNOWFLAKE_DATABASE'),
-        schema=os.getenv('SNOWFLAKE_SCHEMA')
-    )
-
-def load_data_to_snowflake(file_path, conn):
+    with run_metrics.stage('connect'):
+        return snowflake.connector.connect(
+            user=os.getenv('SNOWFLAKE_USER'),
+            password=os.getenv('SNOWFLAKE_PASSWORD'),
+            account=os.getenv('SNOWFLAKE_ACCOUNT'),
+            database=os.getenv('SNOWFLAKE_DATABASE'),
+            schema=os.getenv('SNOWFLAKE_SCHEMA')
+        )
+
+def buffer_size(buffer):
+    buffer.seek(0, os.SEEK_END)
+    size = buffer.tell()
+    buffer.seek(0)
+    return size
+
+def staged_files_exist(cursor, files):
+    cursor.execute(f"LIST @{STAGE_NAME}")
+    listed = {row[0].rsplit('/', 1)[-1] for row in cursor.fetchall()}
+    return bool(files) and all(name in listed for name in files)
+
+def load_data_to_snowflake(file_path, conn, csv_row_count=None, manifest=None, table=TARGET_TABLE,
+                           strategy=DEFAULT_STRATEGY, staging=DEFAULT_STAGING, validate=False,
+                           compress_workers=COMPRESS_WORKERS):
     try:
         with conn.cursor() as cursor:
-            with open(file_path, 'r') as file:
-                csv_row_count = sum(1 for row in file) - 1  # Subtract 1 for the header row
-            logging.info(f"Row count in CSV file (excluding header): {csv_row_count}")            
-
-            cursor.execute("SELECT COUNT(*) FROM PLAYGROUND_TEST.STAGE.test_npi_data")
-            initial_row_count = cursor.fetchone()[0]
-            logging.info(f"Initial row count: {initial_row_count}")
-
-            cursor.execute("BEGIN")
-            cursor.execute("TRUNCATE TABLE PLAYGROUND_TEST.STAGE.test_npi_data")
-            cursor.execute("CREATE OR REPLACE TEMPORARY STAGE temp_stage")
-            cursor.execute(f"PUT file://{file_path} @temp_stage")
-            cursor.execute("""
-                COPY INTO PLAYGROUND_TEST.STAGE.test_npi_data
-                FROM @temp_stage
-                FILE_FORMAT = (TYPE = 'CSV' FIELD_OPTIONALLY_ENCLOSED_BY = '"' SKIP_HEADER = 1)
-            """)
-
-            cursor.execute("COMMIT")
-            logging.info("Data loaded into Snowflake table successfully!")
-
-            cursor.execute("SELECT COUNT(*) FROM PLAYGROUND_TEST.STAGE.test_npi_data")
-            final_row_count = cursor.fetchone()[0]
-            logging.info(f"Final row count: {final_row_count}")
-
-            new_rows_added = final_row_count - initial_row_count
-            logging.info(f"New rows added: {new_rows_added}")
+            # counted during extraction, without it the COPY is reconciled against its own rows_parsed
+            # no COUNT(*) before or after the load, COPY INTO reports what it loaded per file
+            logging.info(f"Row count in CSV file (excluding header): {csv_row_count}")
+
+            if validate:
+                # a malformed file fails here in seconds instead of after the PUT
+                with run_metrics.stage(f'validate:{table}') as stage:
+                    stage.bytes_in = os.path.getsize(file_path)
+                    stage.rows = validate_csv(file_path, expected_columns=len(table_columns(cursor, table)))['rows']
+
+            # PUT is not transactional anyway, so it runs before BEGIN and is checkpointed
+            cursor.execute(f"CREATE STAGE IF NOT EXISTS {STAGE_NAME}")
+            with run_metrics.stage(f'put:{table}') as stage:
+                stage.bytes_in = os.path.getsize(file_path)
+                stage.rows = csv_row_count
+                staged = manifest.stage(f'put:{table}') if manifest else {}
+                if (staged.get('done') and staged.get('file') == file_path and staged.get('staging', 'csv') == staging
+                        and staged_files_exist(cursor, staged['files'])):
+                    logging.info("Resuming: DATA File already staged")
+                    staged_files = staged['files']
+                elif staging == 'parquet':
+                    # column names come from the table, the Parquet columns follow the CSV order
+                    # fresh directory per run, files left by a crashed run can't end up on the stage
+                    parquet_dir = tempfile.mkdtemp(prefix='npi_parquet_', dir=os.path.dirname(file_path))
+                    try:
+                        parquet_paths, parquet_rows = csv_to_parquet(file_path, parquet_dir, table_columns(cursor, table))
+                        if parquet_rows != csv_row_count:
+                            raise Exception(f"Parquet files have {parquet_rows} rows but the CSV has {csv_row_count}")
+                        put_results = put_files(cursor, parquet_paths, STAGE_NAME)
+                    finally:
+                        shutil.rmtree(parquet_dir, ignore_errors=True)
+                    staged_files = [result['target'] for result in put_results]
+                    stage.bytes_out = put_summary(put_results)['target_bytes']
+                    if manifest:
+                        manifest.complete(f'put:{table}', file=file_path, stage=STAGE_NAME, files=staged_files, staging=staging)
+                elif SPLIT_STAGING:
+                    chunk_dir = tempfile.mkdtemp(prefix='npi_chunks_', dir=os.path.dirname(file_path))
+                    try:
+                        chunk_paths = split_and_compress(file_path, chunk_dir, workers=compress_workers)
+                        put_results = put_files(cursor, chunk_paths, STAGE_NAME)
+                    finally:
+                        shutil.rmtree(chunk_dir, ignore_errors=True)
+                    staged_files = [result['target'] for result in put_results]
+                    stage.bytes_out = put_summary(put_results)['target_bytes']
+                    if manifest:
+                        manifest.complete(f'put:{table}', file=file_path, stage=STAGE_NAME, files=staged_files, staging=staging)
+                else:
+                    cursor.execute(f"PUT file://{file_path} @{STAGE_NAME} OVERWRITE = TRUE")
+                    put_results = result_rows(cursor, PUT_RESULT_COLUMNS)
+                    staged_files = [result['target'] for result in put_results]
+                    stage.bytes_out = put_summary(put_results)['target_bytes']
+                    if manifest:
+                        manifest.complete(f'put:{table}', file=file_path, stage=STAGE_NAME, files=staged_files, staging=staging)
+            files_list = ", ".join(f"'{name}'" for name in staged_files)
+            file_format = PARQUET_FILE_FORMAT if staging == 'parquet' else CSV_FILE_FORMAT
+
+            def copy_into(target):
+                with run_metrics.stage(f'copy:{table}') as stage:
+                    cursor.execute(f"""
+                        COPY INTO {target}
+                        FROM @{STAGE_NAME}
+                        FILES = ({files_list})
+                        {file_format}
+                    """)
+                    summary = copy_summary(result_rows(cursor, COPY_RESULT_COLUMNS))
+                    stage.rows = summary['rows_loaded']
+                    # target is empty (fresh shadow or truncated) so rows loaded is its row count
+                    check_copy(summary, target, csv_row_count, len(staged_files))
+                return summary
+
+            if strategy == 'swap':
+                # readers keep querying the live table while the shadow loads,
+                # the SWAP itself is a single metadata operation
+                shadow_table = f"{table}{SHADOW_SUFFIX}"
+                cursor.execute(f"CREATE OR REPLACE TABLE {shadow_table} LIKE {table} COPY GRANTS")
+                # raises before the SWAP when the shadow doesn't reconcile
+                summary = copy_into(shadow_table)
+                cursor.execute(f"ALTER TABLE {table} SWAP WITH {shadow_table}")
+                logging.info(f"Swapped {shadow_table} into {table}, previous snapshot kept in {shadow_table}")
+            else:
+                cursor.execute("BEGIN")
+                cursor.execute(f"TRUNCATE TABLE {table}")
+                summary = copy_into(table)
+                cursor.execute("COMMIT")
+            logging.info(f"Data loaded into Snowflake table {table} successfully!")
+            if manifest:
+                manifest.complete(f'copy:{table}', table=table, rows_loaded=summary['rows_loaded'])
+            for name in staged_files:
+                cursor.execute(f"REMOVE @{STAGE_NAME}/{name}")
+            logging.info(f"Final row count: {summary['rows_loaded']}")
 
     except Exception as e:
         conn.cursor().execute("ROLLBACK")
         logging.error(f"An error occurred while loading data into Snowflake: {e}")
         raise
 
+def load_weekly_files(soup, conn):
+    state_path = os.path.join(os.getcwd(), INCREMENTAL_STATE_FILE)
+    weekly_files = pending_weekly_files(find_weekly_files(soup, WEBSITE_URL), load_state(state_path))
+    if not weekly_files:
+        logging.info("No new weekly files to apply")
+        return
+    logging.info(f"Applying {len(weekly_files)} weekly files: {[weekly.name for weekly in weekly_files]}")
+
+    # strictly in order, a later week must never be overwritten by an earlier one
+    for weekly in weekly_files:
+        with run_metrics.stage('download') as stage:
+            buffer = download_file(weekly.url)
+            stage.bytes_out = buffer_size(buffer)
+        with buffer, run_metrics.stage('extract') as stage:
+            extracted = extract_file(buffer)
+            stage.bytes_out, stage.rows = extracted.size, extracted.row_count
+        try:
+            with run_metrics.stage('merge') as stage:
+                stage.bytes_in = extracted.size
+                stage.rows = sum(merge_weekly_file(conn, extracted.path, TARGET_TABLE, STAGE_NAME))
+            save_state(state_path, weekly)
+            logging.info(f"Weekly file {weekly.name} applied")
+        finally:
+            os.remove(extracted.path)
+
+def write_snapshot_index(extracted, index_path):
+    # the table holds exactly this file now, so its index is the baseline for the next --mode diff.
+    # without the full CSV (pipelined, projected) the old index no longer matches and goes,
+    # the next --mode diff then loads in full
+    try:
+        if extracted is None:
+            raise Exception("no full npidata CSV to index")
+        with run_metrics.stage('snapshot_index') as stage:
+            stage.bytes_in = extracted.size
+            stage.rows = build_index(extracted.path, index_path)
+    except Exception as e:
+        logging.warning(f"Snapshot index not written ({e}), the next --mode diff loads in full")
+        if os.path.exists(index_path):
+            os.remove(index_path)
+
+def load_snapshot_diff(soup, conn, lookup_index=None):
+    index_path = os.path.join(os.getcwd(), SNAPSHOT_INDEX_FILE)
+    with run_metrics.stage('link_discovery'):
+        download_url = find_download_url(soup, WEBSITE_URL)
+    with run_metrics.stage('download') as stage:
+        buffer = download_file(download_url)
+        stage.bytes_out = buffer_size(buffer)
+    with buffer, run_metrics.stage('extract') as stage:
+        extracted = extract_file(buffer, lookup_index=lookup_index)
+        stage.bytes_out, stage.rows = extracted.size, extracted.row_count
+    try:
+        if not os.path.exists(index_path):
+            # nothing to diff against, a MERGE alone would keep every provider that left the file
+            logging.warning(f"No snapshot index at {index_path}, loading {TARGET_TABLE} in full instead")
+            with run_metrics.stage(f'load:{TARGET_TABLE}') as stage:
+                stage.bytes_in, stage.rows = extracted.size, extracted.row_count
+                load_data_to_snowflake(extracted.path, conn, extracted.row_count, table=TARGET_TABLE)
+            write_snapshot_index(extracted, index_path)
+            return
+        with run_metrics.stage(f'diff:{TARGET_TABLE}') as stage:
+            stage.bytes_in = extracted.size
+            diff = diff_snapshot(extracted.path, index_path)
+            stage.bytes_out = os.path.getsize(diff.upserts_path) + os.path.getsize(diff.deletes_path)
+            stage.rows = diff.inserted + diff.updated + diff.deleted
+        with run_metrics.stage(f'apply:{TARGET_TABLE}') as stage:
+            stage.bytes_in = os.path.getsize(diff.upserts_path) + os.path.getsize(diff.deletes_path)
+            stage.rows = sum(apply_diff(conn, diff, TARGET_TABLE, STAGE_NAME))
+        # only now does the table match the new snapshot
+        promote_index(diff.index_path, index_path)
+    finally:
+        leftovers = [extracted.path]
+        if 'diff' in locals():
+            leftovers += [diff.upserts_path, diff.deletes_path, diff.index_path]
+        for path in leftovers:
+            if os.path.exists(path):
+                os.remove(path)
+
+def load_table(table, extracted, manifest, strategy=DEFAULT_STRATEGY, staging=DEFAULT_STAGING, validate=False,
+               compress_workers=COMPRESS_WORKERS):
+    # separate connection per table so the loads really run side by side
+    if manifest.is_done(f'copy:{table}'):
+        logging.info(f"Resuming: {table} already loaded into Snowflake")
+        return extracted.row_count
+    conn = connect_to_snowflake()
+    try:
+        load_data_to_snowflake(extracted.path, conn, extracted.row_count, manifest, table=table,
+                               strategy=strategy, staging=staging, validate=validate,
+                               compress_workers=compress_workers)
+    finally:
+        conn.close()
+    return extracted.row_count
+
+def pipelined_load_table(zip_ref, member, table):
+    # async COPYs auto-commit per chunk, so the pipeline always loads a shadow table and swaps it in
+    shadow_table = f"{table}{SHADOW_SUFFIX}"
+    conn = connect_to_snowflake()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(f"CREATE STAGE IF NOT EXISTS {STAGE_NAME}")
+            cursor.execute(f"CREATE OR REPLACE TABLE {shadow_table} LIKE {table} COPY GRANTS")
+        with run_metrics.stage(f'pipelined:{table}') as stage:
+            stage.bytes_in = member.file_size
+            result = pipelined_load(conn, zip_ref, member, shadow_table, STAGE_NAME,
+                                    os.path.join(os.getcwd(), 'npi_chunks'))
+            stage.rows = result.rows_loaded
+        if result.rows_loaded != result.row_count:
+            raise Exception(f"{shadow_table} has {result.rows_loaded} rows but the CSV has "
+                            f"{result.row_count}, not swapping")
+        with conn.cursor() as cursor:
+            cursor.execute(f"ALTER TABLE {table} SWAP WITH {shadow_table}")
+        logging.info(f"Swapped {shadow_table} into {table}, previous snapshot kept in {shadow_table}")
+    finally:
+        conn.close()
+    return result.row_count
+
+def run_table_loads(jobs):
+    # jobs: table -> callable that loads it and returns the row count
+    results = {}
+    with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+        futures = {pool.submit(job): table for table, job in jobs.items()}
+        started = time.perf_counter()
+        for future in as_completed(futures):
+            table = futures[future]
+            try:
+                results[table] = ('LOADED', future.result(), time.perf_counter() - started, None)
+            except Exception as e:
+                results[table] = ('FAILED', None, time.perf_counter() - started, e)
+
+    logging.info("Load report:")
+    for table, (status, rows, elapsed, error) in sorted(results.items()):
+        logging.info(f"    {table}: {status}, {rows} rows, {elapsed:.2f} seconds" + (f", {error}" if error else ""))
+    failed = [table for table, (status, _, _, _) in results.items() if status == 'FAILED']
+    if failed:
+        raise Exception(f"Load failed for {failed}")
+
+def load_table_locally(table, extracted, manifest, sink, local_path, validate=False):
+    # same extracted file and manifest as load_table, only the target is different
+    if manifest.is_done(f'{sink}:{table}'):
+        logging.info(f"Resuming: {table} already loaded into {local_path}")
+        return extracted.row_count
+    if validate:
+        with run_metrics.stage(f'validate:{table}') as stage:
+            stage.bytes_in = extracted.size
+            stage.rows = validate_csv(extracted.path)['rows']
+    with run_metrics.stage(f'{sink}:{table}') as stage:
+        stage.bytes_in = extracted.size
+        stage.rows = load_local(sink, extracted.path, local_path, table, extracted.row_count)
+    manifest.complete(f'{sink}:{table}', table=table, path=local_path, rows_loaded=stage.rows)
+    return stage.rows
+
+def load_tables(extracted, manifest, strategy=DEFAULT_STRATEGY, staging=DEFAULT_STAGING, validate=False,
+                sink=DEFAULT_SINK, local_path=None):
+    if sink != 'snowflake':
+        run_table_loads({table: partial(load_table_locally, table, file, manifest, sink, local_path, validate)
+                         for table, file in extracted.items()})
+        return
+    # the tables load side by side, each gets its share of the cores for compressing chunks
+    compress_workers = max(COMPRESS_WORKERS // len(extracted), 1)
+    run_table_loads({table: partial(load_table, table, file, manifest, strategy, staging, validate, compress_workers)
+                     for table, file in extracted.items()})
+
+def load_tables_pipelined(buffer, member_tables):
+    # one ZipFile shared by all members, zipfile serialises the reads on the underlying file
+    with zipfile.ZipFile(buffer, 'r') as zip_ref:
+        run_table_loads({table: partial(pipelined_load_table, zip_ref, member, table)
+                         for table, member in find_members(zip_ref, member_tables).items()})
+
+def resume_extracted_files(manifest, member_tables):
+    extracted = {}
+    for table in member_tables.values():
+        file = resume_extracted(manifest, f'extract:{table}')
+        if not file:
+            return None
+        extracted[table] = file
+    return extracted
+
+def remove_downloaded_zip(manifest):
+    zip_path = manifest.stage('download').get('path')
+    if zip_path and os.path.exists(zip_path):
+        os.remove(zip_path)
+
+def load_monthly_file(soup, members=DEFAULT_MEMBERS, strategy=DEFAULT_STRATEGY, pipelined=False,
+                      staging=DEFAULT_STAGING, projections=None, validate=False, sink=DEFAULT_SINK, local_path=None,
+                      lookup_index=None):
+    with run_metrics.stage('link_discovery'):
+        download_url = find_download_url(soup, WEBSITE_URL)
+    manifest_file = MANIFEST_FILE if sink == 'snowflake' else LOCAL_MANIFEST_FILES[sink]
+    manifest = RunManifest(os.path.join(os.getcwd(), manifest_file), download_url)
+    member_tables = {prefix: MEMBER_TABLES[prefix] for prefix in members}
+    if pipelined and (projections or validate):
+        raise Exception("Projection and validation work on the extracted CSV, they can't be combined with --pipelined")
+    try:
+        if pipelined:
+            # extract, compress, PUT and COPY overlap, nothing is fully extracted to disk first
+            with run_metrics.stage('download') as stage:
+                buffer = download_file(download_url, manifest=manifest)
+                stage.bytes_out = buffer_size(buffer)
+            with buffer:
+                load_tables_pipelined(buffer, member_tables)
+            extracted = {}
+            remove_downloaded_zip(manifest)
+        else:
+            extracted = resume_extracted_files(manifest, member_tables)
+            if extracted and lookup_index and TARGET_TABLE in extracted:
+                # extracted by an earlier run, so the index wasn't built on the way
+                build_lookup_index(extracted[TARGET_TABLE].path, lookup_index)
+        if not pipelined and not extracted:
+            # one download, every wanted member comes out of the same archive
+            with run_metrics.stage('download') as stage:
+                buffer = download_file(download_url, manifest=manifest)
+                stage.bytes_out = buffer_size(buffer)
+            with buffer, run_metrics.stage('extract') as stage:
+                stage.bytes_in = buffer_size(buffer)
+                extracted = extract_files(buffer, member_tables, projections=projections, lookup_index=lookup_index)
+                stage.bytes_out = sum(file.size for file in extracted.values())
+                stage.rows = sum(file.row_count for file in extracted.values())
+            for table, file in extracted.items():
+                manifest.complete(f'extract:{table}', **file._asdict())
+                logging.info(f"DATA File sha256 for {table}: {file.sha256}")
+            remove_downloaded_zip(manifest)
+        if not pipelined:
+            load_tables(extracted, manifest, strategy, staging, validate, sink, local_path)
+    except Exception:
+        # on failure everything stays on disk so the next run can resume
+        logging.info("Files and manifest kept, the next run resumes from the last checkpoint")
+        raise
+
+    if sink == 'snowflake' and TARGET_TABLE in member_tables.values():
+        projected = 'npidata_pfile' in (projections or {})
+        write_snapshot_index(None if projected else extracted.get(TARGET_TABLE),
+                             os.path.join(os.getcwd(), SNAPSHOT_INDEX_FILE))
+    for file in extracted.values():
+        if os.path.exists(file.path):
+            os.remove(file.path)
+    logging.info("DATA Files removed after processing")
+    manifest.clear()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load the NPPES registry into Snowflake")
+    parser.add_argument('--mode', choices=['full', 'incremental', 'diff', 'backfill'], default='full',
+                        help="full: TRUNCATE and reload from the monthly file, "
+                             "incremental: MERGE the weekly files not applied yet, "
+                             "diff: MERGE/DELETE only what changed in the monthly file since the last load, "
+                             "backfill: load --archives / --months into the history table")
+    parser.add_argument('--archives', nargs='+',
+                        help="backfill: monthly ZIP URLs or local paths, committed in the order given")
+    parser.add_argument('--months',
+                        help="backfill: YYYY-MM:YYYY-MM range of monthly archives on download.cms.gov")
+    parser.add_argument('--backfill-workers', type=int, default=BACKFILL_WORKERS,
+                        help="backfill: archives downloaded, extracted and staged at the same time")
+    parser.add_argument('--members', nargs='+', choices=sorted(MEMBER_TABLES), default=DEFAULT_MEMBERS,
+                        help="ZIP members to load (full mode), all of them come from one download")
+    parser.add_argument('--strategy', choices=['truncate', 'swap'], default=DEFAULT_STRATEGY,
+                        help="truncate: reload the live table in one transaction, "
+                             "swap: load a shadow table and ALTER TABLE ... SWAP WITH it")
+    parser.add_argument('--staging', choices=['csv', 'parquet'], default=DEFAULT_STAGING,
+                        help="parquet converts to typed Parquet before PUT (needs pyarrow)")
+    parser.add_argument('--project', action='store_true',
+                        help="only extract the columns in PROJECTIONS (npi_projection) for each member")
+    parser.add_argument('--columns',
+                        help="JSON file mapping member prefix to the ordered list of columns to extract, implies --project")
+    parser.add_argument('--validate', action='store_true',
+                        help="check header, field counts, NPI check digits, entity types and dates before PUT (needs pyarrow)")
+    parser.add_argument('--pipelined', action='store_true',
+                        help="overlap extract, compress, PUT and COPY in chunks (always loads via shadow table swap)")
+    parser.add_argument('--rollback', action='store_true',
+                        help="swap the previous snapshot back in for --members and exit")
+    parser.add_argument('--watch', action='store_true',
+                        help="keep running and only load when a new monthly file is published (--mode full or diff)")
+    parser.add_argument('--sink', choices=['snowflake'] + LOCAL_SINKS, default=DEFAULT_SINK,
+                        help="snowflake, or load the monthly file into a local DuckDB database (duckdb, needs "
+                             "duckdb and pyarrow) or a Parquet dataset partitioned by practice state (parquet)")
+    parser.add_argument('--local-path',
+                        help="DuckDB file or Parquet dataset directory for --sink duckdb / parquet "
+                             f"(default {LOCAL_SINK_PATHS['duckdb']} / {LOCAL_SINK_PATHS['parquet']})")
+    parser.add_argument('--lookup-index', action='store_true',
+                        help=f"also write the NPI lookup index ({LOOKUP_INDEX_FILE}.idx / .rec, needs pyarrow) "
+                             "while extracting npidata (full and diff mode)")
+    parser.add_argument('--report', default=RUN_REPORT_FILE,
+                        help="JSON run report with per stage timings, bytes, rows and peak RSS")
+    parser.add_argument('--prometheus-textfile',
+                        help="also write the stage metrics here for node_exporter's textfile collector (*.prom)")
+    parser.add_argument('--interval', type=int, default=WATCH_INTERVAL,
+                        help="seconds between watch checks")
+    parser.add_argument('--jitter', type=int, default=WATCH_JITTER,
+                        help="random +/- seconds added to every watch interval")
+    args = parser.parse_args()
+    if args.mode == 'backfill' and not (args.archives or args.months):
+        parser.error("--mode backfill needs --archives or --months")
+    if args.watch and args.mode not in ('full', 'diff'):
+        # the watch follows the monthly file, weekly files would be missed and backfill has nothing to wait for
+        parser.error(f"--watch only follows the monthly file (--mode full or diff, not {args.mode})")
+    if args.sink != 'snowflake' and (args.mode != 'full' or args.pipelined or args.rollback):
+        parser.error(f"--sink {args.sink} only loads the monthly file (--mode full, without --pipelined or --rollback)")
+    if args.lookup_index and (args.mode not in ('full', 'diff') or args.pipelined):
+        parser.error("--lookup-index is built while extracting the monthly file (--mode full or diff, not --pipelined)")
+    return args
+
+def rollback_to_previous_snapshot(conn, members):
+    with conn.cursor() as cursor:
+        for prefix in members:
+            table = MEMBER_TABLES[prefix]
+            cursor.execute(f"ALTER TABLE {table} SWAP WITH {table}{SHADOW_SUFFIX}")
+            logging.info(f"Rolled {table} back to the previous snapshot")
+
+def locate_download_url(html_content):
+    return find_download_url(BeautifulSoup(html_content, 'html.parser'), WEBSITE_URL)
+
+def load_projections(args):
+    if args.columns:
+        with open(args.columns, 'r') as file:
+            return json.load(file)
+    return PROJECTIONS if args.project else None
+
+def lookup_index_path(args):
+    return os.path.join(os.getcwd(), LOOKUP_INDEX_FILE) if args.lookup_index else None
+
+def local_sink_path(args):
+    if args.sink == 'snowflake':
+        return None
+    return os.path.abspath(args.local_path or os.path.join(os.getcwd(), LOCAL_SINK_PATHS[args.sink]))
+
+def backfill_history(args, conn):
+    sources = list(args.archives or [])
+    if args.months:
+        start, _, end = args.months.partition(':')
+        sources += monthly_urls(start, end or start)
+    # workers open their own sessions with connect_to_snowflake, commits go through conn
+    with run_metrics.stage('backfill') as stage:
+        state = run_backfill(sources, conn, connect_to_snowflake, TARGET_TABLE + HISTORY_SUFFIX, TARGET_TABLE,
+                             STAGE_NAME, os.path.join(os.getcwd(), BACKFILL_DIR),
+                             os.path.join(os.getcwd(), BACKFILL_STATE_FILE), workers=args.backfill_workers)
+        stage.rows = len(state.get('committed', {}))
+
+def run_pipeline(args, conn):
+    if args.mode == 'backfill':
+        backfill_history(args, conn)
+        return
+    with run_metrics.stage('page_fetch') as stage:
+        html_content = fetch_html(WEBSITE_URL)
+        stage.bytes_in = len(html_content)
+    soup = BeautifulSoup(html_content, 'html.parser')
+    if args.mode == 'incremental':
+        load_weekly_files(soup, conn)
+    elif args.mode == 'diff':
+        load_snapshot_diff(soup, conn, lookup_index_path(args))
+    else:
+        load_monthly_file(soup, args.members, args.strategy, args.pipelined, args.staging,
+                          load_projections(args), args.validate, args.sink, local_sink_path(args),
+                          lookup_index_path(args))
+
+def run_with_new_connection(args):
+    if args.sink != 'snowflake':
+        run_pipeline(args, None)
+        return
+    conn = connect_to_snowflake()
+    try:
+        run_pipeline(args, conn)
+    finally:
+        conn.close()
+
+def write_run_report(args, success):
+    try:
+        run_metrics.write_json(args.report, success)
+        if args.prometheus_textfile:
+            run_metrics.write_prometheus(args.prometheus_textfile, success)
+    except OSError as e:
+        logging.error(f"Could not write the run report: {e}")
+
+def run_and_report(run, args):
+    # watch mode never gets to the end of main(), so every load writes its own report
+    run_metrics.reset()
+    success = False
+    try:
+        run(args)
+        success = True
+    finally:
+        write_run_report(args, success)
+
 def main():
+    args = parse_args()
     configure_logging()
     start_time = time.perf_counter()
+    run_metrics.job = os.path.splitext(os.path.basename(__file__))[0]
+    success = False
 
     try:
-        load_env_variables()
-        conn = connect_to_snowflake()  # Establish Snowflake connection first
-        html_content = fetch_html(WEBSITE_URL)
-        soup = BeautifulSoup(html_content, 'html.parser')
-        download_url = find_download_url(soup, WEBSITE_URL)
-        buffer = download_file(download_url)
-        file_name, file_content = extract_file(buffer)
-        file_path = save_file(file_name, file_content)
-        load_data_to_snowflake(file_path, conn)
+        load_env_variables(args.sink)
+        if args.rollback:
+            conn = connect_to_snowflake()
+            rollback_to_previous_snapshot(conn, args.members)
+        elif args.watch:
+            # long running, so connect per load instead of holding a session open between polls
+            watch(WEBSITE_URL, locate_download_url, lambda download_url: run_and_report(run_with_new_connection, args),
+                  os.path.join(os.getcwd(), WATCH_STATE_FILE), interval=args.interval, jitter=args.jitter)
+        elif args.sink != 'snowflake':
+            run_pipeline(args, None)
+        else:
+            conn = connect_to_snowflake()  # Establish Snowflake connection first
+            run_pipeline(args, conn)
+        success = True
     except Exception as e:
         logging.error(f"An error occurred: {e}")
     finally:
-        if 'file_path' in locals() and os.path.exists(file_path):
-            os.remove(file_path)
-            logging.info("DATA File removed after processing")
         if 'conn' in locals():
             conn.close()
+        if not args.watch:
+            write_run_report(args, success)
 
     end_time = time.perf_counter()
     execution_time = end_time - start_time
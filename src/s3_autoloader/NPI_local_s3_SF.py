@@ -10,6 +10,14 @@ ID hybridized using re
 
 tqdm for uploading bar
 
+stream_upload streams the CSV out of the ZIP straight into the multipart
+upload, set it to False for the old read-everything-then-upload path.
+Both checkpoint their parts to the manifest and leave a failed upload
+open, so a rerun only uploads the parts S3 doesn't have yet. Either way the ZIP is read remotely with range requests,
+only the central directory and the endpoint member are transferred,
+and nothing at all when the shared cache (npi_cache) already has them.
+gzip_upload compresses on the fly and uploads <key>.gz instead.
+
 '''
 
 import requests
@@ -17,14 +25,21 @@ from bs4 import BeautifulSoup
 import boto3
 from botocore.exceptions import NoCredentialsError
 from datetime import datetime
-import zipfile
-import io
 from tqdm import tqdm
 import snowflake.connector
 import re
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+import os
+import sys
+
+# shared helpers live in src/utils
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils'))
+from npi_s3_upload import upload_multipart, upload_stream, choose_part_size, count_parts, STREAM_PART_SIZE
+from npi_remote_zip import open_remote_zip
+from npi_cache import default_cache
+from npi_manifest import RunManifest
 
 # SOURCE URL where the download file is located.
 website_url = "https://download.cms.gov/nppes/NPI_Files.html"
@@ -37,6 +52,13 @@ aws_access_key_id = ''
 aws_secret_access_key = ''
 aws_region = ''
 
+# parallel part uploads
+upload_workers = 8
+# stream the member from the ZIP into the upload, memory stays at a few parts
+stream_upload = True
+# gzip while streaming, the stage/COPY in reload_data_from_s3 has to expect .gz (COMPRESSION = AUTO does)
+gzip_upload = False
+
 # Email configuration
 smtp_server = 'outlook.office365.com'
 smtp_port = 587
@@ -89,17 +111,12 @@ if not anchor_tag:
 # the website url, and concats the name of the file instead
 download_url = website_url.rsplit('/', 1)[0] + '/' + anchor_tag['href']
 
-# checking if download link is valid
-file_response = requests.get(download_url, stream=True)
-if file_response.status_code != 200:
-    raise Exception(f"Failed to download file from {download_url}")
-else:
-    print("Got 200 file_response")
-
 # Making a dynamic s3 key using current month and year
 # current_datetime = datetime.now()
 # s3_file_key = f"{s3_key_prefix}NPPES_Data_Dissemination_{current_datetime.strftime('%B_%Y')}.csv"
 s3_file_key = f"{s3_key_prefix}TESTING_GLUE.csv"
+if stream_upload and gzip_upload:
+    s3_file_key += '.gz'
 
 # Initialize the S3 client with credentials
 s3_client = boto3.client(
@@ -108,50 +125,86 @@ s3_client = boto3.client(
     aws_secret_access_key=aws_secret_access_key,
     region_name=aws_region
 )
-print("Downloading...")
-# Unzip the file in memory and find the desired CSV file
-buffer = io.BytesIO(file_response.content)
-desired_file_name = None
-desired_file_content = None
-print("Unzipping")
-with zipfile.ZipFile(buffer, 'r') as zip_ref:
+# Manifest lets a rerun pick up an interrupted multipart upload instead of starting over
+manifest = RunManifest(os.path.join(os.getcwd(), 'NPI_s3_run_manifest.json'),
+                       f"{download_url}|{s3_bucket_name}/{s3_file_key}")
+upload_state = manifest.stage('s3_upload')
+
+if upload_state.get('done'):
+    print("Resuming: file already uploaded to S3, skipping download")
+else:
+    print("Downloading...")
+    desired_file_name = None
+    desired_file_content = None
+    print("Unzipping")
+    # falls back to a full download when the server doesn't take range requests
+    cache = default_cache()
+    zip_ref = open_remote_zip(download_url, cache=cache)
     for file_info in zip_ref.infolist():
         if file_info.filename.startswith('endpoint_') and not file_info.filename.endswith('fileheader.csv'):
             desired_file_name = file_info.filename
-            desired_file_content = zip_ref.read(file_info.filename)
+            desired_member = file_info
+            if not stream_upload and cache:
+                with cache.open_member(zip_ref, file_info) as member:
+                    desired_file_content = member.read()
+            elif not stream_upload:
+                desired_file_content = zip_ref.read(file_info.filename)
             break
-print("Unzipped")
-if not desired_file_name:
-    raise Exception("Desired CSV file not found in the zip archive")
-else:
-    print("File Found")
+    if not stream_upload:
+        zip_ref.close()
+    print("Unzipped")
+    if not desired_file_name:
+        raise Exception("Desired CSV file not found in the zip archive")
+    else:
+        print("File Found")
 
 # Upload the desired CSV file to S3 using multipart upload with progress tracking
 try:
-    print("Uploading the desired CSV file using multipart upload...")
-    multipart_upload = s3_client.create_multipart_upload(Bucket=s3_bucket_name, Key=s3_file_key)
-    part_size = 5 * 1024 * 1024  # 5 MB
-    parts = []
-    total_parts = (len(desired_file_content) + part_size - 1) // part_size
-
-    for i in tqdm(range(0, len(desired_file_content), part_size), desc="Uploading parts", unit="part"):
-        part_number = len(parts) + 1
-        part = s3_client.upload_part(
-            Bucket=s3_bucket_name,
-            Key=s3_file_key,
-            PartNumber=part_number,
-            UploadId=multipart_upload['UploadId'],
-            Body=desired_file_content[i:i + part_size]
-        )
-        parts.append({'PartNumber': part_number, 'ETag': part['ETag']})
-
-    s3_client.complete_multipart_upload(
-        Bucket=s3_bucket_name,
-        Key=s3_file_key,
-        UploadId=multipart_upload['UploadId'],
-        MultipartUpload={'Parts': parts}
-    )
-    print(f"Desired CSV file successfully uploaded to s3://{s3_bucket_name}/{s3_file_key}")
+    if not upload_state.get('done') and stream_upload:
+        print("Streaming the desired CSV file from the zip into a multipart upload...")
+        # decompression and upload overlap, each part goes up as soon as it fills
+        # (with the cache on the member is copied into it on the way, or read from it on a hit)
+        member_source = cache.stream_member(zip_ref, desired_member) if cache else zip_ref.open(desired_member)
+        with member_source as member_stream, \
+                tqdm(total=desired_member.file_size, desc="Uploading", unit="B", unit_scale=True) as progress_bar:
+            upload_stream(
+                s3_client,
+                s3_bucket_name,
+                s3_file_key,
+                member_stream,
+                workers=upload_workers,
+                part_size=max(choose_part_size(desired_member.file_size), STREAM_PART_SIZE),
+                compress=gzip_upload,
+                progress=progress_bar.update,
+                upload_id=upload_state.get('upload_id'),
+                uploaded_parts=upload_state.get('parts'),
+                checkpoint=lambda upload_id, parts: manifest.update('s3_upload', upload_id=upload_id, parts=parts),
+                abort_on_error=False  # left open so the next run can resume it
+            )
+        zip_ref.close()
+        manifest.complete('s3_upload')
+        print(f"Desired CSV file successfully uploaded to s3://{s3_bucket_name}/{s3_file_key}")
+    elif not upload_state.get('done'):
+        print("Uploading the desired CSV file using multipart upload...")
+        part_size = choose_part_size(len(desired_file_content))
+        total_parts = count_parts(len(desired_file_content), part_size)
+
+        with tqdm(total=total_parts, desc="Uploading parts", unit="part") as progress_bar:
+            upload_multipart(
+                s3_client,
+                s3_bucket_name,
+                s3_file_key,
+                desired_file_content,
+                workers=upload_workers,
+                part_size=part_size,
+                progress=progress_bar.update,
+                upload_id=upload_state.get('upload_id'),
+                uploaded_parts=upload_state.get('parts'),
+                checkpoint=lambda upload_id, parts: manifest.update('s3_upload', upload_id=upload_id, parts=parts),
+                abort_on_error=False  # left open so the next run can resume it
+            )
+        manifest.complete('s3_upload')
+        print(f"Desired CSV file successfully uploaded to s3://{s3_bucket_name}/{s3_file_key}")
 
     # Call the Snowflake stored procedure
     def call_snowflake_procedure():
@@ -168,6 +221,7 @@ try:
             cursor.execute("CALL PLAYGROUND_TEST.STAGE.reload_data_from_s3();")
             result = cursor.fetchone()
             print(result[0])  # Print the result from the stored procedure
+            manifest.clear()  # run finished, next run starts fresh
             send_email("Snowflake Data Reload Status", result[0])
         except Exception as e:
             error_message = f"An error occurred while calling the procedure: {e}"
@@ -2,12 +2,22 @@
 Website -> S3 Bucket
 
 Here, it just uploads to S3 bucket after downloading the file
+
+With the shared cache on (npi_cache) the ZIP is uploaded from the cached
+copy, downloading it into the cache first if no earlier run has.
 '''
 import requests
 from bs4 import BeautifulSoup
 import boto3
 from botocore.exceptions import NoCredentialsError
 from datetime import datetime
+import os
+import sys
+
+# shared helpers live in src/utils
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils'))
+from npi_cache import default_cache
+from npi_download import range_download
 
 # SOURCE URL
 website_url = "https://download.cms.gov/nppes/NPI_Files.html"
@@ -37,10 +47,15 @@ if not anchor_tag:
 # the website url, and concats the name of the file instead
 download_url = website_url.rsplit('/', 1)[0] + '/' + anchor_tag['href']
 
-# checking if download link is valid
-file_response = requests.get(download_url, stream=True)
-if file_response.status_code != 200:
-    raise Exception(f"Failed to download file from {download_url}")
+cache = default_cache()
+if cache:
+    zip_file = cache.open_archive(download_url, lambda dest_path: range_download(download_url, dest_path=dest_path))
+else:
+    # checking if download link is valid
+    file_response = requests.get(download_url, stream=True)
+    if file_response.status_code != 200:
+        raise Exception(f"Failed to download file from {download_url}")
+    zip_file = file_response.raw
 
 # Making a dynamic s3 key using current month and year
 current_datetime = datetime.now()
@@ -54,11 +69,11 @@ s3_client = boto3.client(
     region_name=aws_region
 )
 
-# Direct transfer of file from response stream to s3 location!!
+# Direct transfer of file from response stream (or the cached ZIP) to s3 location!!
 try:
     print("Uploading...")
     s3_client.upload_fileobj(
-        Fileobj=file_response.raw,
+        Fileobj=zip_file,
         Bucket=s3_bucket_name,
         Key=s3_file_key
     )
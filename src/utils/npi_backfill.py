@@ -0,0 +1,212 @@
+'''
+Parallel backfill of monthly NPPES snapshots into a history table.
+
+The loaders only ever handle the current DDSMTH file. For history every
+archive (URL or local ZIP) goes through stage_archive on a process pool,
+independently of the others:
+    download (range requests) -> extract npidata -> split + gzip -> PUT
+into its own stage path @<stage>/backfill/<snapshot date>/. The slow
+parts (download, inflate, compress, upload) run workers archives at a
+time, so 36 months take roughly 36 / workers times one month.
+
+Commits happen in the main process, strictly in the order the archives
+were given (oldest first for --months): a snapshot is only committed once
+every earlier one is. Each commit is one transaction that replaces that
+snapshot_date in the history table with a COPY from its stage path, so a
+rerun can redo any snapshot safely. Committed snapshots are recorded in a
+small JSON state file and skipped on the next run.
+
+The snapshot date comes from the npidata member name
+(npidata_pfile_20050523-20241013.csv -> 2024-10-13).
+'''
+
+import csv
+import json
+import logging
+import os
+import re
+import shutil
+import time
+import zipfile
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date, datetime
+
+from npi_download import range_download
+from npi_cache import default_cache
+from npi_extract import extract_member_to_file
+from npi_staging import split_and_compress, put_chunks, result_rows, copy_summary, check_copy, COPY_RESULT_COLUMNS
+from npi_incremental import table_columns
+
+SNAPSHOT_COLUMN = 'SNAPSHOT_DATE'
+BACKFILL_WORKERS = 3
+DOWNLOAD_CONNECTIONS = 4  # per archive, BACKFILL_WORKERS archives at a time
+COMPRESS_WORKERS = max((os.cpu_count() or 4) // BACKFILL_WORKERS, 1)
+MEMBER_DATES = re.compile(r'npidata_pfile_(\d{8})-(\d{8})', re.IGNORECASE)
+MONTHLY_URL_TEMPLATE = 'https://download.cms.gov/nppes/NPPES_Data_Dissemination_{month}_{year}.zip'
+
+StagedSnapshot = namedtuple('StagedSnapshot', ['index', 'source', 'snapshot_date', 'row_count',
+                                               'columns', 'stage_path', 'files'])
+
+def monthly_urls(start, end, template=MONTHLY_URL_TEMPLATE):
+    # start and end as YYYY-MM, inclusive
+    year, month = (int(part) for part in start.split('-'))
+    end_year, end_month = (int(part) for part in end.split('-'))
+    urls = []
+    while (year, month) <= (end_year, end_month):
+        urls.append(template.format(month=date(year, month, 1).strftime('%B'), year=year))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return urls
+
+def snapshot_date(member_name):
+    match = MEMBER_DATES.search(member_name)
+    if not match:
+        raise Exception(f"Can't tell the snapshot date from {member_name}")
+    return datetime.strptime(match.group(2), '%Y%m%d').date().isoformat()
+
+def _is_url(source):
+    return source.startswith('http://') or source.startswith('https://')
+
+def stage_archive(index, source, work_dir, connect, stage):
+    # runs in a worker process, everything it needs is passed in and it cleans up after itself
+    started = time.perf_counter()
+    archive_dir = os.path.join(work_dir, f'archive_{index:03d}')
+    os.makedirs(archive_dir, exist_ok=True)
+    try:
+        cache = default_cache()
+        if _is_url(source) and cache:
+            # a rerun after a failure finds the archives it already fetched
+            buffer = cache.open_archive(source, lambda dest_path: range_download(
+                source, connections=DOWNLOAD_CONNECTIONS, dest_path=dest_path))
+        elif _is_url(source):
+            buffer = range_download(source, connections=DOWNLOAD_CONNECTIONS,
+                                    dest_path=os.path.join(archive_dir, source.rsplit('/', 1)[-1]))
+        else:
+            buffer = open(source, 'rb')
+        with buffer, zipfile.ZipFile(buffer) as zip_ref:
+            member = next((info for info in zip_ref.infolist()
+                           if os.path.basename(info.filename).startswith('npidata_pfile')
+                           and not info.filename.endswith('fileheader.csv')), None)
+            if member is None:
+                raise Exception(f"No npidata file in {source}")
+            snapshot = snapshot_date(member.filename)
+            extracted = extract_member_to_file(zip_ref, member,
+                                               os.path.join(archive_dir, os.path.basename(member.filename)))
+        with open(extracted.path, 'r', newline='', encoding='utf-8', errors='replace') as file:
+            columns = len(next(csv.reader(file)))
+
+        chunk_paths = split_and_compress(extracted.path, os.path.join(archive_dir, 'chunks'),
+                                         workers=COMPRESS_WORKERS)
+        os.remove(extracted.path)
+        stage_path = f"{stage}/backfill/{snapshot}"
+        conn = connect()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(f"CREATE STAGE IF NOT EXISTS {stage}")
+                files = put_chunks(cursor, chunk_paths, stage_path)
+        finally:
+            conn.close()
+    finally:
+        shutil.rmtree(archive_dir, ignore_errors=True)
+
+    logging.info(f"Staged {source} as snapshot {snapshot}: {extracted.row_count} rows, "
+                 f"{len(files)} chunks in {time.perf_counter() - started:.2f} seconds")
+    return StagedSnapshot(index, source, snapshot, extracted.row_count, columns, stage_path, files)
+
+def ensure_history_table(cursor, history_table, source_table):
+    cursor.execute(f"CREATE TABLE IF NOT EXISTS {history_table} LIKE {source_table}")
+    cursor.execute(f"ALTER TABLE {history_table} ADD COLUMN IF NOT EXISTS {SNAPSHOT_COLUMN} DATE")
+    cursor.execute(f"ALTER TABLE {history_table} CLUSTER BY ({SNAPSHOT_COLUMN})")
+
+def build_history_copy_sql(history_table, staged, column_count):
+    # older snapshots can have fewer columns than today's table, the missing ones load as NULL
+    data_columns = column_count - 1
+    if staged.columns > data_columns:
+        raise Exception(f"Snapshot {staged.snapshot_date} has {staged.columns} columns, "
+                        f"{history_table} only has {data_columns}")
+    select = [f"t.${position}" for position in range(1, staged.columns + 1)]
+    select += ['NULL'] * (data_columns - staged.columns)
+    select.append(f"TO_DATE('{staged.snapshot_date}')")
+    files_list = ", ".join(f"'{name}'" for name in staged.files)
+    return f"""
+        COPY INTO {history_table}
+        FROM (SELECT {", ".join(select)} FROM @{staged.stage_path}/ t)
+        FILES = ({files_list})
+        FILE_FORMAT = (TYPE = 'CSV' FIELD_OPTIONALLY_ENCLOSED_BY = '"' SKIP_HEADER = 1)
+    """
+
+def commit_snapshot(conn, history_table, staged, column_count):
+    started = time.perf_counter()
+    with conn.cursor() as cursor:
+        try:
+            cursor.execute("BEGIN")
+            cursor.execute(f"DELETE FROM {history_table} WHERE {SNAPSHOT_COLUMN} = %s", (staged.snapshot_date,))
+            cursor.execute(build_history_copy_sql(history_table, staged, column_count))
+            summary = copy_summary(result_rows(cursor, COPY_RESULT_COLUMNS))
+            check_copy(summary, f"{history_table} ({staged.snapshot_date})", staged.row_count, len(staged.files))
+            rows_loaded = summary['rows_loaded']
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+        cursor.execute(f"REMOVE @{staged.stage_path}/")
+    logging.info(f"Committed snapshot {staged.snapshot_date} into {history_table}: {rows_loaded} rows "
+                 f"in {time.perf_counter() - started:.2f} seconds")
+
+def load_backfill_state(state_path):
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path, 'r') as file:
+        return json.load(file)
+
+def save_backfill_state(state_path, state):
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(state, file, indent=2)
+    os.replace(tmp_path, state_path)
+
+def run_backfill(sources, conn, connect, history_table, source_table, stage, work_dir, state_path,
+                 workers=BACKFILL_WORKERS):
+    state = load_backfill_state(state_path)
+    committed = state.setdefault('committed', {})
+    pending = [source for source in sources if source not in committed.values()]
+    if not pending:
+        logging.info("Every archive is already in the history table")
+        return state
+    logging.info(f"Backfilling {len(pending)} archives on {workers} workers "
+                 f"({len(sources) - len(pending)} already committed)")
+
+    with conn.cursor() as cursor:
+        ensure_history_table(cursor, history_table, source_table)
+        column_count = len(table_columns(cursor, history_table))
+
+    staged = {}
+    failed = {}
+    next_index = 0
+    os.makedirs(work_dir, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(stage_archive, index, source, work_dir, connect, stage): index
+                   for index, source in enumerate(pending)}
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                staged[index] = future.result()
+            except Exception as e:
+                failed[index] = e
+                logging.error(f"Staging {pending[index]} failed: {e}")
+            # commit everything that is now contiguous from the oldest not yet committed,
+            # a failed archive only holds back the snapshots after it
+            while next_index in staged and next_index < min(failed, default=len(pending)):
+                snapshot = staged.pop(next_index)
+                commit_snapshot(conn, history_table, snapshot, column_count)
+                committed[snapshot.snapshot_date] = snapshot.source
+                save_backfill_state(state_path, state)
+                next_index += 1
+
+    if failed:
+        # everything before the first failure is committed, later snapshots stay staged but
+        # uncommitted and the rerun restages and commits them in order
+        raise Exception(f"Backfill stopped at {pending[min(failed)]}, {len(failed)} archives failed: "
+                        f"{[pending[index] for index in sorted(failed)]}")
+    logging.info(f"Backfill done, {len(committed)} snapshots in {history_table}")
+    return state
@@ -0,0 +1,315 @@
+'''
+Shared on-disk cache of downloaded archives and extracted members.
+
+The S3 scripts and the Snowflake loaders run separately in the same
+month and each used to download (and unzip) the same NPPES file. Every
+entry point now asks this cache first, so a repeat or sibling run only
+pays for a HEAD request.
+
+Layout under NPI_CACHE_DIR (default ~/.cache/npi_loader):
+    objects/<sha256>   the files, named by their content hash, so an
+                       archive or member reached through two keys is
+                       stored once
+    index.json         key -> sha256, size, last_used and metadata
+
+Keys:
+    archive|<url>|<ETag or Last-Modified>
+        the validator comes from a HEAD request, a new file at the same
+        URL is a new key
+    member|<name>|<CRC-32>|<size>|<variant>
+        taken from the ZIP's central directory, so the key is known
+        before a single byte of the member is read. variant tells a
+        projected extraction apart from the full one.
+
+Members are handed out as hard links, so the loaders can delete their
+copy when they are done without touching the cache. A link needs the
+cache and the loader's work directory on the same filesystem. When it
+fails, the member is extracted from the ZIP as usual and not cached, with
+a warning, rather than quietly copying ~10 GB on every run. Scripts that only read a cached file get it
+as a file object opened under the lock, so an eviction by a concurrent
+run can't pull it away between the lookup and the open.
+
+The cache holds at most NPI_CACHE_MAX_GB. The default of 30 fits a month's
+archive (~1 GB) and all of its members unpacked (npidata alone is ~10 GB)
+twice over, so the previous month survives the changeover. After every
+insert the least recently used objects are evicted until it fits again.
+A member is only cached if it fits next to the archives already held,
+so a small budget never evicts the archive for one of its own members.
+NPI_CACHE_MAX_GB=0 switches the cache off. index.json is only changed
+under a lock file (flock where available), so concurrent runs can share
+one cache directory.
+'''
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from npi_download import probe
+from npi_extract import extract_member_to_file, ExtractedFile
+from npi_rowcount import RowCounter
+
+GB = 1024 * 1024 * 1024
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'npi_loader')
+DEFAULT_MAX_GB = 30
+HASH_BLOCK_SIZE = 16 * 1024 * 1024
+
+def default_cache():
+    # read at call time, the loaders only load .env in main()
+    max_gb = float(os.getenv('NPI_CACHE_MAX_GB') or DEFAULT_MAX_GB)
+    if max_gb <= 0:
+        return None
+    return ArchiveCache(os.getenv('NPI_CACHE_DIR') or DEFAULT_CACHE_DIR, int(max_gb * GB))
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _link(src, dest):
+    # False when the two can't share an inode (another filesystem), copying instead would cost as
+    # much as extracting again, so the caller goes without the cache
+    if os.path.exists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+        return True
+    except OSError as e:
+        logging.warning(f"Could not hard link {src} to {dest} ({e}), not using the cache for it. "
+                        f"Put NPI_CACHE_DIR on the same filesystem as the working directory")
+        return False
+
+class _TeeReader:
+    # passes the member through read() and writes every block into the cache on the way
+    def __init__(self, source, out):
+        self.source = source
+        self.out = out
+        self.digest = hashlib.sha256()
+        self.counter = RowCounter()
+
+    def read(self, size=-1):
+        block = self.source.read(size)
+        self.out.write(block)
+        self.digest.update(block)
+        self.counter.feed(block)
+        return block
+
+class ArchiveCache:
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.objects = os.path.join(root, 'objects')
+        self.index_path = os.path.join(root, 'index.json')
+        self.lock = threading.Lock()
+        os.makedirs(self.objects, exist_ok=True)
+
+    @contextmanager
+    def _locked(self):
+        with self.lock, open(os.path.join(self.root, '.lock'), 'a') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load(self):
+        if not os.path.exists(self.index_path):
+            return {}
+        try:
+            with open(self.index_path, 'r') as file:
+                return json.load(file)
+        except ValueError:
+            logging.warning(f"Cache index {self.index_path} is unreadable, starting an empty one")
+            return {}
+
+    def _save(self, index):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(index, file, indent=2)
+        os.replace(tmp_path, self.index_path)
+
+    def object_path(self, sha256):
+        return os.path.join(self.objects, sha256)
+
+    def lookup(self, key):
+        # the entry for key if its object is still there, marked as just used
+        entry, _ = self._lookup(key)
+        return entry
+
+    def open_entry(self, key):
+        # (entry, open file) or (None, None). Opened under the lock, so a put() from a sibling
+        # run can't evict the object in between, and the open handle keeps reading it if it does later
+        return self._lookup(key, open_object=True)
+
+    def _lookup(self, key, open_object=False):
+        with self._locked():
+            index = self._load()
+            entry = index.get(key)
+            if entry is None:
+                return None, None
+            object_path = self.object_path(entry['sha256'])
+            if not os.path.exists(object_path):
+                del index[key]
+                self._save(index)
+                return None, None
+            file = open(object_path, 'rb') if open_object else None
+            entry['last_used'] = time.time()
+            self._save(index)
+        logging.info(f"Cache hit for {key}")
+        return entry, file
+
+    def put(self, key, path, sha256=None, **metadata):
+        # path is moved into the cache, link it back out if the caller still needs it
+        entry, _ = self._put(key, path, sha256, metadata)
+        return entry
+
+    def member_fits(self, size):
+        # room for a member of size bytes without pushing out any archive
+        with self._locked():
+            index = self._load()
+        archives = {entry['sha256']: entry['size'] for key, entry in index.items() if key.startswith('archive|')}
+        if sum(archives.values()) + size <= self.max_bytes:
+            return True
+        logging.warning(f"A {size / GB:.1f} GB member doesn't fit next to the cached archives in "
+                        f"{self.max_bytes / GB:.1f} GB (NPI_CACHE_MAX_GB), not caching it")
+        return False
+
+    def _put(self, key, path, sha256, metadata, open_object=False):
+        sha256 = sha256 or file_sha256(path)
+        object_path = self.object_path(sha256)
+        with self._locked():
+            if os.path.exists(object_path):
+                os.remove(path)
+            else:
+                # a rename when path is on the cache's filesystem, a copy when it isn't
+                shutil.move(path, object_path)
+            index = self._load()
+            replaced = index.get(key, {}).get('sha256')
+            index[key] = dict(metadata, sha256=sha256, size=os.path.getsize(object_path), last_used=time.time())
+            if replaced and replaced != sha256 and all(entry['sha256'] != replaced for entry in index.values()):
+                os.remove(self.object_path(replaced))
+            self._evict(index, keep=sha256)
+            self._save(index)
+            file = open(object_path, 'rb') if open_object else None
+        logging.info(f"Cached {key} as {sha256[:12]}")
+        return index[key], file
+
+    def _evict(self, index, keep):
+        objects = {}
+        for key, entry in index.items():
+            item = objects.setdefault(entry['sha256'], {'size': entry['size'], 'last_used': 0, 'keys': []})
+            item['last_used'] = max(item['last_used'], entry['last_used'])
+            item['keys'].append(key)
+        total = sum(item['size'] for item in objects.values())
+        for sha256, item in sorted(objects.items(), key=lambda pair: pair[1]['last_used']):
+            if total <= self.max_bytes:
+                break
+            if sha256 == keep:
+                continue
+            path = self.object_path(sha256)
+            if os.path.exists(path):
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    # still open somewhere (Windows won't delete it), try again on the next insert
+                    logging.warning(f"Could not evict {item['keys']} from the cache: {e}")
+                    continue
+            for key in item['keys']:
+                del index[key]
+            total -= item['size']
+            logging.info(f"Evicted {item['keys']} from the cache ({item['size'] / GB:.2f} GB)")
+
+    def cached_archive(self, url):
+        # (open file, validator), the file is None on a miss
+        headers = probe(url)
+        validator = headers.get('ETag') or headers.get('Last-Modified')
+        if not validator:
+            return None, None
+        _, file = self.open_entry(f"archive|{url}|{validator}")
+        return file, validator
+
+    def open_archive(self, url, download):
+        # download(dest_path) fetches url to dest_path and returns the open file, only called on a miss
+        file, validator = self.cached_archive(url)
+        if file:
+            return file
+        if not validator:
+            # nothing to tell this file from the next one at the same URL, don't cache it
+            return download(None)
+        # stable name so an interrupted download can resume from its manifest
+        partial = os.path.join(self.objects, 'partial-' + hashlib.sha256(f"{url}|{validator}".encode()).hexdigest())
+        download(partial).close()
+        _, file = self._put(f"archive|{url}|{validator}", partial, None, {'url': url}, open_object=True)
+        return file
+
+    def extract_member(self, zip_ref, info, dest_path, extract=extract_member_to_file, variant=''):
+        key = f"member|{info.filename}|{info.CRC:08x}|{info.file_size}|{variant}"
+        entry = self.lookup(key)
+        if entry and _link(self.object_path(entry['sha256']), dest_path):
+            return ExtractedFile(dest_path, entry['row_count'], entry['sha256'], entry['size'])
+        extracted = extract(zip_ref, info, dest_path)
+        if entry or not self.member_fits(extracted.size):
+            return extracted
+        # linked into the cache so put() only has to rename it
+        staged = os.path.join(self.objects, f"partial-{os.getpid()}-{threading.get_ident()}-"
+                                            f"{os.path.basename(dest_path)}")
+        try:
+            if _link(dest_path, staged):
+                self.put(key, staged, extracted.sha256, row_count=extracted.row_count)
+        finally:
+            if os.path.exists(staged):
+                os.remove(staged)
+        return extracted
+
+    @contextmanager
+    def stream_member(self, zip_ref, info):
+        # the member as a stream for readers that start working before it is all inflated,
+        # straight out of the ZIP on a miss and copied into the cache as it is read
+        key = f"member|{info.filename}|{info.CRC:08x}|{info.file_size}|"
+        _, file = self.open_entry(key)
+        if file:
+            with file:
+                yield file
+            return
+        if not self.member_fits(info.file_size):
+            with zip_ref.open(info) as source:
+                yield source
+            return
+        partial = os.path.join(self.objects, f"partial-{os.getpid()}-{threading.get_ident()}-"
+                                             f"{os.path.basename(info.filename)}")
+        try:
+            with zip_ref.open(info) as source, open(partial, 'wb') as out:
+                reader = _TeeReader(source, out)
+                yield reader
+            # a reader that stopped early leaves a partial copy, that one is not cached
+            if reader.counter.size == info.file_size:
+                self.put(key, partial, reader.digest.hexdigest(), row_count=reader.counter.data_rows())
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+
+    def open_member(self, zip_ref, info):
+        # the full member as an open file inside the cache, for scripts that only read it
+        key = f"member|{info.filename}|{info.CRC:08x}|{info.file_size}|"
+        _, file = self.open_entry(key)
+        if file:
+            return file
+        if not self.member_fits(info.file_size):
+            return zip_ref.open(info)
+        partial = os.path.join(self.objects, f"partial-{os.getpid()}-{os.path.basename(info.filename)}")
+        extracted = extract_member_to_file(zip_ref, info, partial)
+        _, file = self._put(key, partial, extracted.sha256, {'row_count': extracted.row_count}, open_object=True)
+        return file
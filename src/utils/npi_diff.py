@@ -0,0 +1,334 @@
+'''
+Month over month diff of the npidata file against the last loaded snapshot.
+
+Only a small share of the ~8M providers change between monthly files, so
+instead of TRUNCATE and reload we keep an index of the snapshot that is
+in the table and upload just the difference.
+
+The index is a flat binary file, NPIIDX01 + record count, then one
+little-endian (npi, hash) pair of uint64s per provider, sorted by NPI
+(~128 MB for 8M rows). It is memory mapped, never read into Python
+objects: SnapshotIndex exposes the NPIs and hashes as zero-copy views
+(numpy arrays if numpy is installed) and lookup() binary searches it.
+The hash is an 8 byte blake2b of the raw CSV record, so any change in
+any column shows up.
+
+diff_snapshot reads the new CSV once:
+    1. records are cut quote aware (a quoted field may hold a newline)
+       and hashed in batches of RECORD_BATCH
+    2. each batch is looked up in the old index: NPI missing from it ->
+       inserted, hash differs -> updated, and those records go straight
+       into <name>_upserts.csv while the batch is still in memory
+    3. after the pass the (npi, hash) pairs are sorted, NPIs of the old
+       index missing from them -> deleted, into <name>_deletes.csv
+    4. the sorted pairs are the new index, written next to the old one
+       as <index>.new
+With numpy the lookups and the sort are vectorised, without it they fall
+back to plain Python over the mmap (slower, same result). Hashing is
+still one blake2b call per record.
+
+apply_diff stages both files and runs MERGE + DELETE in one transaction.
+The caller promotes <index>.new over the old index only after that
+commits (promote_index), so a failed load diffs against the same
+snapshot again next time.
+
+The baseline comes from the full load: build_index hashes the file that
+was just loaded, so the index always matches the table. diff_snapshot
+refuses to run without one, a MERGE against no baseline would keep every
+provider that has left the file since.
+'''
+
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import time
+from array import array
+from collections import namedtuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from npi_incremental import table_columns, build_merge_sql, KEY_COLUMN
+from npi_staging import result_rows, copy_summary, check_copy, PUT_RESULT_COLUMNS, COPY_RESULT_COLUMNS
+
+INDEX_MAGIC = b'NPIIDX01'
+INDEX_HEADER = struct.Struct('<8sQ')
+BLOCK_SIZE = 16 * 1024 * 1024
+HASH_SIZE = 8
+RECORD_BATCH = 65536  # records hashed and looked up in the old index together
+
+SnapshotDiff = namedtuple('SnapshotDiff', ['upserts_path', 'deletes_path', 'index_path', 'rows',
+                                           'inserted', 'updated', 'deleted'])
+
+class SnapshotIndex:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.mapped = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = INDEX_HEADER.unpack_from(self.mapped, 0)
+        if magic != INDEX_MAGIC:
+            self.close()
+            raise Exception(f"{path} is not an NPI snapshot index")
+        if np is not None:
+            records = np.frombuffer(self.mapped, dtype='<u8', count=2 * self.count, offset=INDEX_HEADER.size)
+        else:
+            records = memoryview(self.mapped)[INDEX_HEADER.size:INDEX_HEADER.size + 16 * self.count].cast('Q')
+        self.records = records
+        self.npis = records[0::2]
+        self.hashes = records[1::2]
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def lookup(self, npi):
+        # hash of the provider's record in this snapshot, None if it isn't in it
+        if np is not None:
+            position = int(np.searchsorted(self.npis, npi))
+        else:
+            low, high = 0, self.count
+            while low < high:
+                middle = (low + high) // 2
+                if self.npis[middle] < npi:
+                    low = middle + 1
+                else:
+                    high = middle
+            position = low
+        if position < self.count and self.npis[position] == npi:
+            return int(self.hashes[position])
+        return None
+
+    def close(self):
+        # views have to go before the mmap can close
+        for name in ('npis', 'hashes', 'records'):
+            view = self.__dict__.pop(name, None)
+            if isinstance(view, memoryview):
+                view.release()
+            del view
+        self.mapped.close()
+        self.file.close()
+
+def write_index(path, npis, hashes):
+    # npis and hashes already sorted by NPI
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(INDEX_HEADER.pack(INDEX_MAGIC, len(npis)))
+        if np is not None:
+            records = np.empty(2 * len(npis), dtype='<u8')
+            records[0::2] = npis
+            records[1::2] = hashes
+            file.write(records.tobytes())
+        else:
+            records = array('Q', bytes(16 * len(npis)))
+            records[0::2] = array('Q', npis)
+            records[1::2] = array('Q', hashes)
+            file.write(records.tobytes())
+    os.replace(tmp_path, path)
+
+def promote_index(new_index_path, index_path):
+    os.replace(new_index_path, index_path)
+    logging.info(f"Snapshot index {index_path} now matches the loaded table")
+
+def iter_records(file):
+    # one CSV record at a time, lines are joined while a quote is open
+    record = b''
+    for line in file:
+        record += line
+        if record.count(b'"') & 1:
+            continue
+        yield record
+        record = b''
+    if record:
+        yield record
+
+def record_npi(record):
+    # NPI is always the first column, quoted in the CMS files
+    end = record.find(b',')
+    return int(record[:end if end != -1 else len(record)].strip(b'"\r\n '))
+
+def record_hash(record):
+    digest = hashlib.blake2b(record.rstrip(b'\r\n'), digest_size=HASH_SIZE).digest()
+    return int.from_bytes(digest, 'little')
+
+def _record_batches(file, size=RECORD_BATCH):
+    batch = []
+    for record in iter_records(file):
+        batch.append(record)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _classify_numpy(npis, hashes, old):
+    # (positions of changed records, inserted, updated) for one batch against the old index
+    new_npis = np.frombuffer(npis, dtype='<u8')
+    if old is None or not len(old):
+        return np.arange(len(new_npis)), len(new_npis), 0
+    positions = np.searchsorted(old.npis, new_npis)
+    clipped = np.minimum(positions, len(old) - 1)
+    found = (positions < len(old)) & (old.npis[clipped] == new_npis)
+    updated = found & (old.hashes[clipped] != np.frombuffer(hashes, dtype='<u8'))
+    return np.flatnonzero(~found | updated), int((~found).sum()), int(updated.sum())
+
+def _classify_python(npis, hashes, old):
+    changed = []
+    inserted = updated = 0
+    for position, npi in enumerate(npis):
+        previous = old.lookup(npi) if old is not None else None
+        if previous is None:
+            inserted += 1
+        elif previous == hashes[position]:
+            continue
+        else:
+            updated += 1
+        changed.append(position)
+    return changed, inserted, updated
+
+def scan_snapshot(csv_path, old=None, upserts=None):
+    # one pass: hash every record and, with upserts open, write the ones old doesn't have as they are read
+    # a provider listed twice is looked up twice, the MERGE keeps one row of whatever goes out
+    started = time.perf_counter()
+    classify = _classify_numpy if np is not None else _classify_python
+    npis, hashes = array('Q'), array('Q')
+    inserted = updated = 0
+    with open(csv_path, 'rb', buffering=BLOCK_SIZE) as file:
+        header = file.readline()
+        if upserts is not None:
+            upserts.write(header)
+        for batch in _record_batches(file):
+            batch_npis = array('Q', map(record_npi, batch))
+            batch_hashes = array('Q', map(record_hash, batch))
+            if upserts is not None:
+                changed, batch_inserted, batch_updated = classify(batch_npis, batch_hashes, old)
+                for position in changed:
+                    record = batch[position]
+                    upserts.write(record if record.endswith(b'\n') else record + b'\n')
+                inserted += batch_inserted
+                updated += batch_updated
+            npis.extend(batch_npis)
+            hashes.extend(batch_hashes)
+    logging.info(f"Hashed {len(npis)} records of {csv_path} in {time.perf_counter() - started:.2f} seconds")
+    return npis, hashes, inserted, updated
+
+def _sorted_index(npis, hashes):
+    if np is not None:
+        new_npis = np.frombuffer(npis, dtype='<u8')
+        order = np.argsort(new_npis, kind='stable')
+        return new_npis[order], np.frombuffer(hashes, dtype='<u8')[order]
+    order = sorted(range(len(npis)), key=npis.__getitem__)
+    return array('Q', (npis[i] for i in order)), array('Q', (hashes[i] for i in order))
+
+def _deleted(sorted_npis, old):
+    # NPIs of the old index that the new file no longer has
+    if old is None or not len(old):
+        return []
+    if np is not None:
+        return old.npis[~np.isin(old.npis, sorted_npis)]
+    deleted = array('Q')
+    j = 0
+    for npi in old.npis:
+        while j < len(sorted_npis) and sorted_npis[j] < npi:
+            j += 1
+        if j == len(sorted_npis) or sorted_npis[j] != npi:
+            deleted.append(npi)
+    return deleted
+
+def build_index(csv_path, index_path):
+    # index of a file that was just loaded in full, the baseline for the next diff
+    started = time.perf_counter()
+    npis, hashes, _, _ = scan_snapshot(csv_path)
+    write_index(index_path, *_sorted_index(npis, hashes))
+    logging.info(f"Snapshot index {index_path} written for {len(npis)} rows "
+                 f"in {time.perf_counter() - started:.2f} seconds")
+    return len(npis)
+
+def diff_snapshot(csv_path, index_path, out_dir=None):
+    started = time.perf_counter()
+    out_dir = out_dir or os.path.dirname(os.path.abspath(csv_path))
+    base_name = os.path.splitext(os.path.basename(csv_path))[0]
+    upserts_path = os.path.join(out_dir, f"{base_name}_upserts.csv")
+    deletes_path = os.path.join(out_dir, f"{base_name}_deletes.csv")
+
+    if not os.path.exists(index_path):
+        raise Exception(f"No snapshot index at {index_path}, a full load writes the baseline")
+    old = SnapshotIndex(index_path)
+    try:
+        with open(upserts_path, 'wb', buffering=BLOCK_SIZE) as upserts:
+            npis, hashes, inserted, updated = scan_snapshot(csv_path, old, upserts)
+        sorted_npis, sorted_hashes = _sorted_index(npis, hashes)
+        deleted = _deleted(sorted_npis, old)
+    finally:
+        old.close()
+
+    with open(deletes_path, 'w') as file:
+        file.write(f'"{KEY_COLUMN}"\n')
+        file.writelines(f'"{int(npi)}"\n' for npi in deleted)
+
+    new_index_path = index_path + '.new'
+    write_index(new_index_path, sorted_npis, sorted_hashes)
+    logging.info(f"Diffed {len(npis)} rows in {time.perf_counter() - started:.2f} seconds: "
+                 f"{inserted} inserted, {updated} updated, {len(deleted)} deleted")
+    return SnapshotDiff(upserts_path, deletes_path, new_index_path, len(npis), inserted, updated, len(deleted))
+
+def _stage_file(cursor, file_path, table, stage, expected_rows):
+    cursor.execute(f"PUT file://{file_path} @{stage} AUTO_COMPRESS = TRUE OVERWRITE = TRUE")
+    staged_files = [result['target'] for result in result_rows(cursor, PUT_RESULT_COLUMNS)]
+    files_list = ", ".join(f"'{name}'" for name in staged_files)
+    cursor.execute(f"""
+        COPY INTO {table}
+        FROM @{stage}
+        FILES = ({files_list})
+        FILE_FORMAT = (TYPE = 'CSV' FIELD_OPTIONALLY_ENCLOSED_BY = '"' SKIP_HEADER = 1)
+    """)
+    check_copy(copy_summary(result_rows(cursor, COPY_RESULT_COLUMNS)), table,
+               expected_rows=expected_rows, expected_files=len(staged_files))
+    return staged_files
+
+def apply_diff(conn, diff, target, stage, key=KEY_COLUMN):
+    started = time.perf_counter()
+    upserts_table = f"{target}_upserts"
+    deletes_table = f"{target}_deletes"
+    inserted = updated = deleted = 0
+    staged_files = []
+    with conn.cursor() as cursor:
+        try:
+            cursor.execute(f"CREATE STAGE IF NOT EXISTS {stage}")
+            columns = table_columns(cursor, target)
+            key_column = next(column for column in columns if column.upper() == key.upper())
+            if diff.inserted or diff.updated:
+                cursor.execute(f"CREATE OR REPLACE TRANSIENT TABLE {upserts_table} LIKE {target}")
+                staged_files += _stage_file(cursor, diff.upserts_path, upserts_table, stage,
+                                            diff.inserted + diff.updated)
+            if diff.deleted:
+                cursor.execute(f"CREATE OR REPLACE TRANSIENT TABLE {deletes_table} ({key} NUMBER)")
+                staged_files += _stage_file(cursor, diff.deletes_path, deletes_table, stage, diff.deleted)
+
+            cursor.execute("BEGIN")
+            if diff.inserted or diff.updated:
+                cursor.execute(build_merge_sql(target, upserts_table, columns, key))
+                inserted, updated = cursor.fetchone()[:2]
+            if diff.deleted:
+                cursor.execute(f'DELETE FROM {target} t USING {deletes_table} d WHERE t."{key_column}" = d.{key}')
+                deleted = cursor.fetchone()[0]
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+        finally:
+            cursor.execute(f"DROP TABLE IF EXISTS {upserts_table}")
+            cursor.execute(f"DROP TABLE IF EXISTS {deletes_table}")
+        for name in staged_files:
+            cursor.execute(f"REMOVE @{stage}/{name}")
+    logging.info(f"Applied diff to {target}: {inserted} inserted, {updated} updated, {deleted} deleted "
+                 f"in {time.perf_counter() - started:.2f} seconds")
+    return inserted, updated, deleted
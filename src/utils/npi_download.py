@@ -0,0 +1,225 @@
+'''
+Download helpers shared by the NPI loaders.
+
+stream_download:
+    Writes the HTTP response body to a temp spill file in fixed size chunks
+    instead of holding response.content in memory. The handle it returns is
+    seekable, so zipfile.ZipFile can open it directly.
+    Peak memory is one chunk, no matter how big the monthly ZIP gets.
+
+range_download:
+    HEADs the URL and, when the server answers Accept-Ranges: bytes, fetches
+    N byte ranges concurrently into a preallocated spill file. A dropped
+    connection only re-fetches the missing tail of that one range.
+    Falls back to stream_download over a single connection otherwise.
+
+    With dest_path and a RunManifest the spill file is a named file and the
+    byte offset reached by every range is checkpointed, so a rerun after a
+    crash only fetches what is still missing.
+'''
+
+import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+
+CHUNK_SIZE = 8 * 1024 * 1024  # 8 MB
+PROGRESS_EVERY = 100 * 1024 * 1024  # log every 100 MB
+RANGE_CHUNK_SIZE = 1024 * 1024  # 1 MB writes per range
+MIN_RANGE_SIZE = 16 * 1024 * 1024  # not worth a connection below this
+DOWNLOAD_CONNECTIONS = 8
+RANGE_RETRIES = 3
+CHECKPOINT_EVERY = 64 * 1024 * 1024  # record range offsets every 64 MB
+
+def _mb(num_bytes):
+    return num_bytes / (1024 * 1024)
+
+def log_progress(done, total, started):
+    elapsed = max(time.perf_counter() - started, 1e-6)
+    rate = _mb(done) / elapsed
+    if total:
+        logging.info(f"Downloaded {_mb(done):.1f} / {_mb(total):.1f} MB "
+                     f"({done * 100 / total:.0f}%) at {rate:.1f} MB/s")
+    else:
+        logging.info(f"Downloaded {_mb(done):.1f} MB at {rate:.1f} MB/s")
+
+def _open_spill(dest_path, spill_dir, resume=False):
+    if dest_path:
+        return open(dest_path, 'r+b' if resume else 'w+b')
+    # TemporaryFile is removed by the OS as soon as the handle is closed
+    return tempfile.TemporaryFile(dir=spill_dir)
+
+def stream_download(response, chunk_size=CHUNK_SIZE, spill_dir=None, dest_path=None):
+    total = int(response.headers.get('Content-Length') or 0)
+    spill = _open_spill(dest_path, spill_dir)
+    started = time.perf_counter()
+    done = 0
+    next_report = PROGRESS_EVERY
+    try:
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            if not chunk:
+                continue
+            spill.write(chunk)
+            done += len(chunk)
+            if done >= next_report:
+                log_progress(done, total, started)
+                next_report += PROGRESS_EVERY
+        if total and done != total and not response.headers.get('Content-Encoding'):
+            raise IOError(f"Download truncated: got {done} of {total} bytes")
+        spill.flush()
+        spill.seek(0)
+    except Exception:
+        spill.close()
+        raise
+
+    log_progress(done, total, started)
+    logging.info(f"ZIP File downloaded in {time.perf_counter() - started:.2f} seconds")
+    return spill
+
+def probe(url):
+    response = requests.head(url, allow_redirects=True, timeout=(10, 60))
+    response.raise_for_status()
+    return response.headers
+
+def split_ranges(size, connections, min_range_size=MIN_RANGE_SIZE):
+    count = max(1, min(connections, -(-size // min_range_size)))
+    step = -(-size // count)
+    return [(start, min(start + step, size) - 1) for start in range(0, size, step)]
+
+def _fetch_range(url, spill, lock, stop, start, end, retries, position=None, checkpoint=None):
+    position = start if position is None else position
+    resumed_from = position
+    next_checkpoint = position + CHECKPOINT_EVERY
+    started = time.perf_counter()
+    for attempt in range(1, retries + 1):
+        try:
+            headers = {'Range': f'bytes={position}-{end}'}
+            with requests.get(url, headers=headers, stream=True, timeout=(10, 1000)) as response:
+                if response.status_code != 206:
+                    raise IOError(f"Expected 206 for bytes {position}-{end}, got {response.status_code}")
+                for chunk in response.iter_content(chunk_size=RANGE_CHUNK_SIZE):
+                    if stop.is_set():
+                        raise RuntimeError("Download cancelled")
+                    if not chunk:
+                        continue
+                    with lock:
+                        spill.seek(position)
+                        spill.write(chunk)
+                    position += len(chunk)
+                    if checkpoint and position >= next_checkpoint:
+                        checkpoint(start, end, position)
+                        next_checkpoint = position + CHECKPOINT_EVERY
+            if position != end + 1:
+                raise IOError(f"Connection dropped at byte {position}")
+            break
+        except RuntimeError:
+            raise
+        except Exception as e:
+            if attempt == retries:
+                raise
+            # only the bytes we are still missing get fetched again
+            logging.warning(f"Range {start}-{end} failed at byte {position} "
+                            f"(attempt {attempt}/{retries}): {e}")
+            time.sleep(2 ** attempt)
+
+    if checkpoint:
+        checkpoint(start, end, position)
+    elapsed = max(time.perf_counter() - started, 1e-6)
+    size = end + 1 - resumed_from
+    logging.info(f"Range {start}-{end}: {_mb(size):.1f} MB in {elapsed:.2f} seconds "
+                 f"({_mb(size) / elapsed:.1f} MB/s)")
+    return size
+
+def range_download(url, connections=DOWNLOAD_CONNECTIONS, spill_dir=None, retries=RANGE_RETRIES,
+                   dest_path=None, manifest=None):
+    state = manifest.stage('download') if manifest and dest_path else {}
+    if state.get('done') and state.get('path') == dest_path and os.path.exists(dest_path) \
+            and os.path.getsize(dest_path) == state.get('size'):
+        logging.info("Resuming: ZIP File already downloaded")
+        return open(dest_path, 'rb')
+
+    headers = probe(url)
+    size = int(headers.get('Content-Length') or 0)
+    etag = headers.get('ETag')
+    last_modified = headers.get('Last-Modified')
+    if connections <= 1 or headers.get('Accept-Ranges', '').lower() != 'bytes' or not size:
+        logging.info("Range requests not available, downloading over a single connection")
+        response = requests.get(url, stream=True, timeout=(10, 1000))
+        response.raise_for_status()
+        with response:
+            spill = stream_download(response, spill_dir=spill_dir, dest_path=dest_path)
+        if manifest and dest_path:
+            manifest.complete('download', url=url, path=dest_path, size=size or os.path.getsize(dest_path), etag=etag,
+                              last_modified=last_modified)
+        return spill
+
+    # only trust recorded offsets if the file on the server is provably the same one,
+    # a server without ETag or Last-Modified gets a fresh download
+    same_file = (etag or last_modified) is not None and state.get('etag') == etag \
+        and state.get('last_modified') == last_modified
+    resume = bool(state.get('ranges')) and same_file and state.get('size') == size \
+        and state.get('path') == dest_path and os.path.exists(dest_path)
+    if resume:
+        positions = dict(state['ranges'])
+        ranges = [tuple(int(n) for n in key.split('-')) for key in positions]
+        logging.info(f"Resuming download, {_mb(size - _remaining(positions)):.1f} MB already on disk")
+    else:
+        ranges = split_ranges(size, connections)
+        positions = {f"{start}-{end}": start for start, end in ranges}
+        if manifest and dest_path:
+            manifest.update('download', url=url, path=dest_path, size=size, etag=etag,
+                            last_modified=last_modified, ranges=dict(positions), done=False)
+
+    pending = [(start, end) for start, end in ranges if positions[f"{start}-{end}"] <= end]
+    logging.info(f"Downloading {_mb(size):.1f} MB over {len(pending)} connections")
+    spill = _open_spill(dest_path, spill_dir, resume=resume)
+    lock = threading.Lock()
+    stop = threading.Event()
+    started = time.perf_counter()
+
+    checkpoint = None
+    if manifest and dest_path:
+        def checkpoint(start, end, position):
+            # flush before recording, the offset must never run ahead of the data
+            with lock:
+                spill.flush()
+                positions[f"{start}-{end}"] = position
+                snapshot = dict(positions)
+            manifest.update('download', ranges=snapshot)
+
+    done = size - _remaining(positions)
+    try:
+        if not resume:
+            spill.truncate(size)  # preallocate so every range can write at its own offset
+        with ThreadPoolExecutor(max_workers=max(len(pending), 1)) as pool:
+            futures = [pool.submit(_fetch_range, url, spill, lock, stop, start, end, retries,
+                                   positions[f"{start}-{end}"], checkpoint)
+                       for start, end in pending]
+            try:
+                for future in as_completed(futures):
+                    done += future.result()
+                    log_progress(done, size, started)
+            except BaseException:
+                stop.set()
+                raise
+        spill.flush()
+        spill.seek(0)
+    except BaseException:
+        spill.close()
+        raise
+
+    if manifest and dest_path:
+        manifest.complete('download', url=url, path=dest_path, size=size, etag=etag)
+    logging.info(f"ZIP File downloaded in {time.perf_counter() - started:.2f} seconds")
+    return spill
+
+def _remaining(positions):
+    remaining = 0
+    for key, position in positions.items():
+        end = int(key.split('-')[1])
+        remaining += max(end + 1 - position, 0)
+    return remaining
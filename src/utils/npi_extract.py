@@ -0,0 +1,61 @@
+'''
+ZIP member extraction helpers shared by the NPI loaders.
+
+extract_member_to_file:
+    Streams one member through zip_ref.open() straight into the destination
+    file with large buffered writes, so the decompressed CSV (~10 GB for
+    npidata_pfile) never sits in memory.
+    Row count (quote-aware, see npi_rowcount) and sha256 are computed in the
+    same pass, so nothing has to read the file back afterwards. tee= gets
+    every block too (npi_lookup builds its index from them).
+'''
+
+import hashlib
+import logging
+import os
+import time
+from collections import namedtuple
+
+from npi_rowcount import RowCounter
+
+BLOCK_SIZE = 16 * 1024 * 1024  # 16 MB reads and writes
+
+ExtractedFile = namedtuple('ExtractedFile', ['path', 'row_count', 'sha256', 'size'])
+
+def extract_member_to_file(zip_ref, member, dest_path, block_size=BLOCK_SIZE, tee=None):
+    started = time.perf_counter()
+    digest = hashlib.sha256()
+    counter = RowCounter()
+
+    try:
+        with zip_ref.open(member) as src, open(dest_path, 'wb', buffering=block_size) as dst:
+            while True:
+                block = src.read(block_size)
+                if not block:
+                    break
+                dst.write(block)
+                digest.update(block)
+                counter.feed(block)
+                if tee is not None:
+                    tee.feed(block)
+    except Exception:
+        # don't leave a half written CSV lying around
+        if os.path.exists(dest_path):
+            os.remove(dest_path)
+        raise
+
+    size = counter.size
+    row_count = counter.data_rows()
+
+    elapsed = max(time.perf_counter() - started, 1e-6)
+    logging.info(f"Extracted {size / (1024 * 1024):.1f} MB to {dest_path} "
+                 f"in {elapsed:.2f} seconds ({size / (1024 * 1024) / elapsed:.1f} MB/s)")
+    return ExtractedFile(dest_path, row_count, digest.hexdigest(), size)
+
+def resume_extracted(manifest, name='extract'):
+    # the extracted CSV from an earlier run is reused if it is still on disk untouched
+    state = manifest.stage(name)
+    if state.get('done') and os.path.exists(state['path']) and os.path.getsize(state['path']) == state['size']:
+        logging.info("Resuming: DATA File already extracted")
+        return ExtractedFile(*(state[field] for field in ExtractedFile._fields))
+    return None
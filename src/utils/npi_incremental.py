@@ -0,0 +1,141 @@
+'''
+Weekly incremental NPPES files applied with MERGE.
+
+Besides the monthly full file (DDSMTH.ZIP), CMS publishes weekly
+incremental ZIPs named like
+    NPPES_Data_Dissemination_100724_101324_Weekly_V2.zip
+(MMDDYY start and end of the week). They only hold the providers that
+changed that week, so applying them with MERGE on NPI refreshes the table
+in minutes instead of a TRUNCATE and full reload.
+
+The last applied weekly file is kept in a small JSON state file. Only
+files whose end date is after it get applied, oldest first. With no state
+every listed weekly file is applied. The weeklies on the page are the ones
+since the current monthly file, and re-merging a week is harmless.
+'''
+
+import json
+import logging
+import os
+import re
+import time
+from collections import namedtuple
+from datetime import datetime
+
+from npi_staging import result_rows, copy_summary, check_copy, PUT_RESULT_COLUMNS, COPY_RESULT_COLUMNS
+
+WEEKLY_HREF = re.compile(r'NPPES_Data_Dissemination_(\d{6})_(\d{6})_Weekly(?:_V\d+)?\.zip$', re.IGNORECASE)
+KEY_COLUMN = 'NPI'
+# when a file lists an NPI more than once the most recently updated row wins
+ORDER_COLUMN = 'Last Update Date'
+
+WeeklyFile = namedtuple('WeeklyFile', ['url', 'name', 'start', 'end'])
+
+def find_weekly_files(soup, base_url):
+    weekly_files = {}
+    for anchor in soup.find_all('a', href=True):
+        name = anchor['href'].rsplit('/', 1)[-1]
+        match = WEEKLY_HREF.search(name)
+        if not match:
+            continue
+        start, end = (datetime.strptime(value, '%m%d%y').date() for value in match.groups())
+        url = base_url.rsplit('/', 1)[0] + '/' + anchor['href']
+        weekly_files[name] = WeeklyFile(url, name, start.isoformat(), end.isoformat())
+    return sorted(weekly_files.values(), key=lambda weekly: (weekly.start, weekly.end))
+
+def load_state(state_path):
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path, 'r') as file:
+        return json.load(file)
+
+def save_state(state_path, weekly):
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump({'last_applied': weekly.name, 'last_end': weekly.end,
+                   'applied_at': datetime.now().isoformat(timespec='seconds')}, file, indent=2)
+    os.replace(tmp_path, state_path)
+
+def pending_weekly_files(weekly_files, state):
+    last_end = state.get('last_end')
+    return [weekly for weekly in weekly_files if not last_end or weekly.end > last_end]
+
+def table_columns(cursor, table):
+    database, schema, name = table.split('.')
+    cursor.execute(f"""
+        SELECT column_name
+        FROM {database}.information_schema.columns
+        WHERE table_schema = %s AND table_name = %s
+        ORDER BY ordinal_position
+    """, (schema.upper(), name.upper()))
+    columns = [row[0] for row in cursor.fetchall()]
+    if not columns:
+        raise Exception(f"No columns found for {table}")
+    return columns
+
+def _normalized(name):
+    # "Last Update Date" and LAST_UPDATE_DATE are the same column
+    return re.sub(r'[^0-9A-Z]+', '_', name.strip('"').upper()).strip('_')
+
+def _duplicate_order(quoted, order_column=ORDER_COLUMN):
+    # newest update first, the row hash breaks ties so reruns always keep the same row
+    column = next((column for column in quoted if _normalized(column) == _normalized(order_column)), None)
+    if column is None:
+        return "HASH(*)"
+    # the CSVs carry MM/DD/YYYY, a typed DATE column comes back as YYYY-MM-DD
+    updated = (f"COALESCE(TRY_TO_DATE(TO_VARCHAR({column}), 'MM/DD/YYYY'), "
+               f"TRY_TO_DATE(TO_VARCHAR({column})))")
+    return f"{updated} DESC NULLS LAST, HASH(*)"
+
+def build_merge_sql(target, source, columns, key=KEY_COLUMN):
+    quoted = [f'"{column}"' for column in columns]
+    key_column = next(column for column in quoted if column.upper() == f'"{key.upper()}"')
+    updates = ",\n            ".join(f"t.{column} = s.{column}" for column in quoted if column != key_column)
+    # a week can list the same NPI twice, keep one row per NPI or MERGE fails as nondeterministic
+    return f"""
+        MERGE INTO {target} t
+        USING (
+            SELECT * FROM {source}
+            QUALIFY ROW_NUMBER() OVER (PARTITION BY {key_column} ORDER BY {_duplicate_order(quoted)}) = 1
+        ) s
+        ON t.{key_column} = s.{key_column}
+        WHEN MATCHED THEN UPDATE SET
+            {updates}
+        WHEN NOT MATCHED THEN INSERT ({", ".join(quoted)})
+            VALUES ({", ".join(f"s.{column}" for column in quoted)})
+    """
+
+def merge_weekly_file(conn, file_path, target, stage):
+    started = time.perf_counter()
+    staging_table = f"{target}_weekly"
+    with conn.cursor() as cursor:
+        try:
+            cursor.execute(f"CREATE STAGE IF NOT EXISTS {stage}")
+            cursor.execute(f"CREATE OR REPLACE TRANSIENT TABLE {staging_table} LIKE {target}")
+            cursor.execute(f"PUT file://{file_path} @{stage} OVERWRITE = TRUE")
+            staged_files = [result['target'] for result in result_rows(cursor, PUT_RESULT_COLUMNS)]
+            files_list = ", ".join(f"'{name}'" for name in staged_files)
+            cursor.execute(f"""
+                COPY INTO {staging_table}
+                FROM @{stage}
+                FILES = ({files_list})
+                FILE_FORMAT = (TYPE = 'CSV' FIELD_OPTIONALLY_ENCLOSED_BY = '"' SKIP_HEADER = 1)
+            """)
+            # a short staging table would otherwise merge silently
+            check_copy(copy_summary(result_rows(cursor, COPY_RESULT_COLUMNS)), staging_table,
+                       expected_files=len(staged_files))
+
+            cursor.execute("BEGIN")
+            cursor.execute(build_merge_sql(target, staging_table, table_columns(cursor, target)))
+            inserted, updated = cursor.fetchone()[:2]
+            cursor.execute("COMMIT")
+            logging.info(f"MERGE into {target}: {inserted} inserted, {updated} updated "
+                         f"in {time.perf_counter() - started:.2f} seconds")
+            for name in staged_files:
+                cursor.execute(f"REMOVE @{stage}/{name}")
+            return inserted, updated
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+        finally:
+            cursor.execute(f"DROP TABLE IF EXISTS {staging_table}")
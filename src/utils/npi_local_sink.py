@@ -0,0 +1,166 @@
+'''
+Local DuckDB / Parquet sink for the loaders (--sink duckdb / --sink parquet).
+
+Same download, extract, manifest and validation as the Snowflake loads,
+only the last step is different: the extracted member goes through
+typed_batches (npi_parquet, pyarrow's CSV reader, no Python per row) and
+the Arrow record batches are bulk loaded into
+
+duckdb:
+    a table in a local .duckdb file, one CREATE OR REPLACE TABLE ... AS
+    SELECT over the batch stream inside a transaction. Other readers
+    keep seeing the previous snapshot until the COMMIT, a failed load
+    rolls back to it.
+
+parquet:
+    a Parquet dataset directory per table, hive partitioned by practice
+    state (PROVIDER_BUSINESS_PRACTICE_LOCATION_ADDRESS_STATE_NAME=IL/...)
+    when the member has that column. It is written next to the live one
+    and renamed into place, the previous snapshot stays in <table>.previous.
+    The swap is two renames, not one, so for a moment between them <table>
+    does not exist and a reader that looks then has to retry or fall back to
+    <table>.previous. It never sees a half written dataset though.
+
+Column names are the CSV headers in Snowflake style (upper case, anything
+not a letter or digit becomes _), table names are the last part of the
+Snowflake table name, so queries carry over between the two. Types are
+the ones from npi_parquet: NPIs are integers, dates are dates, the rest
+stays text.
+
+Both need pyarrow, duckdb additionally needs the duckdb package. Neither
+touches Snowflake, so they also work as an offline stand-in for testing
+the pipeline.
+'''
+
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as pa_ds
+except ImportError:
+    pa = None
+
+from npi_parquet import read_header, typed_batches
+
+MB = 1024 * 1024
+LOCAL_SINKS = ['duckdb', 'parquet']
+PARTITION_COLUMN = 'Provider Business Practice Location Address State Name'
+ROWS_PER_FILE = 1000000
+ROWS_PER_GROUP = 250000
+PREVIOUS_SUFFIX = '.previous'
+# one writer per database file, the member loads run on threads and take turns
+_duckdb_lock = threading.Lock()
+
+def local_column_name(name):
+    return re.sub(r'[^0-9A-Za-z]+', '_', name).strip('_').upper()
+
+def local_table_name(table):
+    # PLAYGROUND_TEST.STAGE.npi_data -> npi_data
+    return table.rsplit('.', 1)[-1].lower()
+
+def _column_names(csv_path):
+    names = [local_column_name(column) for column in read_header(csv_path)]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise Exception(f"Columns of {csv_path} collide after renaming: {duplicates}")
+    return names
+
+def _counted(batches, counter):
+    for batch in batches:
+        counter[0] += batch.num_rows
+        yield batch
+
+def _check_rows(loaded, expected_rows, target):
+    if expected_rows is not None and loaded != expected_rows:
+        raise Exception(f"{target} got {loaded} rows but the CSV has {expected_rows}")
+
+def _batch_reader(csv_path, counter):
+    column_names = _column_names(csv_path)
+    batches = typed_batches(csv_path, column_names)
+    first = next(batches, None)
+    if first is None:
+        raise Exception(f"{csv_path} has no rows")
+    def all_batches():
+        yield first
+        yield from batches
+    return pa.RecordBatchReader.from_batches(first.schema, _counted(all_batches(), counter))
+
+def load_duckdb(csv_path, db_path, table, expected_rows=None):
+    if duckdb is None or pa is None:
+        raise ImportError("--sink duckdb needs the duckdb and pyarrow packages")
+    started = time.perf_counter()
+    name = local_table_name(table)
+    counter = [0]
+    with _duckdb_lock:
+        conn = duckdb.connect(db_path)
+        try:
+            conn.register('npi_batches', _batch_reader(csv_path, counter))
+            conn.execute("BEGIN")
+            try:
+                conn.execute(f'CREATE OR REPLACE TABLE "{name}" AS SELECT * FROM npi_batches')
+                _check_rows(counter[0], expected_rows, f"{db_path}:{name}")
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+    elapsed = max(time.perf_counter() - started, 1e-6)
+    logging.info(f"Loaded {counter[0]} rows into {name} in {db_path} in {elapsed:.2f} seconds "
+                 f"({counter[0] / elapsed:,.0f} rows/s)")
+    return counter[0]
+
+def load_parquet_dataset(csv_path, dataset_dir, table, expected_rows=None, partition_column=PARTITION_COLUMN):
+    if pa is None:
+        raise ImportError("--sink parquet needs the pyarrow package")
+    started = time.perf_counter()
+    name = local_table_name(table)
+    target = os.path.join(dataset_dir, name)
+    loading = target + '.loading'
+    shutil.rmtree(loading, ignore_errors=True)
+    counter = [0]
+    reader = _batch_reader(csv_path, counter)
+    partition = local_column_name(partition_column)
+    partitioning = None
+    if partition in reader.schema.names:
+        partitioning = pa_ds.partitioning(pa.schema([reader.schema.field(partition)]), flavor='hive')
+    try:
+        pa_ds.write_dataset(reader, loading, format='parquet', partitioning=partitioning,
+                            basename_template=f'{name}-{{i}}.parquet', max_rows_per_file=ROWS_PER_FILE,
+                            max_rows_per_group=ROWS_PER_GROUP, existing_data_behavior='error')
+        _check_rows(counter[0], expected_rows, loading)
+    except Exception:
+        shutil.rmtree(loading, ignore_errors=True)
+        raise
+
+    # not atomic, <table> is missing between the two renames (but never half written)
+    previous = target + PREVIOUS_SUFFIX
+    if os.path.exists(target):
+        shutil.rmtree(previous, ignore_errors=True)
+        os.replace(target, previous)
+    os.replace(loading, target)
+    elapsed = max(time.perf_counter() - started, 1e-6)
+    size = sum(os.path.getsize(os.path.join(root, file)) for root, _, files in os.walk(target) for file in files)
+    logging.info(f"Wrote {counter[0]} rows to {target} ({size / MB:.1f} MB of Parquet"
+                 f"{', partitioned by ' + partition if partitioning else ''}) in {elapsed:.2f} seconds "
+                 f"({counter[0] / elapsed:,.0f} rows/s)")
+    return counter[0]
+
+def load_local(sink, csv_path, path, table, expected_rows=None):
+    # path is the .duckdb file or the dataset directory
+    if sink == 'duckdb':
+        return load_duckdb(csv_path, path, table, expected_rows)
+    if sink == 'parquet':
+        os.makedirs(path, exist_ok=True)
+        return load_parquet_dataset(csv_path, path, table, expected_rows)
+    raise Exception(f"Unknown local sink {sink}, expected one of {LOCAL_SINKS}")
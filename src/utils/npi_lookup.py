@@ -0,0 +1,312 @@
+'''
+Memory-mapped NPI -> provider lookup index, built while the npidata file
+is extracted.
+
+Services that only need "who is this NPI" (name, primary taxonomy,
+practice address) used to query Snowflake for every lookup. The loaders
+can now write two files next to the extracted CSV (--lookup-index):
+
+    <base>.idx  NPILKP01 + count + size of the .rec file, then three
+                little-endian arrays, all sorted by NPI:
+                    npis     uint64[count]
+                    offsets  uint64[count]  into <base>.rec
+                    lengths  uint32[count]
+                20 bytes per provider, ~160 MB for 8M
+    <base>.rec  the packed records back to back, LOOKUP_FIELDS as UTF-8
+                joined by \\x1f, in file order
+
+LookupIndexWriter is fed the raw blocks of the member as
+extract_member_to_file writes them (tee=) and pipes them into pyarrow's
+CSV reader on a thread, so the index costs no extra pass over the file.
+Only the LOOKUP_COLUMNS are converted, the records are packed with
+pyarrow compute per batch (no Python per row) and the sort by NPI
+happens once at the end. Columns missing from the file (a projected
+extraction) come back empty. Building needs pyarrow.
+
+NpiLookup memory maps both files and never reads them into Python
+objects, so a lookup is a binary search over the mapped NPI array
+(numpy searchsorted when numpy is installed, bisect otherwise) plus one
+slice of the record file. Only the pages a lookup touches become
+resident. get_many() resolves a whole batch of NPIs in one vectorised
+search.
+
+The .rec file is replaced before the .idx file and the .idx header
+records the size of the .rec it belongs to, so a reader that opens the
+pair halfway through a rebuild gets an error instead of wrong records.
+'''
+
+import bisect
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = None
+
+MB = 1024 * 1024
+READ_BLOCK_SIZE = 16 * MB
+LOOKUP_MAGIC = b'NPILKP01'
+LOOKUP_HEADER = struct.Struct('<8sQQ')
+FIELD_SEPARATOR = '\x1f'
+TAXONOMY_SLOTS = 15
+
+# record field -> npidata CSV column, primary_taxonomy is picked from the taxonomy slots
+LOOKUP_FIELDS = {
+    'entity_type': 'Entity Type Code',
+    'organization_name': 'Provider Organization Name (Legal Business Name)',
+    'last_name': 'Provider Last Name (Legal Name)',
+    'first_name': 'Provider First Name',
+    'middle_name': 'Provider Middle Name',
+    'name_prefix': 'Provider Name Prefix Text',
+    'name_suffix': 'Provider Name Suffix Text',
+    'credential': 'Provider Credential Text',
+    'primary_taxonomy': None,
+    'address_line_1': 'Provider First Line Business Practice Location Address',
+    'address_line_2': 'Provider Second Line Business Practice Location Address',
+    'city': 'Provider Business Practice Location Address City Name',
+    'state': 'Provider Business Practice Location Address State Name',
+    'postal_code': 'Provider Business Practice Location Address Postal Code',
+    'country': 'Provider Business Practice Location Address Country Code (If outside U.S.)',
+    'phone': 'Provider Business Practice Location Address Telephone Number',
+}
+TAXONOMY_CODES = [f'Healthcare Provider Taxonomy Code_{slot}' for slot in range(1, TAXONOMY_SLOTS + 1)]
+TAXONOMY_SWITCHES = [f'Healthcare Provider Primary Taxonomy Switch_{slot}' for slot in range(1, TAXONOMY_SLOTS + 1)]
+LOOKUP_COLUMNS = ['NPI'] + [column for column in LOOKUP_FIELDS.values() if column] + TAXONOMY_CODES + TAXONOMY_SWITCHES
+
+def index_paths(base_path):
+    return base_path + '.idx', base_path + '.rec'
+
+def _primary_taxonomy(batch):
+    # the slot flagged Y, the first slot when none is
+    primary = batch.column('Healthcare Provider Taxonomy Code_1')
+    for code, switch in reversed(list(zip(TAXONOMY_CODES, TAXONOMY_SWITCHES))):
+        flagged = pc.fill_null(pc.equal(batch.column(switch), 'Y'), False)
+        primary = pc.if_else(flagged, batch.column(code), primary)
+    return primary
+
+def _pack_batch(batch):
+    fields = [_primary_taxonomy(batch) if column is None else batch.column(column)
+              for column in LOOKUP_FIELDS.values()]
+    records = pc.binary_join_element_wise(*[pc.fill_null(field, '') for field in fields], FIELD_SEPARATOR)
+    # a string array's data buffer already is the records back to back, offsets says where each starts
+    offsets = pa.Array.from_buffers(pa.int32(), len(records) + 1, [None, records.buffers()[1]],
+                                    offset=records.offset)
+    start, end = offsets[0].as_py(), offsets[-1].as_py()
+    data = records.buffers()[2]
+    packed = memoryview(data)[start:end] if data is not None else memoryview(b'')
+    return packed, pc.subtract(offsets.slice(0, len(records)), start), pc.binary_length(records)
+
+def build_lookup_index(source, base_path):
+    # source is a CSV path or a binary file object positioned at the header
+    if pa is None:
+        raise ImportError("pyarrow is not installed, it is needed to build the lookup index")
+    started = time.perf_counter()
+    index_path, records_path = index_paths(base_path)
+    reader = pa_csv.open_csv(
+        source,
+        read_options=pa_csv.ReadOptions(block_size=READ_BLOCK_SIZE),
+        parse_options=pa_csv.ParseOptions(newlines_in_values=True),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=LOOKUP_COLUMNS,
+            include_missing_columns=True,
+            column_types={column: pa.int64() if column == 'NPI' else pa.string() for column in LOOKUP_COLUMNS},
+            null_values=[''],
+            strings_can_be_null=True,
+        ),
+    )
+
+    npis, offsets, lengths = [], [], []
+    written = 0
+    with open(records_path + '.tmp', 'wb') as records_file:
+        for batch in reader:
+            if batch.column('NPI').null_count:
+                raise Exception(f"{batch.column('NPI').null_count} rows without an NPI")
+            packed, batch_offsets, batch_lengths = _pack_batch(batch)
+            records_file.write(packed)
+            npis.append(batch.column('NPI'))
+            offsets.append(pc.add(pc.cast(batch_offsets, pa.uint64()), pa.scalar(written, pa.uint64())))
+            lengths.append(pc.cast(batch_lengths, pa.uint32()))
+            written += len(packed)
+
+    npis = pa.chunked_array(npis, pa.int64()).combine_chunks()
+    order = pc.sort_indices(npis)
+    columns = [pc.cast(npis, pa.uint64()), pa.chunked_array(offsets, pa.uint64()).combine_chunks(),
+               pa.chunked_array(lengths, pa.uint32()).combine_chunks()]
+    count = len(npis)
+    with open(index_path + '.tmp', 'wb') as index_file:
+        index_file.write(LOOKUP_HEADER.pack(LOOKUP_MAGIC, count, written))
+        for column in columns:
+            column = pc.take(column, order)
+            width = column.type.bit_width // 8
+            if count:
+                index_file.write(memoryview(column.buffers()[1])[column.offset * width:(column.offset + count) * width])
+
+    # records first, the header check in NpiLookup catches a reader that opens the pair in between
+    os.replace(records_path + '.tmp', records_path)
+    os.replace(index_path + '.tmp', index_path)
+    logging.info(f"Lookup index {index_path}: {count} providers, {written / MB:.1f} MB of records "
+                 f"in {time.perf_counter() - started:.2f} seconds")
+    return count
+
+class LookupIndexWriter:
+    # feed() the raw member blocks as they are extracted, close() when the member is done
+    def __init__(self, base_path):
+        if pa is None:
+            raise ImportError("pyarrow is not installed, it is needed to build the lookup index")
+        self.base_path = base_path
+        self.pipe = None
+        self.thread = None
+        self.error = None
+        self.count = None
+
+    def _build(self, read_fd):
+        with os.fdopen(read_fd, 'rb') as source:
+            try:
+                self.count = build_lookup_index(source, self.base_path)
+            except BaseException as e:
+                self.error = e
+                # keep draining, a full pipe would block the extraction forever
+                while source.read(READ_BLOCK_SIZE):
+                    pass
+
+    def feed(self, block):
+        if self.pipe is None:
+            read_fd, write_fd = os.pipe()
+            self.pipe = os.fdopen(write_fd, 'wb')
+            self.thread = threading.Thread(target=self._build, args=(read_fd,), name='lookup-index', daemon=True)
+            self.thread.start()
+        self.pipe.write(block)
+
+    def _finish(self):
+        self.pipe.close()
+        self.thread.join()
+        self.pipe = None
+
+    def close(self, csv_path=None):
+        if self.pipe is None:
+            # nothing streamed through (cache hit or projected extraction), index the extracted file instead
+            return build_lookup_index(csv_path, self.base_path)
+        self._finish()
+        if self.error:
+            self._remove_partial()
+            raise Exception(f"Building the lookup index failed: {self.error}") from self.error
+        return self.count
+
+    def abort(self):
+        if self.pipe is not None:
+            self._finish()
+        self._remove_partial()
+
+    def _remove_partial(self):
+        for path in index_paths(self.base_path):
+            if os.path.exists(path + '.tmp'):
+                os.remove(path + '.tmp')
+
+class NpiLookup:
+    def __init__(self, base_path):
+        index_path, records_path = index_paths(base_path)
+        self.files = [open(index_path, 'rb'), open(records_path, 'rb')]
+        self.index = mmap.mmap(self.files[0].fileno(), 0, access=mmap.ACCESS_READ)
+        # an empty .rec can't be mapped
+        self.records = mmap.mmap(self.files[1].fileno(), 0, access=mmap.ACCESS_READ) \
+            if os.fstat(self.files[1].fileno()).st_size else b''
+        magic, self.count, records_size = LOOKUP_HEADER.unpack_from(self.index, 0)
+        if magic != LOOKUP_MAGIC or records_size != len(self.records):
+            self.close()
+            raise Exception(f"{index_path} and {records_path} are not a matching NPI lookup index")
+        offsets_at = LOOKUP_HEADER.size + 8 * self.count
+        lengths_at = offsets_at + 8 * self.count
+        if np is not None:
+            self.npis = np.frombuffer(self.index, dtype='<u8', count=self.count, offset=LOOKUP_HEADER.size)
+            self.offsets = np.frombuffer(self.index, dtype='<u8', count=self.count, offset=offsets_at)
+            self.lengths = np.frombuffer(self.index, dtype='<u4', count=self.count, offset=lengths_at)
+        else:
+            view = memoryview(self.index)
+            self.npis = view[LOOKUP_HEADER.size:offsets_at].cast('Q')
+            self.offsets = view[offsets_at:lengths_at].cast('Q')
+            self.lengths = view[lengths_at:lengths_at + 4 * self.count].cast('I')
+            view.release()
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __contains__(self, npi):
+        return self._position(int(npi)) is not None
+
+    def _position(self, npi):
+        if np is not None:
+            # np.uint64, a Python int would compare the whole array as float64
+            position = int(np.searchsorted(self.npis, np.uint64(npi)))
+        else:
+            position = bisect.bisect_left(self.npis, npi)
+        if position < self.count and self.npis[position] == npi:
+            return position
+        return None
+
+    def _record(self, npi, position):
+        offset = int(self.offsets[position])
+        values = self.records[offset:offset + int(self.lengths[position])].decode('utf-8').split(FIELD_SEPARATOR)
+        record = dict(zip(LOOKUP_FIELDS, values), npi=npi)
+        if record['entity_type'] == '2':
+            record['name'] = record['organization_name']
+        else:
+            record['name'] = ' '.join(part for part in (record['name_prefix'], record['first_name'], record['middle_name'],
+                                                        record['last_name'], record['name_suffix']) if part)
+        return record
+
+    def get(self, npi):
+        # dict of LOOKUP_FIELDS plus npi and name, None if the NPI isn't in the file
+        npi = int(npi)
+        position = self._position(npi)
+        return self._record(npi, position) if position is not None else None
+
+    def get_many(self, npis):
+        # one result per NPI, in the order given
+        npis = [int(npi) for npi in npis]
+        if np is None or not self.count:
+            return [self.get(npi) for npi in npis]
+        wanted = np.asarray(npis, dtype='<u8')
+        positions = np.searchsorted(self.npis, wanted)
+        clipped = np.minimum(positions, self.count - 1)
+        found = (positions < self.count) & (self.npis[clipped] == wanted)
+        return [self._record(npi, int(position)) if hit else None
+                for npi, position, hit in zip(npis, clipped, found)]
+
+    def close(self):
+        # views have to go before the mmap can close
+        for name in ('npis', 'offsets', 'lengths'):
+            view = self.__dict__.pop(name, None)
+            if isinstance(view, memoryview):
+                view.release()
+            del view
+        for mapped in (self.index, self.records):
+            if isinstance(mapped, mmap.mmap):
+                mapped.close()
+        for file in self.files:
+            file.close()
+
+if __name__ == "__main__":
+    # python npi_lookup.py NPI_lookup 1234567893 ...
+    with NpiLookup(sys.argv[1]) as lookup:
+        for result in lookup.get_many(sys.argv[2:]):
+            print(json.dumps(result))
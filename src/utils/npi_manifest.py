@@ -0,0 +1,72 @@
+'''
+Run manifest for resuming the loaders after a failure.
+
+Every stage that finishes (download, extract, put / s3_upload, copy) is
+written to a small JSON file next to the data. A rerun for the same
+run_key (the download URL, plus the S3 key for the S3 scripts) picks up
+from the last durable point instead of downloading, unzipping and
+uploading everything again. A different run_key means a new monthly file,
+so the old manifest is thrown away.
+
+Writes go to a temp file and are swapped in with os.replace, so a crash
+mid-write never leaves a half written manifest behind.
+'''
+
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+
+class RunManifest:
+    def __init__(self, path, run_key):
+        self.path = path
+        self.run_key = run_key
+        self.lock = threading.Lock()
+        self.data = {'run_key': run_key, 'stages': {}}
+        if os.path.exists(path):
+            with open(path, 'r') as file:
+                existing = json.load(file)
+            if existing.get('run_key') == run_key:
+                self.data = existing
+                done = [name for name, stage in existing['stages'].items() if stage.get('done')]
+                logging.info(f"Resuming run from manifest, completed stages: {done or 'none'}")
+            else:
+                logging.info("Manifest is for a different file, starting a fresh run")
+
+    def stage(self, name):
+        with self.lock:
+            return dict(self.data['stages'].get(name, {}))
+
+    def is_done(self, name):
+        return self.stage(name).get('done', False)
+
+    def update(self, name, **fields):
+        with self.lock:
+            stage = self.data['stages'].setdefault(name, {})
+            stage.update(fields)
+            stage['updated_at'] = datetime.now().isoformat(timespec='seconds')
+            self._save()
+
+    def complete(self, name, **fields):
+        self.update(name, done=True, **fields)
+        logging.info(f"Checkpoint: {name} complete")
+
+    def reset(self, name):
+        with self.lock:
+            self.data['stages'].pop(name, None)
+            self._save()
+
+    def clear(self):
+        with self.lock:
+            self.data = {'run_key': self.run_key, 'stages': {}}
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def _save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(self.data, file, indent=2)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.path)
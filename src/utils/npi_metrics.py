@@ -0,0 +1,178 @@
+'''
+Per-stage run metrics for the NPI loaders.
+
+Every stage of a run (page fetch, link discovery, download, extract,
+connect, validate, PUT, COPY, post count ...) is wrapped in
+
+    with run_metrics.stage('download') as stage:
+        ...
+        stage.bytes_in = size
+
+which records wall time, CPU time (this process plus finished child
+processes, so the compression pool is included), bytes in and out, rows,
+throughput and the peak RSS seen so far. At the end of the run main()
+writes:
+    - a JSON run report with every stage in the order it ran
+    - optionally a Prometheus textfile (for node_exporter's textfile
+      collector), one gauge per metric labelled by stage, so monthly runs
+      can be tracked and alerted on
+
+Stages that run more than once in a run (one per weekly file, one per
+table) are summed per stage name in the textfile. CPU time is process
+wide, so stages running side by side on threads share it.
+'''
+
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+MB = 1024 * 1024
+METRIC_PREFIX = 'npi_loader'
+
+def _cpu_seconds():
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+def peak_rss_bytes():
+    if resource is None:
+        return None
+    # kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+class StageMetrics:
+    def __init__(self, name):
+        self.name = name
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.rows = 0
+        self.status = 'running'
+        self.error = None
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.peak_rss_bytes = None
+
+    def throughput(self):
+        # bytes per second of whatever the stage consumed, or produced if it had no input
+        size = self.bytes_in or self.bytes_out
+        return size / self.wall_seconds if size and self.wall_seconds else None
+
+    def as_dict(self):
+        return {'stage': self.name, 'status': self.status, 'error': self.error,
+                'wall_seconds': round(self.wall_seconds, 3), 'cpu_seconds': round(self.cpu_seconds, 3),
+                'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out, 'rows': self.rows,
+                'throughput_bytes_per_second': self.throughput(), 'peak_rss_bytes': self.peak_rss_bytes}
+
+class RunMetrics:
+    def __init__(self, job='npi_loader'):
+        self.job = job
+        self.started_at = datetime.now()
+        self.started = time.perf_counter()
+        self.stages = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        stage = StageMetrics(name)
+        with self.lock:
+            self.stages.append(stage)
+        started = time.perf_counter()
+        cpu_started = _cpu_seconds()
+        try:
+            yield stage
+            stage.status = 'ok'
+        except BaseException as e:
+            stage.status = 'failed'
+            stage.error = str(e)
+            raise
+        finally:
+            stage.wall_seconds = time.perf_counter() - started
+            stage.cpu_seconds = _cpu_seconds() - cpu_started
+            stage.peak_rss_bytes = peak_rss_bytes()
+            throughput = stage.throughput()
+            logging.info(f"Stage {name} {stage.status} in {stage.wall_seconds:.2f} seconds "
+                         f"(cpu {stage.cpu_seconds:.2f}s" +
+                         (f", {throughput / MB:.1f} MB/s" if throughput else "") +
+                         (f", {stage.rows} rows" if stage.rows else "") + ")")
+
+    def reset(self):
+        # watch mode writes a report per load, each one starts fresh
+        self.started_at = datetime.now()
+        self.started = time.perf_counter()
+        with self.lock:
+            self.stages = []
+
+    def totals(self):
+        # one entry per stage name, repeated stages summed
+        totals = {}
+        for stage in self.stages:
+            total = totals.setdefault(stage.name, {'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'bytes_in': 0,
+                                                   'bytes_out': 0, 'rows': 0, 'peak_rss_bytes': 0, 'success': 1})
+            for key in ('wall_seconds', 'cpu_seconds', 'bytes_in', 'bytes_out', 'rows'):
+                total[key] += getattr(stage, key)
+            total['peak_rss_bytes'] = max(total['peak_rss_bytes'], stage.peak_rss_bytes or 0)
+            total['success'] &= int(stage.status == 'ok')
+        for total in totals.values():
+            size = total['bytes_in'] or total['bytes_out']
+            total['throughput_bytes_per_second'] = size / total['wall_seconds'] if size and total['wall_seconds'] else 0
+        return totals
+
+    def report(self, success):
+        return {'job': self.job, 'started_at': self.started_at.isoformat(timespec='seconds'),
+                'duration_seconds': round(time.perf_counter() - self.started, 3), 'success': success,
+                'peak_rss_bytes': peak_rss_bytes(), 'stages': [stage.as_dict() for stage in self.stages]}
+
+    def write_json(self, path, success):
+        _write_atomic(path, json.dumps(self.report(success), indent=2))
+        logging.info(f"Run report written to {path}")
+
+    def write_prometheus(self, path, success):
+        # not "job", the scraper sets that label itself
+        loader = _label(self.job)
+        lines = []
+
+        def gauge(name, help_text, samples):
+            lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} gauge")
+            lines.extend(f"{METRIC_PREFIX}_{name}{{{labels}}} {value}" for labels, value in samples)
+
+        totals = self.totals()
+        for key, help_text in (('wall_seconds', 'Wall time of the stage in the last run'),
+                               ('cpu_seconds', 'CPU time spent during the stage in the last run'),
+                               ('bytes_in', 'Bytes read by the stage in the last run'),
+                               ('bytes_out', 'Bytes written by the stage in the last run'),
+                               ('rows', 'Rows handled by the stage in the last run'),
+                               ('throughput_bytes_per_second', 'Throughput of the stage in the last run'),
+                               ('peak_rss_bytes', 'Peak resident memory at the end of the stage'),
+                               ('success', '1 if every run of the stage succeeded')):
+            gauge(f"stage_{key}", help_text,
+                  [(f'loader="{loader}",stage="{_label(name)}"', total[key]) for name, total in totals.items()])
+        gauge('run_duration_seconds', 'Wall time of the last run',
+              [(f'loader="{loader}"', round(time.perf_counter() - self.started, 3))])
+        gauge('run_success', '1 if the last run succeeded', [(f'loader="{loader}"', int(success))])
+        gauge('last_run_timestamp_seconds', 'Unix time the last run finished', [(f'loader="{loader}"', int(time.time()))])
+        _write_atomic(path, '\n'.join(lines) + '\n')
+        logging.info(f"Prometheus metrics written to {path}")
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _write_atomic(path, text):
+    # the textfile collector may read at any moment, never let it see half a file
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        file.write(text)
+    os.replace(tmp_path, path)
+
+# one run per process, the scripts import this and set job in main()
+run_metrics = RunMetrics()
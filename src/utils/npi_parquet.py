@@ -0,0 +1,131 @@
+'''
+Typed Parquet staging for the Snowflake loaders.
+
+The npidata CSV has ~330 columns, almost all of them empty and every field
+quoted, so COPY INTO ... TYPE = 'CSV' spends most of its time parsing
+quotes around nothing. csv_to_parquet streams the extracted CSV through
+pyarrow's CSV reader (record batches, no Python per row) and writes it
+back out as row-group-sized Parquet files:
+    - empty fields become nulls
+    - NPI columns and Entity Type Code are integers, the MM/DD/YYYY date
+      columns are dates, everything else stays a string (ZIP codes,
+      license numbers and taxonomy codes keep their leading zeros)
+    - columns can be renamed to the target table's column names, so COPY
+      INTO can use MATCH_BY_COLUMN_NAME
+
+pyarrow is optional, the loaders only need it with --staging parquet.
+'''
+
+import csv
+import logging
+import os
+import time
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+MB = 1024 * 1024
+READ_BLOCK_SIZE = 64 * MB
+ROWS_PER_FILE = 250000  # one row group per file
+PARQUET_COMPRESSION = 'snappy'
+DATE_FORMAT = '%m/%d/%Y'
+
+# columns that are not plain strings in the NPPES files, keyed by CSV header name
+NPPES_TYPES = {
+    'NPI': 'int64',
+    'Replacement NPI': 'int64',
+    'Entity Type Code': 'int8',
+    'Provider Enumeration Date': 'date',
+    'Last Update Date': 'date',
+    'NPI Deactivation Date': 'date',
+    'NPI Reactivation Date': 'date',
+    'Certification Date': 'date',
+}
+
+PARQUET_FILE_FORMAT = "FILE_FORMAT = (TYPE = 'PARQUET') MATCH_BY_COLUMN_NAME = CASE_INSENSITIVE"
+
+def read_header(file_path):
+    with open(file_path, 'r', newline='', encoding='utf-8') as file:
+        return next(csv.reader(file))
+
+def _read_type(kind):
+    # dates are read as timestamps so timestamp_parsers applies, then cast per batch
+    return {'int64': pa.int64(), 'int8': pa.int8(), 'date': pa.timestamp('s')}.get(kind, pa.string())
+
+def _output_type(kind):
+    return {'int64': pa.int64(), 'int8': pa.int8(), 'date': pa.date32()}.get(kind, pa.string())
+
+def nppes_schema(header, column_names=None):
+    column_names = column_names or header
+    if len(column_names) != len(header):
+        raise Exception(f"CSV has {len(header)} columns but {len(column_names)} column names were given")
+    return pa.schema([(name, _output_type(NPPES_TYPES.get(column)))
+                      for column, name in zip(header, column_names)])
+
+def _write_file(batches, out_path):
+    table = pa.Table.from_batches(batches)
+    pq.write_table(table, out_path, row_group_size=ROWS_PER_FILE, compression=PARQUET_COMPRESSION)
+    return table.num_rows
+
+def typed_batches(file_path, column_names=None):
+    # the CSV as typed record batches with nppes_schema, also used by the local sink (npi_local_sink)
+    header = read_header(file_path)
+    schema = nppes_schema(header, column_names)
+    kinds = [NPPES_TYPES.get(column) for column in header]
+    reader = pa_csv.open_csv(
+        file_path,
+        read_options=pa_csv.ReadOptions(block_size=READ_BLOCK_SIZE),
+        parse_options=pa_csv.ParseOptions(newlines_in_values=True),
+        convert_options=pa_csv.ConvertOptions(
+            column_types={column: _read_type(kind) for column, kind in zip(header, kinds)},
+            timestamp_parsers=[DATE_FORMAT],
+            null_values=[''],
+            strings_can_be_null=True,
+        ),
+    )
+    for batch in reader:
+        arrays = [pc.cast(column, pa.date32()) if kind == 'date' else column
+                  for column, kind in zip(batch.columns, kinds)]
+        yield pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+def csv_to_parquet(file_path, out_dir, column_names=None, rows_per_file=ROWS_PER_FILE):
+    if pa is None:
+        raise ImportError("pyarrow is not installed, use --staging csv")
+
+    started = time.perf_counter()
+    os.makedirs(out_dir, exist_ok=True)
+    base_name = os.path.splitext(os.path.basename(file_path))[0]
+    parquet_paths = []
+    pending = []
+    pending_rows = 0
+    row_count = 0
+
+    def flush():
+        out_path = os.path.join(out_dir, f"{base_name}_{len(parquet_paths):04d}.parquet")
+        rows = _write_file(pending, out_path)
+        parquet_paths.append(out_path)
+        return rows
+
+    for batch in typed_batches(file_path, column_names):
+        while batch.num_rows:
+            take = min(rows_per_file - pending_rows, batch.num_rows)
+            pending.append(batch.slice(0, take))
+            pending_rows += take
+            batch = batch.slice(take)
+            if pending_rows >= rows_per_file:
+                row_count += flush()
+                pending = []
+                pending_rows = 0
+    if pending_rows:
+        row_count += flush()
+
+    raw_bytes = os.path.getsize(file_path)
+    parquet_bytes = sum(os.path.getsize(path) for path in parquet_paths)
+    logging.info(f"Converted {raw_bytes / MB:.1f} MB of CSV to {parquet_bytes / MB:.1f} MB of Parquet "
+                 f"({len(parquet_paths)} files, {row_count} rows) in {time.perf_counter() - started:.2f} seconds")
+    return parquet_paths, row_count
@@ -0,0 +1,247 @@
+'''
+Pipelined extract -> compress -> PUT -> COPY for one ZIP member.
+
+The sequential loaders wait for the whole extract before PUT starts and the
+whole PUT before COPY starts. Here every stage runs on its own thread and
+hands chunks to the next one through bounded queues:
+
+    extract:  reads the member through zip_ref.open(), cuts it into ~100 MB
+              chunks on record boundaries (quote-aware) and gzips each
+              chunk to disk as it streams, header repeated in every chunk
+    put:      PUTs each finished chunk to the stage and deletes it locally
+    copy:     starts COPY INTO for each staged chunk with execute_async and
+              polls the query status, a few COPYs in flight at a time
+
+So chunk k+1 is being decompressed and compressed while chunk k is PUT
+and chunk k-1 is COPYed, and wall-clock time approaches the slowest stage
+rather than the sum of all three. QUEUE_DEPTH caps how many finished
+chunks can pile up on disk between stages.
+
+Each async COPY auto-commits, so load into an empty shadow table and swap
+it in afterwards (see --strategy swap in the failover loaders).
+
+Chunks are written to a fresh directory under chunk_dir that is removed
+when the load ends, and every chunk the pipeline PUT is REMOVEd from the
+stage again, whether the load succeeded or not. A rerun starts over from
+the ZIP member, so nothing of a failed run is worth keeping.
+'''
+
+import gzip
+import logging
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+from npi_rowcount import RowCounter
+from npi_staging import result_rows, copy_summary, check_copy, PUT_RESULT_COLUMNS, COPY_RESULT_COLUMNS
+
+MB = 1024 * 1024
+BLOCK_SIZE = 16 * MB
+PIPELINE_CHUNK_SIZE = 100 * MB
+QUEUE_DEPTH = 2
+COPY_IN_FLIGHT = 4
+POLL_INTERVAL = 2  # seconds between async COPY status checks
+GZIP_LEVEL = 3
+FILE_FORMAT = "(TYPE = 'CSV' FIELD_OPTIONALLY_ENCLOSED_BY = '\"' SKIP_HEADER = 1)"
+
+PipelineResult = namedtuple('PipelineResult', ['row_count', 'rows_loaded', 'chunks', 'seconds'])
+
+def _put(q, item, stop):
+    # blocking put that gives up once another stage has failed
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _get(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=1)
+        except queue.Empty:
+            continue
+    return None
+
+def _record_boundary(block, in_quotes):
+    # index just past the first newline outside quotes, -1 if the block has none
+    i = 0
+    while True:
+        newline = block.find(b'\n', i)
+        if newline == -1:
+            return -1, in_quotes ^ (block.count(b'"', i) & 1)
+        in_quotes ^= block.count(b'"', i, newline) & 1
+        i = newline + 1
+        if not in_quotes:
+            return i, 0
+
+def _extract_stage(zip_ref, member, chunk_dir, chunk_size, chunks, stop, counter):
+    base_name = os.path.splitext(os.path.basename(member if isinstance(member, str) else member.filename))[0]
+    index = 0
+    out = None
+    out_path = None
+    written = 0
+    in_quotes = 0
+
+    def close_chunk():
+        out.close()
+        return _put(chunks, out_path, stop)
+
+    with zip_ref.open(member) as src:
+        block = src.read(BLOCK_SIZE)
+        counter.feed(block)
+        header_end = block.find(b'\n') + 1
+        if not header_end:
+            raise Exception(f"No header line found in {base_name}")
+        header = block[:header_end]
+        block = block[header_end:]
+
+        while not stop.is_set():
+            if not block:
+                block = src.read(BLOCK_SIZE)
+                if not block:
+                    break
+                counter.feed(block)
+
+            if out is not None and written >= chunk_size:
+                boundary, state = _record_boundary(block, in_quotes)
+                if boundary == -1:
+                    out.write(block)
+                    written += len(block)
+                    in_quotes = state
+                    block = b''
+                    continue
+                out.write(block[:boundary])
+                if not close_chunk():
+                    return
+                out = None
+                in_quotes = 0
+                block = block[boundary:]
+                continue
+
+            if out is None:
+                out_path = os.path.join(chunk_dir, f"{base_name}_{index:04d}.csv.gz")
+                out = gzip.open(out_path, 'wb', compresslevel=GZIP_LEVEL)
+                out.write(header)
+                index += 1
+                written = 0
+            out.write(block)
+            written += len(block)
+            in_quotes ^= block.count(b'"') & 1
+            block = b''
+
+    if out is not None:
+        close_chunk()
+
+def _put_stage(conn, stage, chunks, staged, stop, staged_names):
+    with conn.cursor() as cursor:
+        while True:
+            path = _get(chunks, stop)
+            if path is None:
+                break
+            cursor.execute(f"PUT file://{path.replace(os.sep, '/')} @{stage} "
+                           f"AUTO_COMPRESS = FALSE SOURCE_COMPRESSION = GZIP OVERWRITE = TRUE")
+            name = result_rows(cursor, PUT_RESULT_COLUMNS)[0]['target']
+            staged_names.append(name)
+            os.remove(path)
+            logging.info(f"Staged chunk {name}")
+            if not _put(staged, name, stop):
+                break
+
+def _reap_copies(conn, cursor, in_flight, loaded, target):
+    for query_id, name in list(in_flight):
+        status = conn.get_query_status_throw_if_error(query_id)
+        if conn.is_still_running(status):
+            continue
+        cursor.get_results_from_sfqid(query_id)
+        summary = copy_summary(result_rows(cursor, COPY_RESULT_COLUMNS))
+        in_flight.remove((query_id, name))
+        # a bad chunk stops the pipeline here instead of showing up as a short total at the end
+        check_copy(summary, f"{target} ({name})", expected_files=1)
+        loaded.append(summary['rows_loaded'])
+
+def _copy_stage(conn, stage, target, staged, stop, loaded):
+    in_flight = []
+    with conn.cursor() as cursor:
+        while True:
+            name = _get(staged, stop)
+            if name is None:
+                break
+            cursor.execute_async(f"COPY INTO {target} FROM @{stage} FILES = ('{name}') "
+                                 f"FILE_FORMAT = {FILE_FORMAT}")
+            in_flight.append((cursor.sfqid, name))
+            while len(in_flight) >= COPY_IN_FLIGHT:
+                time.sleep(POLL_INTERVAL)
+                _reap_copies(conn, cursor, in_flight, loaded, target)
+        while in_flight and not stop.is_set():
+            time.sleep(POLL_INTERVAL)
+            _reap_copies(conn, cursor, in_flight, loaded, target)
+
+def _remove_staged(conn, stage, names):
+    # loaded or not, a rerun PUTs the member again, so the staged chunks can go
+    with conn.cursor() as cursor:
+        for name in names:
+            try:
+                cursor.execute(f"REMOVE @{stage}/{name}")
+            except Exception as e:
+                logging.warning(f"Could not remove {name} from @{stage}: {e}")
+    if names:
+        logging.info(f"Removed {len(names)} pipelined chunks from @{stage}")
+
+def _run_stage(name, errors, stop, done, target, *args):
+    try:
+        target(*args)
+    except BaseException as e:
+        errors.append((name, e))
+        stop.set()
+    finally:
+        # tell the next stage there is nothing more coming
+        if done is not None:
+            _put(done, None, stop)
+
+def pipelined_load(conn, zip_ref, member, target, stage, chunk_dir, chunk_size=PIPELINE_CHUNK_SIZE):
+    started = time.perf_counter()
+    os.makedirs(chunk_dir, exist_ok=True)
+    # per run, so chunks of a failed run never sit next to this one's
+    run_dir = tempfile.mkdtemp(prefix='npi_pipeline_', dir=chunk_dir)
+    staged_names = []
+    chunks = queue.Queue(maxsize=QUEUE_DEPTH)
+    staged = queue.Queue(maxsize=QUEUE_DEPTH)
+    stop = threading.Event()
+    errors = []
+    loaded = []
+    counter = RowCounter()
+
+    threads = [
+        threading.Thread(target=_run_stage, name='extract',
+                         args=('extract', errors, stop, chunks, _extract_stage,
+                               zip_ref, member, run_dir, chunk_size, chunks, stop, counter)),
+        threading.Thread(target=_run_stage, name='put',
+                         args=('put', errors, stop, staged, _put_stage, conn, stage, chunks, staged, stop,
+                               staged_names)),
+        threading.Thread(target=_run_stage, name='copy',
+                         args=('copy', errors, stop, None, _copy_stage, conn, stage, target, staged, stop, loaded)),
+    ]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+        _remove_staged(conn, stage, staged_names)
+
+    if errors:
+        name, error = errors[0]
+        raise Exception(f"Pipeline {name} stage failed: {error}") from error
+
+    elapsed = time.perf_counter() - started
+    result = PipelineResult(counter.data_rows(), sum(loaded), len(loaded), elapsed)
+    logging.info(f"Pipelined load into {target}: {result.rows_loaded} of {result.row_count} rows "
+                 f"in {result.chunks} chunks, {elapsed:.2f} seconds")
+    return result
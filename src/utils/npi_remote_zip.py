@@ -0,0 +1,137 @@
+'''
+Read single members out of the remote NPPES ZIP without downloading it.
+
+The scripts that only want endpoint_pfile (a few MB compressed) used to
+pull the whole ~1 GB archive first. A ZIP can be read from the end:
+the end-of-central-directory record (plus the Zip64 locator and record
+for big archives) sits in the last few KB, it points at the central
+directory, and every central directory entry points at its member's
+local header and compressed bytes.
+
+HttpRangeFile is a read-only, seekable file object where every read is
+an HTTP Range request. Handed to zipfile.ZipFile (behind a small read
+buffer) zipfile does the EOCD / Zip64 / central directory parsing
+itself, and opening a member range-fetches and inflates only that
+member's bytes. Opening the archive costs a handful of small requests,
+reading endpoint_pfile costs its compressed size.
+
+If-Range carries the ETag (or Last-Modified) from the probe, so if CMS
+swaps the file while we read it the server answers 200 instead of 206
+and the read fails instead of mixing two archives.
+
+open_remote_zip falls back to range_download (a full download, spilled
+to disk) when the server doesn't do ranges. Given a cache (npi_cache) it
+opens the local copy instead when a sibling run already downloaded this
+exact file.
+'''
+
+import io
+import logging
+import time
+import zipfile
+
+import requests
+
+from npi_download import probe, range_download, RANGE_RETRIES
+
+READ_BUFFER_SIZE = 64 * 1024  # enough for the EOCD + central directory in one or two requests
+
+class HttpRangeFile(io.RawIOBase):
+    def __init__(self, url, size, validator=None, retries=RANGE_RETRIES, session=None):
+        self.url = url
+        self.size = size
+        self.validator = validator
+        self.retries = retries
+        self.session = session or requests.Session()
+        self.position = 0
+        self.requests = 0
+        self.bytes_fetched = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}")
+        if position < 0:
+            raise OSError(f"Negative seek position {position}")
+        self.position = position
+        return position
+
+    def readinto(self, buffer):
+        end = min(self.position + len(buffer), self.size)
+        if end <= self.position:
+            return 0
+        data = self._fetch(self.position, end - 1)
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def _fetch(self, start, end):
+        headers = {'Range': f'bytes={start}-{end}'}
+        if self.validator:
+            headers['If-Range'] = self.validator
+        for attempt in range(1, self.retries + 1):
+            try:
+                with self.session.get(self.url, headers=headers, timeout=(10, 300)) as response:
+                    if response.status_code == 200:
+                        raise Exception(f"{self.url} changed while it was being read")
+                    response.raise_for_status()
+                    data = response.content
+                self.requests += 1
+                self.bytes_fetched += len(data)
+                return data
+            except requests.RequestException as e:
+                if attempt == self.retries:
+                    raise
+                logging.warning(f"Range {start}-{end} failed (attempt {attempt}/{self.retries}): {e}")
+                time.sleep(2 ** attempt)
+
+    def close(self):
+        if not self.closed:
+            logging.info(f"Read {self.bytes_fetched / (1024 * 1024):.2f} MB of {self.size / (1024 * 1024):.1f} MB "
+                         f"from {self.url} in {self.requests} range requests")
+            self.session.close()
+        super().close()
+
+class _OwningZipFile(zipfile.ZipFile):
+    # ZipFile leaves file objects it didn't open alone, this one closes its source with it
+    def __init__(self, source):
+        self.source = source
+        try:
+            super().__init__(source, 'r')
+        except Exception:
+            source.close()
+            raise
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self.source.close()
+
+def open_remote_zip(url, buffer_size=READ_BUFFER_SIZE, cache=None):
+    if cache:
+        cached, _ = cache.cached_archive(url)
+        if cached:
+            return _OwningZipFile(cached)
+    headers = probe(url)
+    size = int(headers.get('Content-Length') or 0)
+    validator = headers.get('ETag') or headers.get('Last-Modified')
+    if headers.get('Accept-Ranges', '').lower() != 'bytes' or not size:
+        logging.info("Range requests not available, downloading the whole ZIP instead")
+        return _OwningZipFile(range_download(url))
+    logging.info(f"Reading {url} remotely ({size / (1024 * 1024):.1f} MB) with range requests")
+    return _OwningZipFile(io.BufferedReader(HttpRangeFile(url, size, validator), buffer_size))
@@ -0,0 +1,330 @@
+'''
+Concurrent S3 multipart uploader shared by the S3 scripts.
+
+upload_multipart:
+    Sends parts on a thread pool instead of one 5 MB slice at a time.
+    Part size is picked from the object size so we stay under the
+    10,000 part limit, single parts are retried with backoff, and the
+    multipart upload is aborted if anything fatal happens so we don't
+    leave orphaned parts (and storage charges) behind.
+
+    source can be bytes or a path to a local file. For files each worker
+    reads only its own slice, so memory stays at roughly workers x part size.
+
+    s3_client is passed in, so it works the same against moto or any other
+    local S3 stand-in.
+
+    Resuming: pass the upload_id of an interrupted upload together with
+    the parts from the last checkpoint. checkpoint is called with
+    (upload_id, parts) after every part so the caller can record progress,
+    every part carries the MD5 of the bytes that were sent. A part found
+    with list_parts is only skipped if its ETag matches the checkpoint and
+    the same slice of the source still hashes to the recorded MD5, so a
+    source that changed in between gets uploaded again. abort_on_error=False
+    leaves the upload open for the next run instead of aborting it.
+
+upload_stream:
+    Same thing for a stream of unknown length, e.g. zip_ref.open(member).
+    Bytes are pulled into a part buffer (gzipped on the fly with
+    compress=True) and every part is handed to the pool as soon as it
+    fills, so decompression overlaps the upload and at most workers + 1
+    parts are in memory.
+
+    Resuming works like upload_multipart, with the same checkpoint and
+    abort_on_error. Parts are cut in order at fixed sizes, so a rerun
+    reads the stream from the start again and cuts the same parts. A part
+    whose ETag matches the checkpoint and whose bytes still hash to the
+    recorded MD5 is skipped instead of sent again. The stream is still
+    read (and gzipped) in full, only the upload is saved.
+'''
+
+import base64
+import hashlib
+import logging
+import os
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+MB = 1024 * 1024
+MIN_PART_SIZE = 5 * MB  # S3 minimum for every part except the last
+MAX_PARTS = 10000
+DEFAULT_WORKERS = 8
+PART_RETRIES = 3
+STREAM_PART_SIZE = 64 * MB
+STREAM_BLOCK_SIZE = 1 * MB
+GZIP_LEVEL = 3  # csv compresses well, favour speed
+
+def choose_part_size(object_size, min_part_size=MIN_PART_SIZE):
+    part_size = max(min_part_size, -(-object_size // MAX_PARTS))
+    # round up to a whole MB, keeps the numbers readable in logs
+    return -(-part_size // MB) * MB
+
+def count_parts(object_size, part_size):
+    return max(1, -(-object_size // part_size))
+
+def _source_size(source):
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return len(source)
+    return os.path.getsize(source)
+
+def _read_part(source, offset, length):
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return bytes(source[offset:offset + length])
+    with open(source, 'rb') as file:
+        file.seek(offset)
+        return file.read(length)
+
+def _upload_part(s3_client, bucket, key, upload_id, part_number, source, offset, length, retries):
+    for attempt in range(1, retries + 1):
+        try:
+            body = _read_part(source, offset, length)
+            md5 = hashlib.md5(body)
+            part = s3_client.upload_part(
+                Bucket=bucket,
+                Key=key,
+                PartNumber=part_number,
+                UploadId=upload_id,
+                Body=body,
+                ContentMD5=base64.b64encode(md5.digest()).decode()
+            )
+            return {'PartNumber': part_number, 'ETag': part['ETag'], 'MD5': md5.hexdigest()}
+        except Exception as e:
+            if attempt == retries:
+                raise
+            logging.warning(f"Part {part_number} failed (attempt {attempt}/{retries}): {e}")
+            time.sleep(2 ** attempt)
+
+def _completed_parts(parts):
+    # the MD5 is only for our checkpoint, S3 rejects unknown keys
+    return [{'PartNumber': part['PartNumber'], 'ETag': part['ETag']} for part in parts]
+
+def list_uploaded_parts(s3_client, bucket, key, upload_id):
+    parts = {}
+    marker = 0
+    while True:
+        response = s3_client.list_parts(Bucket=bucket, Key=key, UploadId=upload_id,
+                                        PartNumberMarker=marker)
+        for part in response.get('Parts', []):
+            parts[part['PartNumber']] = part
+        if not response.get('IsTruncated'):
+            return parts
+        marker = response['NextPartNumberMarker']
+
+def _resume_parts(s3_client, bucket, key, upload_id, source, size, part_size, recorded):
+    try:
+        uploaded = list_uploaded_parts(s3_client, bucket, key, upload_id)
+    except Exception as e:
+        logging.warning(f"Could not resume multipart upload {upload_id}, starting over: {e}")
+        return None
+    recorded = {part['PartNumber']: part for part in recorded or []}
+    parts = []
+    for part_number, part in uploaded.items():
+        offset = (part_number - 1) * part_size
+        expected = min(part_size, size - offset)
+        checkpointed = recorded.get(part_number, {})
+        # a part with the wrong size was cut for a different part size, one without a
+        # matching checkpoint or with different bytes at its offset is from another source
+        if part.get('Size') != expected or checkpointed.get('ETag') != part['ETag'] or not checkpointed.get('MD5'):
+            continue
+        if hashlib.md5(_read_part(source, offset, expected)).hexdigest() == checkpointed['MD5']:
+            parts.append(checkpointed)
+    logging.info(f"Resuming multipart upload {upload_id}: {len(parts)} parts already on S3")
+    return parts
+
+def upload_multipart(s3_client, bucket, key, source, workers=DEFAULT_WORKERS,
+                     part_size=None, retries=PART_RETRIES, progress=None,
+                     upload_id=None, uploaded_parts=None, checkpoint=None, abort_on_error=True):
+    size = _source_size(source)
+    part_size = part_size or choose_part_size(size)
+    total_parts = count_parts(size, part_size)
+    if total_parts > MAX_PARTS:
+        raise ValueError(f"{total_parts} parts of {part_size} bytes exceeds the {MAX_PARTS} part limit")
+
+    started = time.perf_counter()
+    parts = None
+    if upload_id:
+        parts = _resume_parts(s3_client, bucket, key, upload_id, source, size, part_size, uploaded_parts)
+    if parts is None:
+        upload_id = s3_client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+        parts = []
+        if checkpoint:
+            checkpoint(upload_id, [])
+    logging.info(f"Multipart upload {upload_id} for s3://{bucket}/{key}: "
+                 f"{total_parts} parts of {part_size // MB} MB on {workers} workers")
+    if progress and parts:
+        progress(len(parts))
+    done_parts = {part['PartNumber'] for part in parts}
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [
+                pool.submit(_upload_part, s3_client, bucket, key, upload_id,
+                            part_number, source, offset, part_size, retries)
+                for part_number, offset in enumerate(range(0, max(size, 1), part_size), start=1)
+                if part_number not in done_parts
+            ]
+            try:
+                for future in as_completed(futures):
+                    parts.append(future.result())
+                    if checkpoint:
+                        checkpoint(upload_id, sorted(parts, key=lambda part: part['PartNumber']))
+                    if progress:
+                        progress(1)
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
+        parts.sort(key=lambda part: part['PartNumber'])
+        s3_client.complete_multipart_upload(
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={'Parts': _completed_parts(parts)}
+        )
+    except BaseException:
+        if not abort_on_error:
+            logging.error(f"Multipart upload {upload_id} left open for resume "
+                          f"({len(parts)}/{total_parts} parts uploaded)")
+            raise
+        logging.error(f"Aborting multipart upload {upload_id} for s3://{bucket}/{key}")
+        try:
+            s3_client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        except Exception as e:
+            logging.error(f"Failed to abort multipart upload {upload_id}: {e}")
+        raise
+
+    elapsed = max(time.perf_counter() - started, 1e-6)
+    logging.info(f"Uploaded {size / MB:.1f} MB to s3://{bucket}/{key} "
+                 f"in {elapsed:.2f} seconds ({size / MB / elapsed:.1f} MB/s)")
+    return upload_id, parts
+
+def _resume_stream_parts(s3_client, bucket, key, upload_id, recorded):
+    # part number -> checkpointed part for every part S3 still has as recorded, None to start over
+    try:
+        uploaded = list_uploaded_parts(s3_client, bucket, key, upload_id)
+    except Exception as e:
+        logging.warning(f"Could not resume multipart upload {upload_id}, starting over: {e}")
+        return None
+    # the length of the stream isn't known up front, the MD5 of the re-read part settles it
+    reusable = {part['PartNumber']: part for part in recorded or []
+                if part.get('MD5') and uploaded.get(part['PartNumber'], {}).get('ETag') == part['ETag']}
+    logging.info(f"Resuming multipart upload {upload_id}: {len(reusable)} parts on S3 to check against the stream")
+    return reusable
+
+def upload_stream(s3_client, bucket, key, stream, workers=DEFAULT_WORKERS, part_size=STREAM_PART_SIZE,
+                  compress=False, retries=PART_RETRIES, progress=None, block_size=STREAM_BLOCK_SIZE,
+                  upload_id=None, uploaded_parts=None, checkpoint=None, abort_on_error=True):
+    part_size = max(part_size, MIN_PART_SIZE)
+    started = time.perf_counter()
+    reusable = _resume_stream_parts(s3_client, bucket, key, upload_id, uploaded_parts) if upload_id else None
+    if reusable is None:
+        upload_id = s3_client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+        reusable = {}
+        if checkpoint:
+            checkpoint(upload_id, [])
+    logging.info(f"Streaming multipart upload {upload_id} for s3://{bucket}/{key}: "
+                 f"{part_size // MB} MB parts on {workers} workers" + (", gzip" if compress else ""))
+    # wbits=31 writes a gzip header and trailer, so the object is a plain .gz
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31) if compress else None
+    # one part filling plus one per worker, the reader blocks until a slot frees up
+    slots = threading.BoundedSemaphore(workers + 1)
+    errors = []
+    futures = []
+    reused = []
+    # every finished part, reused or uploaded, in the order they finished
+    finished = []
+    finished_lock = threading.Lock()
+    pending = bytearray()
+    raw_bytes = 0
+    uploaded_bytes = 0
+    part_count = 0
+
+    def part_finished(part):
+        with finished_lock:
+            finished.append(part)
+            snapshot = sorted(finished, key=lambda part: part['PartNumber'])
+        if checkpoint:
+            checkpoint(upload_id, snapshot)
+
+    def part_done(future):
+        slots.release()
+        if future.cancelled():
+            return
+        if future.exception():
+            errors.append(future.exception())
+            return
+        try:
+            part_finished(future.result())
+        except Exception as e:
+            errors.append(e)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            def submit(data):
+                nonlocal part_count
+                part_count += 1
+                previous = reusable.get(part_count)
+                if previous and hashlib.md5(data).hexdigest() == previous['MD5']:
+                    reused.append(previous)
+                    part_finished(previous)
+                    return
+                slots.acquire()
+                future = pool.submit(_upload_part, s3_client, bucket, key, upload_id,
+                                     part_count, data, 0, len(data), retries)
+                futures.append(future)
+                future.add_done_callback(part_done)
+
+            try:
+                while True:
+                    if errors:
+                        raise errors[0]
+                    block = stream.read(block_size)
+                    if not block:
+                        break
+                    raw_bytes += len(block)
+                    pending += compressor.compress(block) if compressor else block
+                    while len(pending) >= part_size:
+                        submit(bytes(pending[:part_size]))
+                        uploaded_bytes += part_size
+                        del pending[:part_size]
+                    if progress:
+                        progress(len(block))
+                if compressor:
+                    pending += compressor.flush()
+                if pending or not part_count:
+                    # the last part may be smaller than the S3 minimum
+                    submit(bytes(pending))
+                    uploaded_bytes += len(pending)
+                parts = sorted(reused + [future.result() for future in futures],
+                               key=lambda part: part['PartNumber'])
+                if errors:
+                    raise errors[0]
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
+        s3_client.complete_multipart_upload(
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={'Parts': _completed_parts(parts)}
+        )
+    except BaseException:
+        if not abort_on_error:
+            logging.error(f"Multipart upload {upload_id} left open for resume "
+                          f"({len(finished)} parts uploaded)")
+            raise
+        logging.error(f"Aborting multipart upload {upload_id} for s3://{bucket}/{key}")
+        try:
+            s3_client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        except Exception as e:
+            logging.error(f"Failed to abort multipart upload {upload_id}: {e}")
+        raise
+
+    elapsed = max(time.perf_counter() - started, 1e-6)
+    logging.info(f"Streamed {raw_bytes / MB:.1f} MB as {uploaded_bytes / MB:.1f} MB in {len(parts)} parts "
+                 f"({len(reused)} already on S3) to s3://{bucket}/{key} in {elapsed:.2f} seconds ({raw_bytes / MB / elapsed:.1f} MB/s)")
+    return upload_id, parts
@@ -0,0 +1,220 @@
+'''
+Split-and-compress staging for the Snowflake loaders.
+
+One multi-GB CSV on a stage means Snowflake compresses it during PUT and
+COPY INTO parses it as a single file on a single thread. Instead:
+
+find_chunk_ranges:
+    One fast pass over the CSV (bytes.count / bytes.find, no Python per row)
+    that picks split points on record boundaries. Quote state is tracked, so
+    a newline inside a quoted field is never used as a split point.
+
+split_and_compress:
+    Compresses every byte range into its own .csv.gz (or .csv.zst when the
+    zstandard package is installed) on a process pool. Every chunk gets a
+    copy of the header so SKIP_HEADER = 1 stays correct for each file.
+
+put_chunks:
+    One PUT with a wildcard and PARALLEL = n, so the chunks go up on
+    parallel threads and COPY INTO can spread them over the warehouse.
+    put_files is the same but returns the PUT result rows (source and
+    target sizes, compression, status).
+
+copy_summary / check_copy:
+    COPY INTO already reports per file how many rows it parsed and
+    loaded, how many errors it saw and the first one. The loaders
+    reconcile against that instead of SELECT COUNT(*) before and after.
+    check_copy raises when a file failed, was skipped or only partly
+    loaded, or when the rows loaded don't match the rows expected.
+'''
+
+import glob
+import gzip
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MB = 1024 * 1024
+CHUNK_SIZE = 200 * MB  # Snowflake recommends 100-250 MB per file
+BLOCK_SIZE = 16 * MB
+COMPRESS_WORKERS = os.cpu_count() or 4
+PUT_THREADS = 8
+GZIP_LEVEL = 3  # csv compresses well, favour speed
+
+def _read_header(file):
+    header = file.readline()
+    if not header.endswith(b'\n'):
+        header += b'\n'
+    return header
+
+def find_chunk_ranges(file_path, chunk_size=CHUNK_SIZE, block_size=BLOCK_SIZE):
+    size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as file:
+        header = _read_header(file)
+        chunk_start = file.tell()
+        target = chunk_start + chunk_size
+        ranges = []
+        in_quotes = 0
+        pos = chunk_start
+
+        while target < size:
+            block = file.read(block_size)
+            if not block:
+                break
+            block_end = pos + len(block)
+            i = 0
+            while target < block_end:
+                # quote parity up to the target, then walk newlines until one is outside quotes
+                start = max(target - pos, i)
+                in_quotes ^= block.count(b'"', i, start) & 1
+                i = start
+                while True:
+                    newline = block.find(b'\n', i)
+                    if newline == -1:
+                        break
+                    in_quotes ^= block.count(b'"', i, newline) & 1
+                    i = newline + 1
+                    if not in_quotes:
+                        break
+                if newline == -1 or in_quotes:
+                    break  # boundary is in the next block
+                ranges.append((chunk_start, pos + i))
+                chunk_start = pos + i
+                target = chunk_start + chunk_size
+            in_quotes ^= block.count(b'"', i) & 1
+            pos = block_end
+
+    if chunk_start < size:
+        ranges.append((chunk_start, size))
+    return header, ranges
+
+def _open_compressed(out_path, codec):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=3, threads=0).stream_writer(open(out_path, 'wb'))
+    return gzip.open(out_path, 'wb', compresslevel=GZIP_LEVEL)
+
+def compress_range(file_path, start, end, header, out_path, codec='gzip', block_size=BLOCK_SIZE):
+    with open(file_path, 'rb') as src, _open_compressed(out_path, codec) as dst:
+        dst.write(header)
+        src.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            block = src.read(min(block_size, remaining))
+            if not block:
+                break
+            dst.write(block)
+            remaining -= len(block)
+    return out_path, end - start, os.path.getsize(out_path)
+
+def split_and_compress(file_path, out_dir, chunk_size=CHUNK_SIZE, workers=COMPRESS_WORKERS, codec=None):
+    codec = codec or ('zstd' if zstandard else 'gzip')
+    if codec == 'zstd' and not zstandard:
+        raise ImportError("zstandard is not installed, use codec='gzip'")
+    extension = '.csv.zst' if codec == 'zstd' else '.csv.gz'
+
+    started = time.perf_counter()
+    header, ranges = find_chunk_ranges(file_path, chunk_size)
+    logging.info(f"Split points found in {time.perf_counter() - started:.2f} seconds: "
+                 f"{len(ranges)} chunks of ~{chunk_size // MB} MB")
+
+    os.makedirs(out_dir, exist_ok=True)
+    base_name = os.path.splitext(os.path.basename(file_path))[0]
+    chunk_paths = [os.path.join(out_dir, f"{base_name}_{index:04d}{extension}")
+                   for index in range(len(ranges))]
+
+    raw_bytes = 0
+    compressed_bytes = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(compress_range, file_path, start, end, header, out_path, codec)
+                   for (start, end), out_path in zip(ranges, chunk_paths)]
+        for future in futures:
+            _, raw, compressed = future.result()
+            raw_bytes += raw
+            compressed_bytes += compressed
+
+    elapsed = max(time.perf_counter() - started, 1e-6)
+    logging.info(f"Compressed {raw_bytes / MB:.1f} MB to {compressed_bytes / MB:.1f} MB ({codec}) "
+                 f"in {elapsed:.2f} seconds ({raw_bytes / MB / elapsed:.1f} MB/s)")
+    return chunk_paths
+
+PUT_RESULT_COLUMNS = ['source', 'target', 'source_size', 'target_size', 'source_compression',
+                      'target_compression', 'status', 'message']
+COPY_RESULT_COLUMNS = ['file', 'status', 'rows_parsed', 'rows_loaded', 'error_limit', 'errors_seen',
+                       'first_error', 'first_error_line', 'first_error_character', 'first_error_column_name']
+
+def result_rows(cursor, columns):
+    # by name when the connector describes the result, by position otherwise
+    rows = cursor.fetchall()
+    description = getattr(cursor, 'description', None)
+    names = [column[0].lower() for column in description] if description else columns
+    return [dict(zip(names, row)) for row in rows]
+
+def put_summary(results):
+    source_bytes = sum(result['source_size'] or 0 for result in results)
+    target_bytes = sum(result['target_size'] or 0 for result in results)
+    compression = sorted({result['target_compression'] or 'NONE' for result in results})
+    return {'files': len(results), 'source_bytes': source_bytes, 'target_bytes': target_bytes,
+            'compression': compression}
+
+def copy_summary(results):
+    # "Copy executed with 0 files processed." comes back as one row with only a status column
+    files = [result for result in results if 'rows_loaded' in result]
+    return {'files': len(files),
+            'rows_parsed': sum(result['rows_parsed'] or 0 for result in files),
+            'rows_loaded': sum(result['rows_loaded'] or 0 for result in files),
+            'errors_seen': sum(result['errors_seen'] or 0 for result in files),
+            'first_error': next((f"{result['file']} line {result['first_error_line']}: {result['first_error']}"
+                                 for result in files if result.get('first_error')), None),
+            'not_loaded': [result['file'] for result in files if result['status'] != 'LOADED']}
+
+def check_copy(summary, target, expected_rows=None, expected_files=None):
+    problems = []
+    if expected_files is not None and summary['files'] != expected_files:
+        problems.append(f"{summary['files']} of {expected_files} files processed")
+    if summary['not_loaded']:
+        problems.append(f"not fully loaded: {summary['not_loaded']}")
+    if summary['errors_seen']:
+        problems.append(f"{summary['errors_seen']} errors, first: {summary['first_error']}")
+    if expected_rows is not None and summary['rows_loaded'] != expected_rows:
+        problems.append(f"{summary['rows_loaded']} rows loaded, expected {expected_rows}")
+    elif summary['rows_loaded'] != summary['rows_parsed']:
+        problems.append(f"{summary['rows_loaded']} of {summary['rows_parsed']} parsed rows loaded")
+    if problems:
+        raise Exception(f"COPY INTO {target} did not reconcile: " + "; ".join(problems))
+    logging.info(f"COPY INTO {target}: {summary['rows_loaded']} rows from {summary['files']} files, "
+                 f"{summary['rows_parsed']} parsed, no errors")
+
+def put_files(cursor, chunk_paths, stage, parallel=PUT_THREADS):
+    if not chunk_paths:
+        return []
+    # every chunk shares the directory and base name, so one wildcard PUT covers them all
+    chunk_dir = os.path.dirname(chunk_paths[0])
+    base_name, _, extension = os.path.basename(chunk_paths[0]).rpartition('_')
+    extension = extension.split('.', 1)[1]
+    # parquet compresses internally, so there is nothing for Snowflake to decompress
+    compression = {'zst': 'ZSTD', 'gz': 'GZIP'}.get(extension.rsplit('.', 1)[-1], 'NONE')
+    options = f"PARALLEL = {parallel} AUTO_COMPRESS = FALSE SOURCE_COMPRESSION = {compression} OVERWRITE = TRUE"
+    pattern = os.path.join(chunk_dir, f"{base_name}_*.{extension}")
+    if sorted(glob.glob(pattern)) == sorted(chunk_paths):
+        cursor.execute(f"PUT file://{pattern.replace(os.sep, '/')} @{stage} {options}")
+        results = result_rows(cursor, PUT_RESULT_COLUMNS)
+    else:
+        # something else in the directory matches the wildcard (leftovers of another run), only PUT ours
+        logging.warning(f"{chunk_dir} holds other files matching {os.path.basename(pattern)}, staging chunk by chunk")
+        results = []
+        for path in chunk_paths:
+            cursor.execute(f"PUT file://{path.replace(os.sep, '/')} @{stage} {options}")
+            results += result_rows(cursor, PUT_RESULT_COLUMNS)
+    summary = put_summary(results)
+    logging.info(f"Staged {summary['files']} chunks to @{stage}: {summary['source_bytes'] / MB:.1f} MB sent "
+                 f"as {summary['target_bytes'] / MB:.1f} MB ({', '.join(summary['compression'])})")
+    return results
+
+def put_chunks(cursor, chunk_paths, stage, parallel=PUT_THREADS):
+    return [result['target'] for result in put_files(cursor, chunk_paths, stage, parallel)]
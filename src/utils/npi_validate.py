@@ -0,0 +1,160 @@
+'''
+Pre-load validation of an extracted NPPES CSV, run before anything is PUT.
+
+The loaders abort on any COPY error, but without this a malformed file is
+only found after the multi-GB PUT and most of the COPY. validate_csv reads
+the file with pyarrow's multithreaded CSV reader in large blocks and checks
+every batch with Arrow compute kernels, no Python per row:
+
+structural (raise as soon as they are seen):
+    - header: expected column count, no blank or duplicate names, NPI present
+    - column count per record: the Arrow reader rejects a record with the
+      wrong number of fields, quoted newlines are handled
+
+content (counted, raise once more than max_errors rows are bad):
+    - NPI is 10 digits and passes the Luhn check with the 80840 prefix
+    - Entity Type Code is 1 or 2 (blank on deactivated NPIs)
+    - date columns are MM/DD/YYYY or blank
+
+A compact report (rows, bad rows per check, a few sample NPIs, MB/s) is
+logged either way.
+'''
+
+import csv
+import logging
+import os
+import time
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = None
+
+MB = 1024 * 1024
+READ_BLOCK_SIZE = 64 * MB
+SAMPLE_SIZE = 5
+NPI_COLUMN = 'NPI'
+ENTITY_TYPE_COLUMN = 'Entity Type Code'
+DATE_COLUMNS = ['Provider Enumeration Date', 'Last Update Date', 'NPI Deactivation Date',
+                'NPI Reactivation Date', 'Certification Date']
+DATE_PATTERN = r'^(0[1-9]|1[0-2])/(0[1-9]|[12][0-9]|3[01])/[0-9]{4}$'
+# the 80840 prefix every NPI carries contributes a constant 24 to the Luhn sum
+LUHN_PREFIX_SUM = 24
+
+class ValidationError(Exception):
+    pass
+
+def _check_header(header, expected_columns):
+    if expected_columns is not None and len(header) != expected_columns:
+        raise ValidationError(f"Header has {len(header)} columns, expected {expected_columns}")
+    names = [name.strip().lower() for name in header]
+    if any(not name for name in names):
+        raise ValidationError("Header has a blank column name")
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValidationError(f"Header has duplicate columns: {duplicates}")
+    if NPI_COLUMN.lower() not in names:
+        raise ValidationError(f"Header has no {NPI_COLUMN} column")
+
+def _mod10(values):
+    # integer divide truncates, so this is values % 10 for non-negative values
+    return pc.subtract(values, pc.multiply(pc.divide(values, 10), 10))
+
+def luhn_valid(npi):
+    # 10 ASCII digits, check digit last; doubled positions are 0, 2, 4, 6, 8
+    well_formed = pc.match_substring_regex(npi, r'^[0-9]{10}$')
+    digits = pc.if_else(well_formed, npi, '0000000000')
+    digit = [pc.cast(pc.utf8_slice_codeunits(digits, i, i + 1), pa.int32()) for i in range(10)]
+    total = pa.scalar(LUHN_PREFIX_SUM, pa.int32())
+    for i in range(9):
+        if i % 2 == 0:
+            doubled = pc.multiply(digit[i], 2)
+            total = pc.add(total, pc.subtract(doubled, pc.multiply(pc.cast(pc.greater(doubled, 9), pa.int32()), 9)))
+        else:
+            total = pc.add(total, digit[i])
+    return pc.and_(well_formed, pc.equal(_mod10(pc.add(total, digit[9])), 0))
+
+def _blank(values):
+    return pc.or_(pc.is_null(values), pc.equal(values, ''))
+
+def _record(bad, name, mask, npi, report):
+    bad_rows = pc.sum(pc.cast(mask, pa.int64())).as_py() or 0
+    if not bad_rows:
+        return
+    report['errors'][name] = report['errors'].get(name, 0) + bad_rows
+    samples = report['samples'].setdefault(name, [])
+    if len(samples) < SAMPLE_SIZE:
+        samples.extend(pc.filter(npi, mask).slice(0, SAMPLE_SIZE - len(samples)).to_pylist())
+    bad.append(mask)
+
+def _check_batch(batch, columns, report):
+    npi = batch.column(columns[NPI_COLUMN])
+    bad = []
+    _record(bad, 'npi_luhn', pc.invert(luhn_valid(npi)), npi, report)
+    if ENTITY_TYPE_COLUMN in columns:
+        entity = batch.column(columns[ENTITY_TYPE_COLUMN])
+        ok = pc.or_(_blank(entity), pc.is_in(entity, value_set=pa.array(['1', '2'])))
+        _record(bad, 'entity_type', pc.invert(ok), npi, report)
+    for name in DATE_COLUMNS:
+        if name in columns:
+            values = batch.column(columns[name])
+            ok = pc.or_(_blank(values), pc.match_substring_regex(values, DATE_PATTERN))
+            _record(bad, name, pc.invert(ok), npi, report)
+    if bad:
+        any_bad = bad[0]
+        for mask in bad[1:]:
+            any_bad = pc.or_(any_bad, mask)
+        report['bad_rows'] += pc.sum(pc.cast(any_bad, pa.int64())).as_py() or 0
+
+def log_report(report):
+    logging.info(f"Validation report for {report['file']}: {report['rows']} rows, {report['bad_rows']} bad, "
+                 f"{report['seconds']:.2f} seconds ({report['mb_per_second']:.1f} MB/s)")
+    for name, count in sorted(report['errors'].items()):
+        logging.info(f"    {name}: {count} rows, e.g. NPI {report['samples'].get(name)}")
+
+def validate_csv(file_path, expected_columns=None, max_errors=0):
+    if pa is None:
+        raise ImportError("pyarrow is not installed, run without --validate")
+
+    started = time.perf_counter()
+    with open(file_path, 'r', newline='', encoding='utf-8', errors='surrogateescape') as file:
+        header = next(csv.reader(file))
+    _check_header(header, expected_columns)
+
+    # only the checked columns are converted, every other field is still tokenised and counted
+    by_name = {name.strip().lower(): name for name in header}
+    checked = [by_name[name.lower()] for name in [NPI_COLUMN, ENTITY_TYPE_COLUMN] + DATE_COLUMNS
+               if name.lower() in by_name]
+    reader = pa_csv.open_csv(
+        file_path,
+        read_options=pa_csv.ReadOptions(block_size=READ_BLOCK_SIZE),
+        parse_options=pa_csv.ParseOptions(newlines_in_values=True),
+        convert_options=pa_csv.ConvertOptions(include_columns=checked,
+                                              column_types={name: pa.string() for name in checked}),
+    )
+    columns = {name: index for index, name in enumerate(reader.schema.names)}
+    # report under the canonical names whatever the header's case
+    columns = {canonical: columns[by_name[canonical.lower()]]
+               for canonical in [NPI_COLUMN, ENTITY_TYPE_COLUMN] + DATE_COLUMNS
+               if canonical.lower() in by_name}
+
+    report = {'file': os.path.basename(file_path), 'rows': 0, 'bad_rows': 0, 'errors': {}, 'samples': {}}
+    try:
+        for batch in reader:
+            _check_batch(batch, columns, report)
+            report['rows'] += batch.num_rows
+            if report['bad_rows'] > max_errors:
+                break
+    except pa.ArrowInvalid as e:
+        # wrong field count, unterminated quote and the like
+        raise ValidationError(f"{file_path} is malformed after ~{report['rows']} rows: {e}") from e
+    finally:
+        report['seconds'] = max(time.perf_counter() - started, 1e-6)
+        report['mb_per_second'] = os.path.getsize(file_path) / MB / report['seconds']
+        log_report(report)
+
+    if report['bad_rows'] > max_errors:
+        raise ValidationError(f"{file_path} has more than {max_errors} invalid rows: {report['errors']}")
+    return report
@@ -0,0 +1,100 @@
+'''
+Watch mode: only run the heavy pipeline when CMS publishes a new file.
+
+The monthly file drops mid month on no fixed day. Instead of blind reruns
+that pull a gigabyte every time, we poll:
+    - the download page with a conditional GET (If-None-Match /
+      If-Modified-Since), a 304 costs a few hundred bytes
+    - if the page changed, the anchor href is compared with the last one
+      seen and the ZIP is checked with a conditional HEAD (ETag,
+      Last-Modified, Content-Length)
+
+The last-seen href and validators are kept in a JSON state file. The state
+is only written after on_new_file succeeds, so a failed load is picked up
+again on the next poll.
+'''
+
+import json
+import logging
+import os
+import random
+import time
+
+import requests
+
+WATCH_INTERVAL = 3600  # seconds between checks
+WATCH_JITTER = 300  # +/- seconds so we don't hit cms.gov on the same second every hour
+
+def load_watch_state(state_path):
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path, 'r') as file:
+        return json.load(file)
+
+def save_watch_state(state_path, state):
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(state, file, indent=2)
+    os.replace(tmp_path, state_path)
+
+def _conditional_headers(etag, last_modified):
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    return headers
+
+def check_for_new_file(page_url, locate, state):
+    response = requests.get(page_url, timeout=(10, 60),
+                            headers=_conditional_headers(state.get('page_etag'), state.get('page_last_modified')))
+    if response.status_code == 304:
+        logging.info("Download page not modified")
+        return False, state
+    response.raise_for_status()
+
+    download_url = locate(response.content)
+    new_state = dict(state,
+                     page_etag=response.headers.get('ETag'),
+                     page_last_modified=response.headers.get('Last-Modified'),
+                     download_url=download_url,
+                     href=download_url.rsplit('/', 1)[-1])
+
+    # same href as last time: ask the server whether the ZIP itself changed
+    same_href = download_url == state.get('download_url')
+    head_headers = _conditional_headers(state.get('etag'), state.get('last_modified')) if same_href else {}
+    head = requests.head(download_url, headers=head_headers, allow_redirects=True, timeout=(10, 60))
+    if head.status_code == 304:
+        logging.info(f"{new_state['href']} not modified")
+        return False, new_state
+    head.raise_for_status()
+    new_state.update(etag=head.headers.get('ETag'),
+                     last_modified=head.headers.get('Last-Modified'),
+                     content_length=head.headers.get('Content-Length'))
+
+    changed = any(new_state.get(key) != state.get(key)
+                  for key in ('download_url', 'etag', 'last_modified', 'content_length'))
+    if not changed:
+        logging.info(f"{new_state['href']} unchanged")
+    return changed, new_state
+
+def watch(page_url, locate, on_new_file, state_path, interval=WATCH_INTERVAL,
+          jitter=WATCH_JITTER, max_checks=None):
+    checks = 0
+    while True:
+        try:
+            state = load_watch_state(state_path)
+            changed, new_state = check_for_new_file(page_url, locate, state)
+            if changed:
+                logging.info(f"New file published: {new_state['href']}")
+                on_new_file(new_state['download_url'])
+            save_watch_state(state_path, new_state)
+        except Exception as e:
+            logging.error(f"Watch check failed, retrying on the next poll: {e}")
+
+        checks += 1
+        if max_checks and checks >= max_checks:
+            return
+        delay = max(interval + random.uniform(-jitter, jitter), 1)
+        logging.info(f"Next check in {delay:.0f} seconds")
+        time.sleep(delay)
@@ -3,9 +3,15 @@ from bs4 import BeautifulSoup
 import boto3
 from botocore.exceptions import NoCredentialsError
 from datetime import datetime
-import zipfile
-import io
 from tqdm import tqdm
+import os
+import sys
+
+# shared helpers live in src/utils
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils'))
+from npi_s3_upload import upload_multipart, choose_part_size, count_parts
+from npi_remote_zip import open_remote_zip
+from npi_cache import default_cache
 
 website_url = "https://download.cms.gov/nppes/NPI_Files.html"
 
@@ -16,6 +22,9 @@ aws_access_key_id = ''
 aws_secret_access_key = ''
 aws_region = ''
 
+# parallel part uploads
+upload_workers = 8
+
 response = requests.get(website_url)
 if response.status_code != 200:
     raise Exception(f"Failed to load page {website_url}")
@@ -34,12 +43,6 @@ if not anchor_tag:
 # the website url, and concats the name of the file instead
 download_url = website_url.rsplit('/', 1)[0] + '/' + anchor_tag['href']
 
-file_response = requests.get(download_url, stream=True)
-if file_response.status_code != 200:
-    raise Exception(f"Failed to download file from {download_url}")
-else:
-    print("Got 200 file_response")
-
 current_datetime = datetime.now()
 s3_file_key = f"{s3_key_prefix}TESTING_GLUE.csv"
 
@@ -51,15 +54,21 @@ s3_client = boto3.client(
     region_name=aws_region
 )
 print("Downloading...")
-buffer = io.BytesIO(file_response.content)
 desired_file_name = None
 desired_file_content = None
 
-with zipfile.ZipFile(buffer, 'r') as zip_ref:
+# only the endpoint member is fetched, with range requests against the remote ZIP
+# (or not at all when the shared cache already has the archive or the member)
+cache = default_cache()
+with open_remote_zip(download_url, cache=cache) as zip_ref:
     for file_info in zip_ref.infolist():
         if file_info.filename.startswith('endpoint_') and not file_info.filename.endswith('fileheader.csv'):
             desired_file_name = file_info.filename
-            desired_file_content = zip_ref.read(file_info.filename)
+            if cache:
+                with cache.open_member(zip_ref, file_info) as member:
+                    desired_file_content = member.read()
+            else:
+                desired_file_content = zip_ref.read(file_info.filename)
             break
 print("Unzipped")
 if not desired_file_name:
@@ -70,28 +79,19 @@ else:
 # Upload the desired CSV file to S3 using multipart upload with progress tracking
 try:
     print("Uploading the desired CSV file using multipart upload...")
-    multipart_upload = s3_client.create_multipart_upload(Bucket=s3_bucket_name, Key=s3_file_key)
-    part_size = 5 * 1024 * 1024  # 5 MB
-    parts = []
-    total_parts = (len(desired_file_content) + part_size - 1) // part_size
+    part_size = choose_part_size(len(desired_file_content))
+    total_parts = count_parts(len(desired_file_content), part_size)
 
-    for i in tqdm(range(0, len(desired_file_content), part_size), desc="Uploading parts", unit="part"):
-        part_number = len(parts) + 1
-        part = s3_client.upload_part(
-            Bucket=s3_bucket_name,
-            Key=s3_file_key,
-            PartNumber=part_number,
-            UploadId=multipart_upload['UploadId'],
-            Body=desired_file_content[i:i + part_size]
+    with tqdm(total=total_parts, desc="Uploading parts", unit="part") as progress_bar:
+        upload_multipart(
+            s3_client,
+            s3_bucket_name,
+            s3_file_key,
+            desired_file_content,
+            workers=upload_workers,
+            part_size=part_size,
+            progress=progress_bar.update
         )
-        parts.append({'PartNumber': part_number, 'ETag': part['ETag']})
-
-    s3_client.complete_multipart_upload(
-        Bucket=s3_bucket_name,
-        Key=s3_file_key,
-        UploadId=multipart_upload['UploadId'],
-        MultipartUpload={'Parts': parts}
-    )
     print(f"Desired CSV file successfully uploaded to s3://{s3_bucket_name}/{s3_file_key}")
 except NoCredentialsError:
     print("Credentials not available")